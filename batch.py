@@ -0,0 +1,260 @@
+""" Runs polyedge across a cohort of bam files in parallel, writing the per-sample output files and
+a run-level summary csv
+"""
+import os
+import glob
+import sys
+import argparse
+import csv
+import datetime
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import config
+import polyedge
+from results_store import current_run_date
+from timing import StageTimings
+
+
+def run_sample(bamfile, bam_index, args, run_date):
+    """
+    Analyse a single sample, writing its csv and html output files. Run in a worker process, so
+    only picklable summary rows and pdf jobs are returned. The pdfs are written by the main
+    process while later samples are analysed, so the timings written with --timing exclude pdf
+    rendering. A sample fails if any of its output files could not be written
+
+        :param bamfile (str):       Bam file to analyse
+        :param bam_index (str):     Bam index file
+        :param args (dict):         Parsed command line arguments
+        :param run_date (str):      Date and time of the batch run recorded in the results store
+        :return rows (list):        List of summary rows, one per allele per locus
+        :return pdf_jobs (list):    List of (html_paths, pdf_path) tuples, one per pdf to write
+    """
+    pdf_renderer = polyedge.create_pdf_renderer(args, deferred=True)
+    results_store = polyedge.create_results_store(args, run_date)
+    output_pipeline = polyedge.create_output_pipeline(args)
+    analysis = polyedge.build_polyedge(
+        bamfile, bam_index, args, pdf_renderer, polyedge.create_result_cache(args),
+        StageTimings(profile=args["profile"]), results_store, output_pipeline,
+    )
+    try:
+        results = analysis.generate_output()
+    finally:
+        output_failures = output_pipeline.close()
+        if results_store:
+            results_store.close()
+    if output_failures:
+        raise RuntimeError("; ".join(f"{label}: {error}" for label, error in output_failures))
+    polyedge.write_timings(analysis, args)
+    if isinstance(analysis, polyedge.PolyEdge):
+        results = [(analysis, *results)]
+    rows = []
+    for _, allele_list, total_read_count in results:
+        for allele in allele_list:
+            values = list(allele.values())
+            rows.append(
+                values[:len(config.GENERAL_HEADERS)]
+                + [total_read_count]
+                + values[len(config.GENERAL_HEADERS):]
+            )
+    return rows, pdf_renderer.jobs
+
+
+def run_batch(samples, args, workers, output_pipeline, run_date=None):
+    """
+    Fan samples out over a pool of worker processes. Failed samples are reported and recorded in
+    the summary without stopping the rest of the batch. The pdfs of each sample are submitted to
+    the output pipeline as soon as the sample completes, so that they are rendered while later
+    samples are analysed. The pipeline is closed once every sample has completed, and a sample
+    whose pdf could not be written is marked as failed
+
+        :param samples (list):      List of (bamfile, bam_index) tuples
+        :param args (dict):         Parsed command line arguments
+        :param workers (int):       Number of worker processes
+        :param output_pipeline (obj):   OutputPipeline to render the pdfs with
+        :param run_date (str):      Date and time recorded in the results store for every sample
+                                    (default: the start of the batch)
+        :return summary (list):     List of (sample_name, status, error, rows) tuples, in
+                                    sample order
+    """
+    outcomes = {}
+    pdf_samples = {}  # Pdf path: index of sample
+    run_date = run_date or current_run_date()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_sample, bamfile, bam_index, args, run_date): index
+            for index, (bamfile, bam_index) in enumerate(samples)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            bamfile = samples[index][0]
+            try:
+                rows, pdf_jobs = future.result()
+                outcomes[index] = (config.BATCH_STATUS["pass"], "", rows)
+                print(f"Completed {bamfile}")
+                for html_paths, pdf_path in pdf_jobs:
+                    pdf_samples[pdf_path] = index
+                    output_pipeline.submit(pdf_path, polyedge.write_pdf, html_paths, pdf_path)
+            except Exception as exception:  # pylint: disable=broad-except
+                error = "".join(
+                    traceback.format_exception_only(type(exception), exception)
+                ).strip()
+                outcomes[index] = (config.BATCH_STATUS["fail"], error, [])
+                print(f"Failed {bamfile}: {error}")
+    pdf_errors = {}
+    for label, error in output_pipeline.close():
+        pdf_errors.setdefault(pdf_samples[label], []).append(f"{label}: {error}")
+    for index, errors in pdf_errors.items():
+        # The metrics of the sample are kept, as only its pdfs could not be written
+        outcomes[index] = (config.BATCH_STATUS["fail"], "; ".join(errors), outcomes[index][2])
+    return [
+        (sample_name(samples[index][0]), *outcomes[index]) for index in range(len(samples))
+    ]
+
+
+def write_summary(summary, summary_path):
+    """
+    Write run-level summary csv, with one row per allele per locus per sample, and one row for
+    each failed sample
+
+        :param summary (list):      List of (sample_name, status, error, rows) tuples
+        :param summary_path (str):  Path of csv to write
+    """
+    with open(summary_path, "wt", encoding="utf-8") as file:
+        writer = csv.writer(file, delimiter=",")
+        writer.writerow(["Created by", f"{config.APP_NAME}"])
+        writer.writerow(["Version", polyedge.git_tag()])
+        writer.writerow(["Date", datetime.datetime.now().strftime("%d-%B-%Y %H:%M")])
+        writer.writerow(["Samples", len(summary)])
+        writer.writerow(
+            ["Failed samples",
+             sum(status == config.BATCH_STATUS["fail"] for _, status, _, _ in summary)]
+        )
+        writer.writerow([])
+        writer.writerow(
+            config.BATCH_HEADERS + config.GENERAL_HEADERS + config.PANEL_HEADERS
+            + config.TABLE_HEADERS
+        )
+        for name, status, error, rows in summary:
+            if not rows:
+                writer.writerow([name, status, error])
+            for row in rows:
+                writer.writerow([name, status, error] + row)
+    file.close()
+
+
+def load_samplesheet(samplesheet):
+    """
+    Read samples from a tab-separated sample sheet with columns bam and (optionally) bai. Blank
+    lines and lines starting with '#' are skipped. Relative paths are resolved against the
+    directory containing the sample sheet
+
+        :param samplesheet (str):   Path to sample sheet
+        :return samples (list):     List of (bamfile, bam_index) tuples
+    """
+    samples = []
+    sheet_dir = os.path.dirname(os.path.abspath(samplesheet))
+    with open(samplesheet, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = [os.path.join(sheet_dir, field) for field in line.strip().split("\t")]
+            bamfile = fields[0]
+            bam_index = fields[1] if len(fields) > 1 else find_index(bamfile)
+            samples.append((bamfile, bam_index))
+    return samples
+
+
+def find_index(bamfile):
+    """
+    Find the index for a bam file, named either $BAM.bai or $PREFIX.bai, or for a cram file,
+    named either $CRAM.crai or $PREFIX.crai
+
+        :param bamfile (str):       Bam or cram file
+        :return bam_index (str):    Index file (which may not exist)
+    """
+    prefix, extension = os.path.splitext(bamfile)
+    suffix = ".crai" if extension.lower() == ".cram" else ".bai"
+    for bam_index in [f"{bamfile}{suffix}", f"{prefix}{suffix}"]:
+        if os.path.exists(bam_index):
+            return bam_index
+    return f"{bamfile}{suffix}"
+
+
+def sample_name(bamfile):
+    """
+    Sample name as used in the per-sample output files
+
+        :param bamfile (str):       Bam file
+        :return sample_name (str):  Sample name
+    """
+    return os.path.splitext(bamfile)[0].split("/")[-1].split(".")[0]
+
+
+def arg_parse():
+    """
+    Parse arguments supplied by the command line. Create argument parser, define command line
+    arguments, then parse supplied command line arguments using the created argument parser
+
+        :return (Namespace object): parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(
+        description="Run polyedge across a cohort of BAM files in parallel"
+    )
+    parser.add_argument(
+        "-W",
+        config.PARAMS["workers"],
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes (default: number of CPUs)",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["summary"],
+        type=str,
+        default=os.path.join(os.getcwd(), config.BATCH_SUMMARY),
+        help=f"Path of run-level summary csv (default: {config.BATCH_SUMMARY})",
+        required=False,
+    )  # Optional arg
+    requirednamed = parser.add_argument_group(
+        "Required named arguments", "one of samplesheet or bams is required. gene, chrom, "
+        "poly_start and poly_end are not required if --loci is supplied"
+    )
+    samples = requirednamed.add_mutually_exclusive_group(required=True)
+    samples.add_argument(
+        config.PARAMS["samplesheet"],
+        type=polyedge.validate_path,
+        help="Tab-separated sample sheet with columns bam and (optionally) bai",
+    )
+    samples.add_argument(
+        config.PARAMS["bams"],
+        type=str,
+        help="Glob matching the bam (or cram) files to analyse (quote to prevent shell "
+        "expansion). The index of each bam is expected at $BAM.bai or $PREFIX.bai, and of each "
+        "cram at $CRAM.crai or $PREFIX.crai",
+    )
+    polyedge.add_analysis_arguments(parser, requirednamed)
+    args = vars(parser.parse_args())
+    polyedge.check_locus_arguments(parser, args)
+    if args["anchor_sweep"]:
+        parser.error(f"argument {config.PARAMS['anchor_sweep']}: not supported in batch mode")
+    return args
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    if args["samplesheet"]:
+        samples = load_samplesheet(args["samplesheet"])
+    else:
+        samples = [(bamfile, find_index(bamfile)) for bamfile in sorted(glob.glob(args["bams"]))]
+    output_pipeline = polyedge.create_output_pipeline(args)
+    try:
+        summary = run_batch(samples, args, args["workers"], output_pipeline)
+    finally:
+        # Finish rendering the pdfs of the samples already completed
+        output_pipeline.close()
+    write_summary(summary, args["summary"])
+    result_cache = polyedge.create_result_cache(args)
+    if result_cache:
+        result_cache.evict()
+    if any(status == config.BATCH_STATUS["fail"] for _, status, _, _ in summary):
+        sys.exit(1)
@@ -0,0 +1,613 @@
+""" Benchmarks for polyedge. The kernel benchmarks check that each optimised kernel gives the same
+results as the implementation it replaces before timing both. The analysis benchmark times whole
+analyses of synthetic bam files across a matrix of depths and locus counts, and stores the results
+as json for comparison between versions
+"""
+import os
+import argparse
+import json
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import Counter
+import pysam
+import metrics
+import polyedge
+from pipeline import OutputPipeline
+from timing import StageTimings
+
+
+def synthetic_reads(read_count, read_length, seed):
+    """
+    Create aligned reads in memory with randomised CIGARs (soft/hard clips, insertions, deletions
+    and reference skips) around a region of interest
+
+        :param read_count (int):    Number of reads to create
+        :param read_length (int):   Length of each read
+        :param seed (int):          Random seed
+        :return reads (list):       List of pysam AlignedSegment objects
+    """
+    rng = random.Random(seed)
+    header = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "2", "LN": 100000}]})
+    reads = []
+    for index in range(read_count):
+        cigar = []
+        remaining = read_length
+        if rng.random() < 0.2:
+            cigar.append((pysam.CHARD_CLIP, rng.randint(1, 10)))
+        if rng.random() < 0.2:
+            clip = rng.randint(1, 10)
+            cigar.append((pysam.CSOFT_CLIP, clip))
+            remaining -= clip
+        while remaining > 0:
+            match = min(remaining, rng.randint(10, 80))
+            cigar.append((pysam.CMATCH, match))
+            remaining -= match
+            if remaining > 5:
+                operation = rng.choice([pysam.CINS, pysam.CDEL, pysam.CDEL, pysam.CREF_SKIP])
+                length = rng.randint(1, 4)
+                cigar.append((operation, length))
+                if operation == pysam.CINS:
+                    remaining -= length
+        read = pysam.AlignedSegment(header)
+        read.query_name = f"read{index}"
+        read.reference_id = 0
+        read.reference_start = 1000 + rng.randint(0, 50)
+        read.query_sequence = "".join(rng.choice("ACGT") for _ in range(read_length))
+        read.cigartuples = cigar
+        reads.append(read)
+    return reads
+
+
+def synthetic_polys(read_count, read_length, anchor_length, seed):
+    """
+    Create read sequences containing a noisy homopolymer, with the query positions of the roi
+    around it. Some rois are too short to contain a poly base between the anchors
+
+        :param read_count (int):    Number of reads to create
+        :param read_length (int):   Length of each read
+        :param anchor_length (int): Length of anchor sequence
+        :param seed (int):          Random seed
+        :return polys (list):       List of (query_sequence, seq_start, seq_end) tuples
+    """
+    rng = random.Random(seed)
+    polys = []
+    for _ in range(read_count):
+        polylen = rng.choice([0, 2, 10, 20, 25, 26, 27, 28, 30])
+        seq_start = rng.randint(10, read_length - polylen - 2 * anchor_length - 10)
+        seq_end = seq_start + polylen + 2 * anchor_length
+        base = rng.choice("ACGT")
+        poly = "".join(
+            base if rng.random() > 0.03 else rng.choice("ACGTN") for _ in range(polylen)
+        )
+        flank = "".join(rng.choice("ACGT") for _ in range(read_length))
+        sequence = (flank[:seq_start + anchor_length] + poly + flank[seq_end - anchor_length:])
+        polys.append((sequence[:read_length], seq_start, seq_end))
+    return polys
+
+
+def legacy_extract_poly(query_sequence, seq_start, seq_end, anchor_length):
+    """
+    Previous implementation: regex match on the roi sequence segment, and Counter over the poly
+
+        :param query_sequence (str):    Read sequence
+        :param seq_start (int):         Query position aligned to the start of the roi
+        :param seq_end (int):           Query position aligned to the end of the roi
+        :param anchor_length (int):     Length of anchor sequence
+        :return poly (tuple):           (allele, polylen, purity), or None if no match
+    """
+    seq_segment = query_sequence[seq_start: seq_end]
+    regex = (
+        r".{"
+        + re.escape(str(anchor_length))
+        + r"}(.+).{"
+        + re.escape(str(anchor_length))
+        + r"}"
+    )
+    seq_match = re.match(regex, seq_segment)
+    if seq_match:
+        remainder_poly = Counter(seq_match.group(1)[1:])
+        return (
+            seq_match.group(1)[0],
+            len(seq_match.group(1)),
+            remainder_poly.most_common()[0][1],
+        )
+    return None
+
+
+def legacy_query_positions(read, roi_start, roi_end):
+    """
+    Previous implementation: linear scans of the full list of aligned pairs
+
+        :param read (obj):          pysam AlignedSegment
+        :param roi_start (int):     0-based reference position of the start of the roi
+        :param roi_end (int):       0-based reference position of the end of the roi
+        :return positions (tuple):  Query positions aligned to roi_start and roi_end
+    """
+    seq_start = next(x for x in read.get_aligned_pairs() if x[1] == roi_start)
+    seq_end = next(x for x in read.get_aligned_pairs() if x[1] == roi_end)
+    return seq_start[0], seq_end[0]
+
+
+def time_call(function, reads, repeats):
+    """
+    Time calling function on every read, taking the fastest of repeats runs
+
+        :param function (func):     Function taking a read
+        :param reads (list):        List of pysam AlignedSegment objects
+        :param repeats (int):       Number of timed runs
+        :return seconds (float):    Fastest run time in seconds
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for read in reads:
+            function(read)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def bench_resolver(read_count, read_length, repeats, seed):
+    """
+    Compare the CIGAR-walk query position resolver with scanning read.get_aligned_pairs()
+
+        :param read_count (int):    Number of reads
+        :param read_length (int):   Length of each read
+        :param repeats (int):       Number of timed runs
+        :param seed (int):          Random seed
+    """
+    reads = synthetic_reads(read_count, read_length, seed)
+    roi_start, roi_end = 1060, 1090
+    spanning = [
+        read for read in reads
+        if read.reference_start < roi_start and roi_end < read.reference_end
+    ]
+    for read in reads:  # Check every covered position, including deleted and skipped bases
+        pairs = {ref_pos: query_pos for query_pos, ref_pos in read.get_aligned_pairs()
+                 if ref_pos is not None}
+        ref_positions = tuple(range(read.reference_start - 5, read.reference_end + 5))
+        resolved = metrics.resolve_query_positions(
+            read.cigartuples, read.reference_start, ref_positions
+        )
+        expected = [pairs.get(ref_pos) for ref_pos in ref_positions]
+        if resolved != expected:
+            raise AssertionError(f"Resolver mismatch for {read.query_name} ({read.cigarstring})")
+
+    legacy = time_call(lambda read: legacy_query_positions(read, roi_start, roi_end),
+                       spanning, repeats)
+    resolver = time_call(
+        lambda read: metrics.resolve_query_positions(
+            read.cigartuples, read.reference_start, (roi_start, roi_end)
+        ), spanning, repeats
+    )
+    print(f"Query position resolver ({len(spanning)} spanning reads of {read_length}bp)")
+    print(f"  get_aligned_pairs scan: {legacy:.4f}s ({len(spanning) / legacy:,.0f} reads/s)")
+    print(f"  CIGAR walk:             {resolver:.4f}s ({len(spanning) / resolver:,.0f} reads/s)")
+    print(f"  Speedup:                {legacy / resolver:.1f}x")
+
+
+def bench_kernel(read_count, read_length, anchor_length, repeats, seed):
+    """
+    Compare the poly extraction kernel with the regex and Counter implementation it replaces
+
+        :param read_count (int):    Number of reads
+        :param read_length (int):   Length of each read
+        :param anchor_length (int): Length of anchor sequence
+        :param repeats (int):       Number of timed runs
+        :param seed (int):          Random seed
+    """
+    polys = synthetic_polys(read_count, read_length, anchor_length, seed)
+    for poly in polys:
+        # The previous implementation raised an IndexError for a poly of length 1
+        if poly[2] - poly[1] - 2 * anchor_length != 1:
+            expected = legacy_extract_poly(*poly, anchor_length)
+            if metrics.extract_poly(*poly, anchor_length) != expected:
+                raise AssertionError(f"Kernel mismatch for {poly}")
+
+    legacy = time_call(lambda poly: legacy_extract_poly(*poly, anchor_length), polys, repeats)
+    kernel = time_call(lambda poly: metrics.extract_poly(*poly, anchor_length), polys, repeats)
+    print(f"Poly extraction kernel ({len(polys)} reads of {read_length}bp)")
+    print(f"  Regex and Counter:      {legacy:.4f}s ({len(polys) / legacy:,.0f} reads/s)")
+    print(f"  Index arithmetic:       {kernel:.4f}s ({len(polys) / kernel:,.0f} reads/s)")
+    print(f"  Speedup:                {legacy / kernel:.1f}x")
+
+
+def synthetic_features(read_count, seed):
+    """
+    Create per-read features as passed to the metrics engines, with a mixture of alleles, poly
+    lengths, strands and read positions
+
+        :param read_count (int):    Number of reads
+        :param seed (int):          Random seed
+        :return features (list):    List of (allele, polylen, first_base_qual, purity, reverse,
+                                    read_pos) tuples
+    """
+    rng = random.Random(seed)
+    features = []
+    for _ in range(read_count):
+        allele = rng.choice("AAAAAACCGTN")
+        polylen = rng.choice([1, 24, 25, 26, 26, 27, 27, 27, 28])
+        features.append((allele, polylen, rng.randint(2, 41), rng.randint(0, polylen - 1),
+                         rng.random() < 0.4, rng.randint(2, 75)))
+    return features
+
+
+def check_engine_features(read_count, seed):
+    """
+    Check that the metrics engines give identical metrics from the same per-read features, for
+    loci of random sizes up to read_count reads
+
+        :param read_count (int):    Maximum number of reads per locus
+        :param seed (int):          Random seed
+        :return check_count (int):  Number of loci checked
+    """
+    checks = []
+    for check_seed in range(seed, seed + 20):  # Includes small loci, where ties are likely
+        check_count = random.Random(check_seed).randint(2, max(read_count, 2))
+        checks.append((check_seed, synthetic_features(check_count, check_seed)))
+    # An allele whose reads have no poly bases after the first base has no defined purity
+    checks.append((None, [feature for feature in synthetic_features(200, seed)
+                          if feature[0] != "G"] + [("G", 1, 30, 0, False, 20)] * 3))
+    for check_seed, features in checks:
+        allele_lists = []
+        for engine in metrics.ENGINES.values():
+            allele_metrics = engine()
+            for feature in features:
+                allele_metrics.add(*feature)
+            allele_lists.append(allele_metrics.allele_list("GENE", 2, 1))
+        if any(allele_list != allele_lists[0] for allele_list in allele_lists):
+            raise AssertionError(f"Engine mismatch for seed {check_seed}")
+    return len(checks)
+
+
+def check_engine_bam(seed, loci_count=10, depth=500):
+    """
+    Check that the metrics engines give identical metrics and read filter counts when analysing
+    the loci of a synthetic bam file
+
+        :param seed (int):          Random seed
+        :param loci_count (int):    Number of loci
+        :param depth (int):         Number of reads spanning each locus
+        :return check_count (int):  Number of loci checked
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bamfile = os.path.join(tmp_dir, "synthetic.bam")
+        loci = write_synthetic_bam(bamfile, loci_count, depth, seed=seed)
+        for gene, chrom, poly in loci:
+            results = []
+            for engine in metrics.ENGINES:
+                analysis = polyedge.PolyEdge(bamfile, f"{bamfile}.bai", gene, chrom, poly, 2,
+                                             engine=engine)
+                results.append((*analysis.calculate_metrics(), analysis.read_filter_counts))
+            if any(result != results[0] for result in results):
+                raise AssertionError(f"Engine mismatch at {chrom}:{poly[0]}-{poly[1]}")
+    return len(loci)
+
+
+def check_engines(read_count, seed):
+    """
+    Check that the numpy metrics engine gives identical metrics to the pure-Python engine, from
+    synthetic per-read features and from a synthetic bam file, without timing them. Raises
+    AssertionError on the first mismatch
+
+        :param read_count (int):    Maximum number of reads per locus of synthetic features
+        :param seed (int):          Random seed
+    """
+    feature_count = check_engine_features(read_count, seed)
+    bam_count = check_engine_bam(seed)
+    print(f"Metrics engines identical ({feature_count} synthetic feature sets, {bam_count} loci "
+          "of a synthetic bam file)")
+
+
+def bench_engines(read_count, repeats, seed):
+    """
+    Check that the numpy metrics engine gives identical metrics to the pure-Python engine, then
+    time accumulating and summarising a locus with each
+
+        :param read_count (int):    Number of reads
+        :param repeats (int):       Number of timed runs
+        :param seed (int):          Random seed
+    """
+    check_engines(read_count, seed)
+    features = synthetic_features(read_count, seed)
+    print(f"Metrics engines ({read_count} reads)")
+    for name, engine in metrics.ENGINES.items():
+        def run_engine(_, engine=engine):
+            allele_metrics = engine()
+            for feature in features:
+                allele_metrics.add(*feature)
+            allele_metrics.allele_list("GENE", 2, 1)
+        seconds = time_call(run_engine, [None], repeats)
+        print(f"  {name + ':':<23} {seconds:.4f}s ({read_count / seconds:,.0f} reads/s)")
+
+
+def write_synthetic_bam(path, loci_count, depth, read_length=150, poly_lengths=(20, 25, 27),
+                        alleles="AAAT", indel_rate=0.2, purity_noise=0.02, chr_prefix=False,
+                        seed=1):
+    """
+    Write a coordinate sorted and indexed bam file of reads spanning homopolymer loci on a random
+    reference sequence. Each read carries one of the first-base alleles, and reads may have a
+    longer or shorter poly (aligned as an insertion or deletion) and substitutions within the poly
+
+        :param path (str):          Path of bam file to write
+        :param loci_count (int):    Number of loci
+        :param depth (int):         Number of reads spanning each locus
+        :param read_length (int):   Length of each read
+        :param poly_lengths (list): Reference poly lengths, chosen at random for each locus
+        :param alleles (str):       First-base alleles, chosen at random for each read (repeat a
+                                    base to weight it)
+        :param indel_rate (float):  Fraction of reads with a poly length differing from the
+                                    reference
+        :param purity_noise (float):    Probability of a substitution at each poly base
+        :param chr_prefix (bool):   Name the contig 'chr2' rather than '2'
+        :param seed (int):          Random seed
+        :return loci (list):        List of (gene, chrom, (poly_start, poly_end)) tuples
+    """
+    rng = random.Random(seed)
+    flank = read_length
+    if read_length < max(poly_lengths) + 2 * 10 + 3:
+        raise ValueError("read_length must be at least 23bp longer than the longest poly")
+    contig_length = (loci_count + 1) * (max(poly_lengths) + 2 * flank)
+    reference = [rng.choice("ACGT") for _ in range(contig_length)]
+    loci = []
+    for index in range(loci_count):
+        poly_start = flank + index * (max(poly_lengths) + 2 * flank)
+        poly_end = poly_start + rng.choice(poly_lengths)
+        poly_base = rng.choice("ACGT")
+        reference[poly_start:poly_end] = poly_base * (poly_end - poly_start)
+        # Flanking bases differ from the poly base, so the reference poly has a defined length
+        reference[poly_start - 1] = rng.choice([base for base in "ACGT" if base != poly_base])
+        reference[poly_end] = rng.choice([base for base in "ACGT" if base != poly_base])
+        loci.append((f"LOCUS{index + 1}", "2", (poly_start, poly_end)))
+    reference = "".join(reference)
+    contig = "chr2" if chr_prefix else "2"
+    header = pysam.AlignmentHeader.from_dict({
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": "1", "LN": contig_length}, {"SN": contig, "LN": contig_length}],
+    })
+    reads = []
+    for gene, _, (poly_start, poly_end) in loci:
+        ref_polylen = poly_end - poly_start
+        poly_base = reference[poly_start]
+        for _ in range(depth):
+            polylen = ref_polylen
+            if rng.random() < indel_rate:
+                polylen += rng.choice([-2, -1, 1, 2])
+            poly = rng.choice(alleles) + "".join(
+                poly_base if rng.random() >= purity_noise else rng.choice("ACGT")
+                for _ in range(polylen - 1)
+            )
+            left_length = rng.randint(10, read_length - polylen - 10)
+            read_start = poly_start - left_length
+            sequence = (reference[read_start:poly_start] + poly + reference[poly_end:])
+            sequence = sequence[:read_length]
+            right_length = read_length - left_length - polylen
+            # The poly is aligned in full, with any length difference placed at its end
+            if polylen < ref_polylen:
+                cigar = [(pysam.CMATCH, left_length + polylen),
+                         (pysam.CDEL, ref_polylen - polylen), (pysam.CMATCH, right_length)]
+            elif polylen > ref_polylen:
+                cigar = [(pysam.CMATCH, left_length + ref_polylen),
+                         (pysam.CINS, polylen - ref_polylen), (pysam.CMATCH, right_length)]
+            else:
+                cigar = [(pysam.CMATCH, read_length)]
+            read = pysam.AlignedSegment(header)
+            read.query_name = f"{gene}_read{len(reads)}"
+            read.flag = rng.choice([0, 16])
+            read.reference_id = 1
+            read.reference_start = read_start
+            read.mapping_quality = 60
+            read.query_sequence = sequence
+            read.cigartuples = cigar
+            read.query_qualities = pysam.qualitystring_to_array(
+                "".join(chr(33 + rng.randint(10, 40)) for _ in range(read_length))
+            )
+            reads.append(read)
+    reads.sort(key=lambda read: read.reference_start)
+    with pysam.AlignmentFile(path, "wb", header=header) as bam:
+        for read in reads:
+            bam.write(read)
+    pysam.index(path)
+    return loci
+
+
+def time_analysis(bamfile, loci, anchor_length, output_dir, pdf, repeats, output_queue=0):
+    """
+    Time calculating the metrics for each locus with PolyEdge.calculate_metrics, and generating
+    all output files for the loci with PolyEdge (one locus) or PolyEdgePanel (several loci),
+    taking the fastest of repeats runs. The result cache is not used
+
+        :param bamfile (str):       Bam file to analyse
+        :param loci (list):         List of (gene, chrom, (poly_start, poly_end)) tuples
+        :param anchor_length (int): Length of anchor sequence
+        :param output_dir (str):    Directory to write output files to
+        :param pdf (bool):          Write pdf reports (requires wkhtmltopdf)
+        :param repeats (int):       Number of timed runs
+        :param output_queue (int):  Write the output files with an OutputPipeline allowing this
+                                    many queued jobs, waiting for them to finish within the timed
+                                    run. If 0, output files are written as each locus finishes
+        :return result (dict):      Timings, read counts and stage timings of the fastest
+                                    generate_output run
+    """
+    bam_index = f"{bamfile}.bai"
+    metrics_seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for gene, chrom, poly in loci:
+            polyedge.PolyEdge(bamfile, bam_index, gene, chrom, poly, anchor_length,
+                              output_dir=output_dir).calculate_metrics()
+        metrics_seconds.append(time.perf_counter() - start)
+    output_runs = []
+    for _ in range(repeats):
+        timings = StageTimings()
+        output_pipeline = OutputPipeline(max_pending=output_queue, log=False)
+        options = {
+            "output_dir": output_dir,
+            "pdf_renderer": polyedge.PdfRenderer(enabled=pdf),
+            "timings": timings,
+            "output_pipeline": output_pipeline,
+        }
+        if len(loci) == 1:
+            gene, chrom, poly = loci[0]
+            analysis = polyedge.PolyEdge(bamfile, bam_index, gene, chrom, poly, anchor_length,
+                                         **options)
+        else:
+            analysis = polyedge.PolyEdgePanel(bamfile, bam_index, loci, anchor_length, **options)
+        start = time.perf_counter()
+        analysis.generate_output()
+        failures = output_pipeline.close()
+        if failures:
+            raise RuntimeError("; ".join(f"{label}: {error}" for label, error in failures))
+        output_runs.append((time.perf_counter() - start, timings.report()))
+    output_seconds, report = min(output_runs, key=lambda run: run[0])
+    reads = report["reads"]["fetched"]
+    return {
+        "calculate_metrics_seconds": round(min(metrics_seconds), 6),
+        "calculate_metrics_reads_per_second": round(reads / min(metrics_seconds)),
+        "generate_output_seconds": round(output_seconds, 6),
+        "reads": report["reads"],
+        "stages": report["stages"],
+    }
+
+
+def bench_analysis(depths, loci_counts, options, repeats, seed, output, baseline=None):
+    """
+    Time whole analyses of synthetic bam files for each combination of depth and locus count,
+    write the results to a json file, and compare them with a previous results file
+
+        :param depths (list):       Reads per locus
+        :param loci_counts (list):  Numbers of loci
+        :param options (dict):      Synthetic bam options (read_length, poly_lengths, alleles,
+                                    indel_rate, purity_noise, chr_prefix) and analysis options
+                                    (anchor_length, pdf, output_queue)
+        :param repeats (int):       Number of timed runs
+        :param seed (int):          Random seed
+        :param output (str):        Path of json results file to write
+        :param baseline (str):      Optional path of a json results file to compare with
+    """
+    bam_options = {key: options[key] for key in
+                   ["read_length", "poly_lengths", "alleles", "indel_rate", "purity_noise",
+                    "chr_prefix"]}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for depth in depths:
+            for loci_count in loci_counts:
+                bamfile = os.path.join(tmp_dir, f"synthetic_{depth}x_{loci_count}.bam")
+                loci = write_synthetic_bam(bamfile, loci_count, depth, seed=seed, **bam_options)
+                output_dir = os.path.join(tmp_dir, f"output_{depth}x_{loci_count}")
+                os.makedirs(output_dir)
+                result = time_analysis(bamfile, loci, options["anchor_length"], output_dir,
+                                       options["pdf"], repeats, options["output_queue"])
+                results.append({"depth": depth, "loci": loci_count, **result})
+                print(f"Depth {depth:>6}, {loci_count:>3} loci: "
+                      f"calculate_metrics {result['calculate_metrics_seconds']:.4f}s "
+                      f"({result['calculate_metrics_reads_per_second']:,} reads/s), "
+                      f"generate_output {result['generate_output_seconds']:.4f}s")
+    report = {
+        "version": polyedge.git_tag(),
+        "python": sys.version.split()[0],
+        "pysam": pysam.__version__,
+        "platform": platform.platform(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seed": seed,
+        "repeats": repeats,
+        "options": options,
+        "results": results,
+    }
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {output}")
+    if baseline:
+        compare_results(baseline, report)
+
+
+def compare_results(baseline, report):
+    """
+    Print the change in time of each depth and locus count relative to a previous results file.
+    Only matrix cells present in both are compared
+
+        :param baseline (str):      Path of json results file to compare with
+        :param report (dict):       Current results
+    """
+    with open(baseline, "r", encoding="utf-8") as file:
+        previous = json.load(file)
+    if previous["options"] != report["options"]:
+        print("Warning: baseline was run with different options")
+    previous_results = {(result["depth"], result["loci"]): result
+                        for result in previous["results"]}
+    print(f"Compared with {baseline} (version {previous['version'] or 'unknown'})")
+    for result in report["results"]:
+        old = previous_results.get((result["depth"], result["loci"]))
+        if old:
+            print(f"Depth {result['depth']:>6}, {result['loci']:>3} loci: calculate_metrics "
+                  f"{old['calculate_metrics_seconds'] / result['calculate_metrics_seconds']:.2f}x, "
+                  f"generate_output "
+                  f"{old['generate_output_seconds'] / result['generate_output_seconds']:.2f}x")
+
+
+def arg_parse():
+    """
+    Parse arguments supplied by the command line. Create argument parser, define command line
+    arguments, then parse supplied command line arguments using the created argument parser
+
+        :return (Namespace object): parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(description="Benchmark polyedge")
+    parser.add_argument("benchmark", choices=["resolver", "kernel", "engines", "analysis", "check"],
+                        help="Benchmark to run, or 'check' to only check that the metrics engines "
+                        "are identical")
+    parser.add_argument("--reads", type=int, default=20000, help="Number of reads")
+    parser.add_argument("--read_length", type=int, default=150, help="Read length")
+    parser.add_argument("--anchor_length", type=int, default=2, help="Length of anchor sequence")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of timed runs")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    analysis = parser.add_argument_group("analysis benchmark options")
+    analysis.add_argument("--depths", type=int, nargs="+", default=[100, 1000, 10000],
+                          help="Reads per locus")
+    analysis.add_argument("--loci_counts", type=int, nargs="+", default=[1, 10],
+                          help="Numbers of loci")
+    analysis.add_argument("--poly_lengths", type=int, nargs="+", default=[20, 25, 27],
+                          help="Reference poly lengths, chosen at random for each locus")
+    analysis.add_argument("--alleles", type=str, default="AAAT",
+                          help="First-base alleles, chosen at random for each read")
+    analysis.add_argument("--indel_rate", type=float, default=0.2,
+                          help="Fraction of reads with a poly length differing from the reference")
+    analysis.add_argument("--purity_noise", type=float, default=0.02,
+                          help="Probability of a substitution at each poly base")
+    analysis.add_argument("--chr_prefix", action="store_true",
+                          help="Name contigs with a 'chr' prefix")
+    analysis.add_argument("--pdf", action="store_true",
+                          help="Write pdf reports in generate_output (requires wkhtmltopdf)")
+    analysis.add_argument("--output_queue", type=int, default=0,
+                          help="Write the output files on a pipeline allowing this many queued "
+                          "jobs, as with polyedge.py --output_queue (default: 0, written as each "
+                          "locus finishes)")
+    analysis.add_argument("--output", type=str, default="benchmark_results.json",
+                          help="Json results file to write")
+    analysis.add_argument("--baseline", type=str, default=None,
+                          help="Json results file from a previous version to compare with")
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    if args["benchmark"] == "resolver":
+        bench_resolver(args["reads"], args["read_length"], args["repeats"], args["seed"])
+    elif args["benchmark"] == "engines":
+        bench_engines(args["reads"], args["repeats"], args["seed"])
+    elif args["benchmark"] == "check":
+        check_engines(min(args["reads"], 2000), args["seed"])
+    elif args["benchmark"] == "kernel":
+        bench_kernel(args["reads"], args["read_length"], args["anchor_length"], args["repeats"],
+                     args["seed"])
+    elif args["benchmark"] == "analysis":
+        bench_analysis(
+            args["depths"], args["loci_counts"],
+            {key: args[key] for key in ["read_length", "poly_lengths", "alleles", "indel_rate",
+                                        "purity_noise", "chr_prefix", "anchor_length", "pdf",
+                                        "output_queue"]},
+            args["repeats"], args["seed"], args["output"], args["baseline"],
+        )
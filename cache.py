@@ -0,0 +1,176 @@
+""" On-disk cache of polyedge results, keyed on the identity of the bam file and the analysis
+parameters, so that reports can be regenerated without re-reading the bam file
+"""
+import os
+import json
+import hashlib
+import tempfile
+import config
+
+
+class ResultCache:
+    """
+    Content-addressed cache of the metrics calculated for a locus. Each result is stored as a
+    json file named by a sha256 hash of the bam identity and the analysis parameters. The bam is
+    identified by its path, size, modification time and a checksum of its index, or optionally by
+    a hash of its contents
+
+        key(bamfile, bam_index, params)
+            Create the cache key for a locus
+            :return key (str):          Hex digest identifying the result
+
+        bam_identity(bamfile, bam_index)
+            Identify a bam file, hashing each file at most once
+            :return identity (list):    Values identifying the bam file
+
+        get(key)
+            Load a cached result
+            :return result (dict):      Cached result, or None if not cached
+
+        put(key, result)
+            Store a result in the cache
+
+        evict()
+            Remove the least recently used results until the cache is within its maximum size
+            :return removed (int):      Number of results removed
+    """
+
+    def __init__(self, cache_dir=config.RESULT_CACHE_DIR, max_size=config.DEFAULT_CACHE_SIZE,
+                 content_hash=False):
+        """
+        Constructor for ResultCache class
+
+            :param cache_dir (str):         Directory to store results in
+            :param max_size (int):          Maximum size of the cache in MB
+            :param content_hash (bool):     Identify bam files by a hash of their contents
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.content_hash = content_hash
+        self.identities = {}
+
+    def key(self, bamfile, bam_index, params):
+        """
+        Create the cache key for a locus
+
+            :param bamfile (str):       Bam file analysed
+            :param bam_index (str):     Bam index file
+            :param params (dict):       Analysis parameters and tool version
+            :return key (str):          Hex digest identifying the result
+        """
+        content = json.dumps(
+            {
+                "schema": config.CACHE_SCHEMA,
+                "bam": self.bam_identity(bamfile, bam_index),
+                "params": params,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def bam_identity(self, bamfile, bam_index):
+        """
+        Identify a bam file, hashing each file at most once
+
+            :param bamfile (str):       Bam file analysed
+            :param bam_index (str):     Bam index file
+            :return identity (list):    Values identifying the bam file
+        """
+        bam_stat = os.stat(bamfile)
+        index_stat = os.stat(bam_index)
+        stats = (bam_stat.st_size, bam_stat.st_mtime_ns, index_stat.st_size,
+                 index_stat.st_mtime_ns)
+        memo_key = (os.path.realpath(bamfile), os.path.realpath(bam_index), stats)
+        if memo_key not in self.identities:
+            if self.content_hash:
+                self.identities[memo_key] = ["sha256", file_digest(bamfile, hashlib.sha256)]
+            else:
+                self.identities[memo_key] = [
+                    os.path.realpath(bamfile),
+                    bam_stat.st_size,
+                    bam_stat.st_mtime_ns,
+                    file_digest(bam_index, hashlib.md5),
+                ]
+        return self.identities[memo_key]
+
+    def get(self, key):
+        """
+        Load a cached result. Unreadable results are treated as not cached
+
+            :param key (str):           Hex digest identifying the result
+            :return result (dict):      Cached result, or None if not cached
+        """
+        path = self.path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                result = json.load(file)
+            os.utime(path)  # Mark as recently used
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def put(self, key, result):
+        """
+        Store a result in the cache. The result is written to a temporary file and renamed, so
+        that concurrent runs never read a partially written result
+
+            :param key (str):           Hex digest identifying the result
+            :param result (dict):       Result to store
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(file_handle, "w", encoding="utf-8") as file:
+            json.dump(result, file)
+        os.replace(tmp_path, path)
+
+    def path(self, key):
+        """
+        Path of the file storing a result
+
+            :param key (str):           Hex digest identifying the result
+            :return path (str):         Path of json file
+        """
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def evict(self):
+        """
+        Remove the least recently used results until the cache is within its maximum size
+
+            :return removed (int):      Number of results removed
+        """
+        entries = []
+        if os.path.isdir(self.cache_dir):
+            for subdir in os.scandir(self.cache_dir):
+                if subdir.is_dir():
+                    for entry in os.scandir(subdir.path):
+                        if entry.name.endswith(".json"):
+                            stat = entry.stat()
+                            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size * 1024 * 1024:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:  # Removed by a concurrent run
+                pass
+            total_size -= size
+        return removed
+
+
+def file_digest(path, algorithm):
+    """
+    Hash the contents of a file in chunks
+
+        :param path (str):          Path of file to hash
+        :param algorithm (func):    hashlib constructor
+        :return digest (str):       Hex digest
+    """
+    digest = algorithm()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -19,10 +19,120 @@ PARAMS = {
     "poly_start": "--poly_start",
     "poly_end": "--poly_end",
     "anchor_length": "--anchor_length",
+    "anchor_sweep": "--anchor_sweep",
+    "loci": "--loci",
+    "combined": "--combined",
+    "combined_pdf": "--combined_pdf",
+    "no_pdf": "--no_pdf",
+    "pdf_workers": "--pdf_workers",
+    "output_queue": "--output_queue",
+    "engine": "--engine",
+    "read_filters": "--read_filters",
+    "min_mapq": "--min_mapq",
+    "early_stop": "--early_stop",
+    "max_reads": "--max_reads",
+    "dedup_mates": "--dedup_mates",
+    "threads": "--threads",
+    "reference": "--reference",
+    "ref_cache": "--ref_cache",
+    "no_cache": "--no_cache",
+    "cache_dir": "--cache_dir",
+    "cache_size": "--cache_size",
+    "cache_hash": "--cache_hash",
+    "timing": "--timing",
+    "profile": "--profile",
+    "evidence": "--evidence",
+    "strand": "--strand",
+    "samplesheet": "--samplesheet",
+    "bams": "--bams",
+    "workers": "--workers",
+    "summary": "--summary",
+    "host": "--host",
+    "port": "--port",
+    "max_open_files": "--max_open_files",
+    "site_index": "--site_index",
+    "region": "--region",
+    "targets": "--targets",
+    "min_length": "--min_length",
+    "output": "--output",
+    "results_store": "--results_store",
+    "pos": "--pos",
+    "sample": "--sample",
+    "since": "--since",
+    "until": "--until",
+    "limit": "--limit",
+    "background": "--background",
+    "allele": "--allele",
 }
 
+DEFAULT_ENGINE = "python"  # Metrics engine (python or numpy)
+CLUSTER_DISTANCE = 150  # Loci closer than this (bp) share a single bam fetch in panel mode
+
+# Reads with these SAM flags can be rejected before their sequence is decoded
+READ_FILTER_FLAGS = {
+    "unmapped": 0x4,
+    "secondary": 0x100,
+    "qc_fail": 0x200,
+    "duplicate": 0x400,
+    "supplementary": 0x800,
+}
+# Duplicates are not rejected by default, as reads from amplicon assays share start positions
+DEFAULT_READ_FILTERS = ["unmapped", "secondary", "qc_fail", "supplementary"]
+DEFAULT_MIN_MAPQ = 0
+
+DEFAULT_THREADS = 1  # htslib decompression threads per bam/cram file
+# Local cache of cram reference sequences, used instead of downloading them
+REF_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "polyedge", "ref_cache")
+# On-disk cache of calculated metrics, keyed on bam identity, analysis parameters and a hash of the
+# source files that calculate the metrics
+RESULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "polyedge", "results")
+DEFAULT_CACHE_SIZE = 512  # MB
+CACHE_SCHEMA = 3  # Increment when the cached result format changes
+CACHE_SOURCE_FILES = ["config.py", "metrics.py", "polyedge.py"]
+
+# Sampling of reads at high depth loci. With early stopping, reads are processed in a random order
+# (with a fixed seed) and processing stops once the confidence intervals of the read fractions and
+# purities are clear of the thresholds, checked every EARLY_STOP_INTERVAL reads
+SAMPLING_SEED = 0
+EARLY_STOP_MIN_READS = 1000
+EARLY_STOP_INTERVAL = 500
+CONFIDENCE_Z = 1.96  # 95% confidence intervals
+SAMPLING_STR = (
+    "Reads were sampled at random from the reads passing the read filters. 95% confidence "
+    "intervals of the metrics are as follows:"
+)
+SAMPLING_COUNT_HEADERS = ["Reads sampled", "Reads available"]
+SAMPLING_HEADERS = [
+    "First base of poly repeat allele",
+    "Fraction of reads lower bound",
+    "Fraction of reads upper bound",
+    "Purity lower bound",
+    "Purity upper bound",
+]
+
+# Outcomes counted for each read fetched, in the order they are checked
+READ_FILTER_REASONS = {
+    "unmapped": "Rejected: unmapped",
+    "secondary": "Rejected: secondary alignment",
+    "qc_fail": "Rejected: failed QC",
+    "duplicate": "Rejected: duplicate",
+    "supplementary": "Rejected: supplementary alignment",
+    "low_mapq": "Rejected: mapping quality below minimum",
+    "not_spanning": "Rejected: does not span poly and anchors",
+    "not_sampled": "Not processed: not sampled",
+    "not_anchored": "Rejected: anchor not aligned",
+    "mate_overlap": "Rejected: overlapping mate already counted",
+    "no_poly": "Rejected: no poly between anchors",
+    "counted": "Reads counted",
+}
+READ_FILTER_STR = "Reads fetched from the bam file were filtered as follows:"
+
 PARAMS_STR = "The app was run with the following parameters:"
 
+# Reads with the first base of the poly closer than this to either end of the read are counted as
+# near the read end, where sequencing artefacts are more likely
+READ_END_DISTANCE = 10
+
 TABLE_HEADERS = [
     "First base of poly repeat allele",
     "Read count",
@@ -32,35 +142,85 @@ TABLE_HEADERS = [
     "Standard deviation of poly length",
     "Mode of poly length",
     "Average purity of polyN repeat",
+    "Forward read count",
+    "Reverse read count",
+    "Strand bias (Fisher's exact p-value)",
+    "Median distance from read end",
+    f"Fraction within {READ_END_DISTANCE} bases of read end",
 ]
 
 # CSV-specific settings ---------------------------------------------------------------------------
 
 GENERAL_HEADERS = ["Gene", "Chromosome", "Position"]  # These are only used in CSV file construction
+PANEL_HEADERS = ["Total read count"]  # Per-locus total, only used in combined panel CSV files
+SWEEP_HEADERS = ["Anchor length"]  # Only used in anchor length sweep files
+
+
+# Batch-specific settings -------------------------------------------------------------------------
+
+BATCH_SUMMARY = "polyedge_run_summary.csv"
+BATCH_HEADERS = ["Sample", "Status", "Error"]
+BATCH_STATUS = {
+    "pass": "COMPLETED",
+    "fail": "FAILED",
+}
+
+
+# Server-specific settings ------------------------------------------------------------------------
+
+SERVER_HOST = "127.0.0.1"  # Only accept jobs from the local machine by default
+SERVER_PORT = 8765
+# Bam/cram files kept open between jobs, with the least recently used closed first
+SERVER_MAX_OPEN_FILES = 16
+
+
+# Results store-specific settings -----------------------------------------------------------------
+
+RESULTS_STORE_TIMEOUT = 60  # Seconds to wait for another run to finish writing to the store
+
+
+# Site index-specific settings --------------------------------------------------------------------
+
+SITE_INDEX_MAGIC = b"PESITES1"  # Identifies site index files, change with the file format
+SITE_INDEX_MIN_LENGTH = 10  # Shortest homopolymer run indexed
+SITE_INDEX_SEGMENT = 10000000  # Bases of reference sequence scanned per parallel job
+SITE_INDEX_CHUNK = 1000000  # Bases of reference sequence read into memory at once
+SITE_INDEX_LOOKBACK = 100  # Bases read at a time before a target region to find a run crossing it
 
 
 # HTML/PDF-specific settings ----------------------------------------------------------------------
 
+DEFAULT_PDF_WORKERS = 4  # Output jobs (and so wkhtmltopdf processes) run at once in a run
+DEFAULT_OUTPUT_QUEUE = 8  # Output jobs queued or running before the calculation of metrics waits
 HTML_TEMPLATE = os.path.join(TEMPLATE_DIR, "template_report.html")
-HTML_TBL_HEADER = (
-    "<tr><th>{}</th><th>{}</th><th>{}</th><th>{}</th>"
-    "<th>{}</th><th>{}</th><th>{}</th><th>{}</th></tr>"
-)
+REPORT_TEMPLATE = "template_report.html"  # Template names within TEMPLATE_DIR
+PANEL_TEMPLATE = "template_panel_report.html"
+SWEEP_TEMPLATE = "template_sweep_report.html"
+BASE_TEMPLATE = "template_base.html"  # Extended by each of the report templates
+HTML_TBL_HEADER = f"<tr>{'<th>{}</th>' * len(TABLE_HEADERS)}</tr>"
 
-HTML_TBL_ROW = "<tr>{}{}{}{}{}{}{}{}</tr>"
+HTML_TBL_ROW = f"<tr>{'{}' * len(TABLE_HEADERS)}</tr>"
 HTML_TBL_CELL = "<td>{}</td>"
 HTML_TBL_CELL_PASS = '<td style="background-color: #90EE90">{}</td>'
 HTML_TBL_CELL_FAIL = '<td style="background-color: #e77e7e">{}</td>'
 HTML_LIST = (
     "<ul><li>{} {}</li><li>{} {}</li><li>{} {}</li><li>{} {}</li>"
-    "<li>{} {}</li><li>{} {}</li><li>{} {}</li></ul>"
+    "<li>{} {}</li><li>{} {}</li><li>{} {}</li><li>{} {}</li><li>{} {}</li></ul>"
+)
+PANEL_HTML_LIST = (
+    "<ul><li>{} {}</li><li>{} {}</li><li>{} {}</li><li>{} {}</li>"
+    "<li>{} {}</li><li>{} {}</li></ul>"
 )
+HTML_FILTER_ROW = "<tr><th>{}</th><td>{}</td></tr>"
+HTML_ROW = "<tr>{}</tr>"
+HTML_HEADER_CELL = "<th>{}</th>"
 
 THRESHOLDS = {
     "read_count": 100,
     "mean_quality": 20,
     "read_fraction": 0.2,
     "poly_purity": 0.95,
+    "strand_bias_p": 0.01,
 }
 
 INTERP_THRESHS = {
@@ -71,4 +231,6 @@ INTERP_THRESHS = {
     "mean_bq_thresh": "Mean BQ ≥20",
     "fraction_reads_thresh": "Het if both fractions of reads ≥0.2",
     "polyn_pur_thresh": "Purity of polyN should be ≥0.95 (max 5% variation within polyN repeat)",
+    "strand_bias_thresh": "Strand bias p-value ≥0.01 (forward and reverse read counts of the "
+    "allele in proportion to those of the other alleles)",
 }
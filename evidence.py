@@ -0,0 +1,175 @@
+""" Per-read evidence behind the metrics for a locus, exported as a NumPy structured array (.npy)
+that can be memory-mapped and re-aggregated without reading the bam file again
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import config
+import metrics
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only required to export and load evidence
+    np = None
+
+# One fixed-width record per counted read, in the order the reads were processed
+EVIDENCE_DTYPE = [
+    ("name_hash", "<u8"),  # First 8 bytes of the blake2b hash of the read name
+    ("allele", "S1"),
+    ("polylen", "<u2"),
+    ("first_base_qual", "u1"),
+    ("purity", "<u2"),
+    ("reverse", "?"),
+    ("mapq", "u1"),
+    ("read_pos", "<u2"),  # Distance of the first base of the poly from the nearest read end
+]
+
+
+class EvidenceRecorder:
+    """
+    Records the features of each read counted for a locus, and writes them to a .npy file with
+    a json file describing the locus
+
+        add(read, allele, polylen, first_base_qual, purity, read_pos)
+            Record a counted read
+
+        write(path, metadata)
+            Write the recorded reads to a .npy file, and the metadata to a json file alongside it
+    """
+
+    def __init__(self):
+        """
+        Constructor for EvidenceRecorder class
+        """
+        if np is None:
+            raise ImportError("Exporting per-read evidence requires numpy to be installed")
+        self.records = []
+
+    def add(self, read, allele, polylen, first_base_qual, purity, read_pos):
+        """
+        Record a counted read
+
+            :param read (obj):              pysam AlignedSegment
+            :param allele (str):            First base of the poly
+            :param polylen (int):           Length of poly (excluding anchor bases)
+            :param first_base_qual (int):   Quality of the first base of the poly
+            :param purity (int):            Count of the most common base in the poly, excluding
+                                            the first base
+            :param read_pos (int):          Distance of the first base of the poly from the
+                                            nearest end of the read
+        """
+        name_hash = int.from_bytes(
+            hashlib.blake2b(read.query_name.encode("utf-8"), digest_size=8).digest(), "little"
+        )
+        self.records.append((name_hash, allele, polylen, first_base_qual, purity,
+                             read.is_reverse, read.mapping_quality, read_pos))
+
+    def write(self, path, metadata):
+        """
+        Write the recorded reads to a .npy file, and the metadata to a json file alongside it
+
+            :param path (str):          Path of .npy file to write
+            :param metadata (dict):     Locus (gene, chrom, pos), parameters and read filter counts
+        """
+        np.save(path, np.array(self.records, dtype=EVIDENCE_DTYPE))
+        with open(metadata_path(path), "w", encoding="utf-8") as file:
+            json.dump(metadata, file, indent=2)
+
+
+def metadata_path(path):
+    """
+    Path of the json file describing an evidence file
+
+        :param path (str):          Path of .npy file
+        :return path (str):         Path of json file
+    """
+    return f"{os.path.splitext(path)[0]}.json"
+
+
+def load_evidence(path):
+    """
+    Memory-map an evidence file and load its metadata
+
+        :param path (str):          Path of .npy file
+        :return evidence (array):   Read-only memory-mapped structured array, one record per read
+        :return metadata (dict):    Locus (gene, chrom, pos), parameters and read filter counts
+    """
+    if np is None:
+        raise ImportError("Loading per-read evidence requires numpy to be installed")
+    with open(metadata_path(path), "r", encoding="utf-8") as file:
+        metadata = json.load(file)
+    return np.load(path, mmap_mode="r"), metadata
+
+
+def evidence_allele_list(path, min_mapq=0, strand=None):
+    """
+    Recalculate the metrics per allele from an evidence file. With no read selection the
+    metrics are identical to those written by the run that exported the evidence
+
+        :param path (str):          Path of .npy file
+        :param min_mapq (int):      Only use reads with at least this mapping quality
+        :param strand (str):        Only use reads on this strand ("forward" or "reverse")
+        :return allele_list (list):         List of dictionaries, one per allele,
+                                            containing calculated metrics
+        :return total_read_count (int):     Total read count across all alleles
+    """
+    evidence, metadata = load_evidence(path)
+    selected = evidence["mapq"] >= min_mapq
+    if strand:
+        selected &= evidence["reverse"] == (strand == "reverse")
+    evidence = evidence[selected]
+    allele_metrics = metrics.NumpyAlleleMetrics(capacity=max(len(evidence), 1))
+    allele_metrics.features[:len(evidence)] = np.column_stack([
+        evidence["allele"].view(np.uint8),
+        evidence["polylen"],
+        evidence["first_base_qual"],
+        evidence["purity"],
+        evidence["reverse"],
+        evidence["read_pos"],
+    ])
+    allele_metrics.read_count = len(evidence)
+    allele_list = allele_metrics.allele_list(metadata["gene"], metadata["chrom"], metadata["pos"])
+    return allele_list, allele_metrics.total_read_count()
+
+
+def arg_parse():
+    """
+    Parse arguments supplied by the command line. Create argument parser, define command line
+    arguments, then parse supplied command line arguments using the created argument parser
+
+        :return (Namespace object): parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(
+        description="Recalculate the metrics for a locus from its exported per-read evidence"
+    )
+    parser.add_argument("evidence", type=str, help="Evidence file (.evidence.npy)")
+    parser.add_argument(
+        config.PARAMS["min_mapq"],
+        type=int,
+        default=0,
+        help="Only use reads with at least this mapping quality (default: 0)",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["strand"],
+        choices=["forward", "reverse"],
+        default=None,
+        help="Only use reads on this strand",
+        required=False,
+    )  # Optional arg
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    allele_list, total_read_count = evidence_allele_list(
+        args["evidence"], args["min_mapq"], args["strand"]
+    )
+    writer = csv.writer(sys.stdout)
+    writer.writerow(config.GENERAL_HEADERS + config.TABLE_HEADERS)
+    for allele in allele_list:
+        writer.writerow(allele.values())
+    print(f"Total read count: {total_read_count}")
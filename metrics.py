@@ -0,0 +1,578 @@
+""" Per-read kernels and per-allele accumulators used by polyedge.py to calculate metrics
+"""
+import math
+from collections import Counter
+from fractions import Fraction
+import pysam
+import config
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only required by the numpy metrics engine
+    np = None
+
+BUFFER_SIZE = 1024  # Reads buffered by the numpy metrics engine between copies into its array
+# Per-read features collected by the numpy metrics engine, in column order
+FEATURES = ("allele", "polylen", "first_base_qual", "purity", "reverse", "read_pos")
+
+# CIGAR operations by the sequences they consume
+CIGAR_MATCH = (pysam.CMATCH, pysam.CEQUAL, pysam.CDIFF)  # Query and reference
+CIGAR_QUERY = (pysam.CINS, pysam.CSOFT_CLIP)  # Query only
+CIGAR_REF = (pysam.CDEL, pysam.CREF_SKIP)  # Reference only
+
+BASES = ("A", "C", "G", "T", "N")
+
+
+def resolve_query_positions(cigartuples, reference_start, ref_positions):
+    """
+    Find the query position aligned to each of the given reference positions by walking the CIGAR
+    once, without building the full list of aligned pairs. Gives the same result as taking the
+    query position of the pair in read.get_aligned_pairs() for each reference position
+
+        :param cigartuples (list):      CIGAR of the read as a list of (operation, length) tuples
+        :param reference_start (int):   0-based position of the first aligned base of the read
+        :param ref_positions (tuple):   0-based reference positions, in ascending order
+        :return query_positions (list): Query position aligned to each reference position. None
+                                        if the position is deleted or skipped in the read, or is
+                                        not covered by the read
+    """
+    query_positions = [None] * len(ref_positions)
+    index = 0
+    query_pos = 0
+    ref_pos = reference_start
+    for operation, length in cigartuples:
+        if operation in CIGAR_MATCH:
+            ref_end = ref_pos + length
+            while index < len(ref_positions) and ref_positions[index] < ref_end:
+                if ref_positions[index] >= ref_pos:
+                    query_positions[index] = query_pos + ref_positions[index] - ref_pos
+                index += 1
+            query_pos += length
+            ref_pos = ref_end
+        elif operation in CIGAR_QUERY:
+            query_pos += length
+        elif operation in CIGAR_REF:
+            ref_pos += length
+            while index < len(ref_positions) and ref_positions[index] < ref_pos:
+                index += 1
+        if index == len(ref_positions):
+            break
+    return query_positions
+
+
+def extract_poly(query_sequence, seq_start, seq_end, anchor_length):
+    """
+    Extract the poly from the read sequence between the query positions aligned to the start and
+    end of the roi, excluding the anchor bases at either end (assuming no indel in the anchor
+    sequence). Uses index arithmetic and str.count rather than a regex and Counter per read
+
+        :param query_sequence (str):    Read sequence
+        :param seq_start (int):         Query position aligned to the start of the roi
+        :param seq_end (int):           Query position aligned to the end of the roi
+        :param anchor_length (int):     Length of anchor sequence
+        :return poly (tuple):           (allele, polylen, purity) where allele is the first base
+                                        of the poly, polylen the poly length and purity the count
+                                        of the most common base in the poly excluding the first
+                                        base. None if there is no poly base between the anchors
+    """
+    poly_start = seq_start + anchor_length
+    poly_end = min(seq_end, len(query_sequence)) - anchor_length
+    if poly_end <= poly_start:
+        return None
+    remainder = query_sequence[poly_start + 1: poly_end]
+    base_counts = [remainder.count(base) for base in BASES]
+    if sum(base_counts) == len(remainder):
+        purity = max(base_counts)
+    else:  # Other IUPAC codes present
+        purity = Counter(remainder).most_common(1)[0][1]
+    return query_sequence[poly_start], poly_end - poly_start, purity
+
+
+def wilson_interval(proportion, trials, z):
+    """
+    Wilson score confidence interval for a binomial proportion
+
+        :param proportion (float):  Observed proportion
+        :param trials (int):        Number of trials the proportion was observed over
+        :param z (float):           Standard normal quantile for the confidence level
+        :return interval (tuple):   Lower and upper bounds of the interval
+    """
+    if not trials:
+        return 0.0, 1.0
+    denominator = 1 + z * z / trials
+    centre = (proportion + z * z / (2 * trials)) / denominator
+    half_width = (
+        z * math.sqrt(proportion * (1 - proportion) / trials + z * z / (4 * trials * trials))
+        / denominator
+    )
+    return max(centre - half_width, 0.0), min(centre + half_width, 1.0)
+
+
+def fisher_exact(table):
+    """
+    Two-sided p-value of Fisher's exact test for a 2x2 contingency table: the total probability,
+    given the row and column totals, of every table at most as probable as the one observed. The
+    hypergeometric probabilities are calculated in log space with a recurrence from the first
+    possible table, so that high depth loci neither overflow nor need a log-gamma per table
+
+        :param table (tuple):       ((a, b), (c, d)) counts
+        :return p_value (float):    Two-sided p-value
+    """
+    (a, b), (c, d) = table
+    row = a + b
+    column = a + c
+    total = a + b + c + d
+    low = max(0, row + column - total)
+    high = min(row, column)
+    if low == high:
+        return 1.0
+    log_prob = (
+        math.lgamma(row + 1) + math.lgamma(total - row + 1) + math.lgamma(column + 1)
+        + math.lgamma(total - column + 1) - math.lgamma(total + 1) - math.lgamma(low + 1)
+        - math.lgamma(row - low + 1) - math.lgamma(column - low + 1)
+        - math.lgamma(total - row - column + low + 1)
+    )
+    log_probs = [log_prob]
+    for count in range(low, high):
+        log_prob += math.log(
+            (row - count) * (column - count) / ((count + 1) * (total - row - column + count + 1))
+        )
+        log_probs.append(log_prob)
+    # Tolerance so that tables exactly as probable as the observed one are not lost to rounding
+    observed = log_probs[a - low] + 1e-7
+    return min(sum(math.exp(value) for value in log_probs if value <= observed), 1.0)
+
+
+class AlleleAccumulator:
+    """
+    Running statistics for the reads supporting a single allele, using memory proportional to the
+    number of distinct poly lengths and read positions rather than the number of reads. Poly
+    lengths and qualities are integers, so the sums are kept exactly and the statistics match
+    those calculated by the statistics module over the full lists of values
+
+        add(polylen, first_base_qual, purity, reverse, read_pos)
+            Add a read to the accumulator
+            :param polylen (int):           Length of poly (excluding anchor bases)
+            :param first_base_qual (int):   Quality of the first base of the poly
+            :param purity (int):            Count of the most common base in the poly, excluding
+                                            the first base
+            :param reverse (bool):          Read is aligned to the reverse strand
+            :param read_pos (int):          Distance of the first base of the poly from the
+                                            nearest end of the read
+
+        mean_quality()
+            :return mean_quality (int):     Mean quality of the first base, truncated
+
+        mean_polylen()
+            :return mean_polylen (float):   Mean poly length
+
+        stdev_polylen()
+            :return stdev_polylen (float):  Sample standard deviation of poly length
+
+        mode_polylen()
+            :return mode_polylen (int):     Most common poly length (first seen if tied)
+
+        poly_purity()
+            :return poly_purity (float):    Fraction of poly bases (excluding the first base)
+                                            matching the most common base, or 0.0 if the
+                                            allele has no poly bases after the first base
+
+        median_read_pos()
+            :return median_read_pos (float):    Median distance of the first base of the poly
+                                                from the nearest end of the read
+
+        read_end_fraction(distance)
+            :return read_end_fraction (float):  Fraction of reads with the first base of the poly
+                                                within distance bases of the nearest end of the
+                                                read
+    """
+
+    __slots__ = (
+        "read_count",
+        "qual_sum",
+        "polylen_sum",
+        "polylen_sq_sum",
+        "purity_sum",
+        "polylen_counts",
+        "reverse_count",
+        "read_pos_counts",
+    )
+
+    def __init__(self):
+        """
+        Constructor for AlleleAccumulator class
+        """
+        self.read_count = 0
+        self.qual_sum = 0
+        self.polylen_sum = 0
+        self.polylen_sq_sum = 0
+        self.purity_sum = 0
+        self.polylen_counts = {}  # Histogram of poly lengths, in order first seen
+        self.reverse_count = 0
+        self.read_pos_counts = {}  # Histogram of distances from the nearest end of the read
+
+    def add(self, polylen, first_base_qual, purity, reverse, read_pos):
+        """
+        Add a read to the accumulator
+
+            :param polylen (int):           Length of poly (excluding anchor bases)
+            :param first_base_qual (int):   Quality of the first base of the poly
+            :param purity (int):            Count of the most common base in the poly, excluding
+                                            the first base
+            :param reverse (bool):          Read is aligned to the reverse strand
+            :param read_pos (int):          Distance of the first base of the poly from the
+                                            nearest end of the read
+        """
+        self.read_count += 1
+        self.qual_sum += first_base_qual
+        self.polylen_sum += polylen
+        self.polylen_sq_sum += polylen * polylen
+        self.purity_sum += purity
+        self.polylen_counts[polylen] = self.polylen_counts.get(polylen, 0) + 1
+        self.reverse_count += reverse
+        self.read_pos_counts[read_pos] = self.read_pos_counts.get(read_pos, 0) + 1
+
+    def mean_quality(self):
+        """
+        :return mean_quality (int):     Mean quality of the first base, truncated
+        """
+        return self.qual_sum // self.read_count
+
+    def mean_polylen(self):
+        """
+        :return mean_polylen (float):   Mean poly length
+        """
+        return self.polylen_sum / self.read_count
+
+    def stdev_polylen(self):
+        """
+        :return stdev_polylen (float):  Sample standard deviation of poly length
+        """
+        variance = Fraction(
+            self.read_count * self.polylen_sq_sum - self.polylen_sum ** 2,
+            self.read_count * (self.read_count - 1),
+        )
+        return math.sqrt(variance)
+
+    def mode_polylen(self):
+        """
+        :return mode_polylen (int):     Most common poly length (first seen if tied)
+        """
+        return max(self.polylen_counts.items(), key=lambda item: item[1])[0]
+
+    def poly_purity(self):
+        """
+        :return poly_purity (float):    Fraction of poly bases (excluding the first base)
+                                        matching the most common base, or 0.0 if the allele has
+                                        no poly bases after the first base
+        """
+        if self.polylen_sum == self.read_count:
+            return 0.0
+        return self.purity_sum / (self.polylen_sum - self.read_count)
+
+    def median_read_pos(self):
+        """
+        :return median_read_pos (float):    Median distance of the first base of the poly from the
+                                            nearest end of the read (the mean of the middle two
+                                            distances if the read count is even)
+        """
+        middle = [(self.read_count - 1) // 2, self.read_count // 2]
+        values = []
+        seen = 0
+        for read_pos, count in sorted(self.read_pos_counts.items()):
+            seen += count
+            while len(values) < 2 and middle[len(values)] < seen:
+                values.append(read_pos)
+        return (values[0] + values[1]) / 2
+
+    def read_end_fraction(self, distance):
+        """
+        :param distance (int):              Distance from the nearest end of the read
+        :return read_end_fraction (float):  Fraction of reads with the first base of the poly
+                                            within distance bases of the nearest end of the read
+        """
+        near_end = sum(
+            count for read_pos, count in self.read_pos_counts.items() if read_pos < distance
+        )
+        return near_end / self.read_count
+
+
+class AlleleMetrics:
+    """
+    Accumulates reads for a single locus, partitioned by first base allele, and calculates the
+    metrics written to the output files. The outcome of filtering each read fetched for the locus
+    is counted in read_filter_counts, and the names of the paired reads counted are kept in
+    mate_names if overlapping mates are deduplicated
+
+        add(allele, polylen, first_base_qual, purity, reverse, read_pos)
+            Add a read to the accumulator for its allele
+
+        allele_list(gene, chrom, pos)
+            Calculate metrics per allele
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+
+        total_read_count()
+            :return total_read_count (int):     Total read count across all alleles
+
+        allele_intervals(z)
+            Calculate confidence intervals for the read fraction and purity of each allele
+            :return intervals (dict):           (read_fraction, poly_purity) intervals by allele
+    """
+
+    def __init__(self):
+        """
+        Constructor for AlleleMetrics class
+        """
+        self.alleles = {}
+        self.read_filter_counts = Counter()  # Outcome of each read fetched for the locus
+        self.mate_names = set()  # Names of the paired reads counted, if mates are deduplicated
+
+    def add(self, allele, polylen, first_base_qual, purity, reverse, read_pos):
+        """
+        Add a read to the accumulator for its allele
+
+            :param allele (str):            First base of the poly
+            :param polylen (int):           Length of poly (excluding anchor bases)
+            :param first_base_qual (int):   Quality of the first base of the poly
+            :param purity (int):            Count of the most common base in the poly, excluding
+                                            the first base
+            :param reverse (bool):          Read is aligned to the reverse strand
+            :param read_pos (int):          Distance of the first base of the poly from the
+                                            nearest end of the read
+        """
+        accumulator = self.alleles.get(allele)
+        if accumulator is None:
+            accumulator = self.alleles[allele] = AlleleAccumulator()
+        accumulator.add(polylen, first_base_qual, purity, reverse, read_pos)
+
+    def total_read_count(self):
+        """
+        :return total_read_count (int):     Total read count across all alleles
+        """
+        return sum(accumulator.read_count for accumulator in self.alleles.values())
+
+    def allele_intervals(self, z):
+        """
+        Calculate Wilson confidence intervals for the read fraction and the purity of each allele
+        from the reads added so far. Purity is treated as a proportion observed over the reads
+        supporting the allele rather than over their bases, as bases within a read are not
+        independent
+
+            :param z (float):           Standard normal quantile for the confidence level
+            :return intervals (dict):   (read_fraction, poly_purity) intervals by allele, where
+                                        the purity interval is None if the allele has no poly
+                                        bases after the first base
+        """
+        total_count = self.total_read_count()
+        intervals = {}
+        for allele in sorted(self.alleles.keys()):
+            accumulator = self.alleles[allele]
+            fraction = wilson_interval(accumulator.read_count / total_count, total_count, z)
+            purity = None
+            if accumulator.polylen_sum > accumulator.read_count:
+                purity = wilson_interval(accumulator.poly_purity(), accumulator.read_count, z)
+            intervals[allele] = (fraction, purity)
+        return intervals
+
+    def allele_list(self, gene, chrom, pos):
+        """
+        Calculate metrics per allele: first base of poly repeat allele, read count, mean quality
+        of first base, fraction of reads, mean poly length, standard deviation of poly length,
+        mode of poly length, average purity of polyN repeat, forward and reverse read counts,
+        strand bias (Fisher's exact test of the allele's forward and reverse read counts against
+        those of the other alleles), median distance of the allele from the nearest end of the
+        read, and fraction of reads with the allele near the end of the read
+
+            :param gene (str):                  Gene of interest
+            :param chrom (str):                 Chromosome of interest
+            :param pos (int):                   1-based position of the variant
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+        """
+        total_count = self.total_read_count()
+        total_reverse = sum(accumulator.reverse_count for accumulator in self.alleles.values())
+        allele_list = []
+        for allele in sorted(self.alleles.keys()):
+            accumulator = self.alleles[allele]
+            forward_count = accumulator.read_count - accumulator.reverse_count
+            strand_bias_p = fisher_exact((
+                (forward_count, accumulator.reverse_count),
+                (total_count - total_reverse - forward_count,
+                 total_reverse - accumulator.reverse_count),
+            ))
+            data = {
+                "gene": gene,
+                "chrom": chrom,
+                "pos": pos,
+                "first_base": allele,
+                "read_count": accumulator.read_count,
+                "mean_quality": accumulator.mean_quality(),
+                "read_fraction": round(accumulator.read_count / total_count, 2),
+                "mean_polylen": round(accumulator.mean_polylen(), 2),
+                "stdev_polylen": round(accumulator.stdev_polylen(), 2)
+                if accumulator.read_count > 1
+                else 0,
+                "mode_polylen": accumulator.mode_polylen(),
+                "poly_purity": round(accumulator.poly_purity(), 2),
+                "forward_count": forward_count,
+                "reverse_count": accumulator.reverse_count,
+                "strand_bias_p": float(f"{strand_bias_p:.3g}"),
+                "median_read_pos": accumulator.median_read_pos(),
+                "read_end_fraction": round(
+                    accumulator.read_end_fraction(config.READ_END_DISTANCE), 2
+                ),
+            }
+            allele_list.append(data)
+        return allele_list
+
+
+class NumpyAlleleMetrics(AlleleMetrics):
+    """
+    Alternative to AlleleMetrics for high depth loci. Collects the per-read features (allele code,
+    poly length, first base quality, purity, strand, distance from the read end) into a
+    preallocated NumPy array, copying them in blocks, then calculates the per-allele sums and
+    histograms with grouped array operations. Gives identical metrics to AlleleMetrics. Requires
+    numpy
+
+        add(allele, polylen, first_base_qual, purity, reverse, read_pos)
+            Add a read's features to the buffer, copying the buffer into the feature array when
+            full
+
+        flush()
+            Copy buffered features into the feature array in one operation, growing it if full
+
+        allele_list(gene, chrom, pos)
+            Calculate metrics per allele
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+
+        allele_intervals(z)
+            Calculate confidence intervals for the read fraction and purity of each allele
+            :return intervals (dict):           (read_fraction, poly_purity) intervals by allele
+
+        summarise_features()
+            Calculate the per-allele sums from the feature array
+
+        total_read_count()
+            :return total_read_count (int):     Total read count across all alleles
+    """
+
+    def __init__(self, capacity=4096):
+        """
+        Constructor for NumpyAlleleMetrics class
+
+            :param capacity (int):  Number of reads to preallocate the feature array for
+        """
+        if np is None:
+            raise ImportError("The numpy metrics engine requires numpy to be installed")
+        super().__init__()
+        self.features = np.empty((capacity, len(FEATURES)), dtype=np.int64)
+        self.read_count = 0  # Reads copied into the feature array
+        self.buffer = []  # Reads not yet copied into the feature array
+
+    def add(self, allele, polylen, first_base_qual, purity, reverse, read_pos):
+        """
+        Add a read's features to the buffer, copying the buffer into the feature array when full
+
+            :param allele (str):            First base of the poly
+            :param polylen (int):           Length of poly (excluding anchor bases)
+            :param first_base_qual (int):   Quality of the first base of the poly
+            :param purity (int):            Count of the most common base in the poly, excluding
+                                            the first base
+            :param reverse (bool):          Read is aligned to the reverse strand
+            :param read_pos (int):          Distance of the first base of the poly from the
+                                            nearest end of the read
+        """
+        self.buffer.append((ord(allele), polylen, first_base_qual, purity, reverse, read_pos))
+        if len(self.buffer) == BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Copy buffered features into the feature array in one operation, growing it if full
+        """
+        if not self.buffer:
+            return
+        while self.read_count + len(self.buffer) > len(self.features):
+            self.features = np.concatenate([self.features, np.empty_like(self.features)])
+        self.features[self.read_count: self.read_count + len(self.buffer)] = self.buffer
+        self.read_count += len(self.buffer)
+        self.buffer = []
+
+    def total_read_count(self):
+        """
+        :return total_read_count (int):     Total read count across all alleles
+        """
+        return self.read_count + len(self.buffer)
+
+    def allele_list(self, gene, chrom, pos):
+        """
+        Calculate per-allele sums from the feature array, then calculate metrics per allele as
+        for AlleleMetrics
+
+            :param gene (str):                  Gene of interest
+            :param chrom (str):                 Chromosome of interest
+            :param pos (int):                   1-based position of the variant
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+        """
+        self.summarise_features()
+        return super().allele_list(gene, chrom, pos)
+
+    def allele_intervals(self, z):
+        """
+        Calculate per-allele sums from the feature array, then calculate confidence intervals as
+        for AlleleMetrics
+
+            :param z (float):           Standard normal quantile for the confidence level
+            :return intervals (dict):   (read_fraction, poly_purity) intervals by allele
+        """
+        self.summarise_features()
+        return super().allele_intervals(z)
+
+    def summarise_features(self):
+        """
+        Calculate the per-allele sums, and the poly length and read position histograms, from the
+        feature array with grouped array operations, replacing the accumulator for each allele
+        """
+        self.flush()
+        codes, polylens, quals, purities, reverses, read_positions = (
+            self.features[:self.read_count].T
+        )
+        allele_codes, groups = np.unique(codes, return_inverse=True)
+        read_counts = np.bincount(groups)
+        qual_sums = np.bincount(groups, weights=quals)
+        polylen_sums = np.bincount(groups, weights=polylens)
+        polylen_sq_sums = np.bincount(groups, weights=polylens * polylens)
+        purity_sums = np.bincount(groups, weights=purities)
+        reverse_counts = np.bincount(groups, weights=reverses)
+        self.alleles = {}
+        for group, code in enumerate(allele_codes):
+            accumulator = AlleleAccumulator()
+            accumulator.read_count = int(read_counts[group])
+            accumulator.qual_sum = int(qual_sums[group])
+            accumulator.polylen_sum = int(polylen_sums[group])
+            accumulator.polylen_sq_sum = int(polylen_sq_sums[group])
+            accumulator.purity_sum = int(purity_sums[group])
+            accumulator.reverse_count = int(reverse_counts[group])
+            # Histogram in order first seen, so that ties for the mode are broken as before
+            lengths, first_seen, counts = np.unique(
+                polylens[groups == group], return_index=True, return_counts=True
+            )
+            accumulator.polylen_counts = {
+                int(lengths[index]): int(counts[index]) for index in np.argsort(first_seen)
+            }
+            positions, position_counts = np.unique(
+                read_positions[groups == group], return_counts=True
+            )
+            accumulator.read_pos_counts = {
+                int(position): int(count) for position, count in zip(positions, position_counts)
+            }
+            self.alleles[chr(code)] = accumulator
+
+
+ENGINES = {
+    "python": AlleleMetrics,
+    "numpy": NumpyAlleleMetrics,
+}
@@ -0,0 +1,113 @@
+""" Bounded pipeline for writing output files (csv, html and pdf) on a pool of threads, so that the
+metrics for the next locus or sample are calculated while the outputs of earlier ones are written
+"""
+import threading
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+import config
+
+
+class OutputPipeline:
+    """
+    Runs output jobs on a bounded pool of threads. Submitting a job blocks while max_pending jobs
+    are queued or running, so that the calculation of metrics cannot run ahead of the outputs
+    without limit. Jobs finish in any order, but are logged in the order they were submitted.
+    A job that fails is reported without affecting the other jobs
+
+        submit(label, function, *args)
+            Queue an output job, waiting for a free slot if max_pending jobs are queued or running
+            :param label (str):         Name of the outputs written, used in log messages
+            :param function (func):     Function writing the outputs
+            :param args (list):         Arguments of function
+
+        drain()
+            Wait for every queued job to finish
+
+        close()
+            Wait for every queued job to finish and stop the pool
+            :return failures (list):    List of (label, error) tuples for jobs that failed, in
+                                        submission order
+
+        log_finished(wait)
+            Log the jobs that have finished, in submission order
+    """
+
+    def __init__(self, workers=config.DEFAULT_PDF_WORKERS, max_pending=config.DEFAULT_OUTPUT_QUEUE,
+                 log=True):
+        """
+        Constructor for OutputPipeline class
+
+            :param workers (int):       Number of jobs run at once
+            :param max_pending (int):   Number of jobs that may be queued or running before
+                                        submit blocks. If 0, jobs are run as they are submitted
+            :param log (bool):          Print a line for each job as it is logged. Failures are
+                                        always printed
+        """
+        self.max_pending = max_pending
+        self.log = log
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1)) if max_pending else None
+        self.slots = threading.Semaphore(max(max_pending, 1))
+        self.pending = collections.deque()  # (label, future) tuples in submission order
+        self.failures = []
+
+    def submit(self, label, function, *args):
+        """
+        Queue an output job, waiting for a free slot if max_pending jobs are queued or running
+
+            :param label (str):         Name of the outputs written, used in log messages
+            :param function (func):     Function writing the outputs
+            :param args (list):         Arguments of function
+        """
+        if self.executor is None:
+            future = Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as exception:  # pylint: disable=broad-except
+                future.set_exception(exception)
+        else:
+            self.slots.acquire()
+            try:
+                future = self.executor.submit(function, *args)
+            except BaseException:
+                self.slots.release()
+                raise
+            future.add_done_callback(lambda _: self.slots.release())
+        self.pending.append((label, future))
+        self.log_finished(wait=False)
+
+    def drain(self):
+        """
+        Wait for every queued job to finish
+        """
+        self.log_finished(wait=True)
+
+    def close(self):
+        """
+        Wait for every queued job to finish and stop the pool
+
+            :return failures (list):    List of (label, error) tuples for jobs that failed, in
+                                        submission order
+        """
+        self.drain()
+        if self.executor is not None:
+            self.executor.shutdown()
+        failures, self.failures = self.failures, []
+        return failures
+
+    def log_finished(self, wait):
+        """
+        Log the jobs that have finished, in submission order. A finished job is only logged once
+        every job submitted before it has been logged
+
+            :param wait (bool):         Wait for every queued job to finish
+        """
+        while self.pending and (wait or self.pending[0][1].done()):
+            label, future = self.pending.popleft()
+            try:
+                future.result()
+                if self.log:
+                    print(f"Wrote {label}")
+            except Exception as exception:  # pylint: disable=broad-except
+                error = f"{type(exception).__name__}: {exception}"
+                self.failures.append((label, error))
+                print(f"Failed to write {label}: {error}")
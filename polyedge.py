@@ -1,18 +1,26 @@
 """ Finds variants at the edge of a poly that is varying length
 """
 import subprocess
-import re
+import sys
 import os
+import hashlib
+import functools
 import argparse
-import statistics
-from collections import defaultdict, Counter
-from functools import reduce
 import csv
 import datetime
+import random
+import tempfile
 import jinja2
 import pdfkit
 import pysam
 import config
+import metrics
+import site_index
+from evidence import EvidenceRecorder
+from cache import ResultCache
+from pipeline import OutputPipeline
+from results_store import ResultsStore
+from timing import StageTimings, timed_stage
 
 
 class PolyEdge:
@@ -20,19 +28,89 @@ class PolyEdge:
     Class for processing bam files to determine whether a variant is present at the position before
     a poly stretch, and write to file
 
+        set_output_string(output_string)
+            Set the prefix used for the output files, and the output file paths derived from it
+            :param output_string (str): Output file prefix
+
         generate_output()
             Call methods required to generate all output files for the sample provided
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+            :return total_read_count (int):     Total read count across all alleles
+
+        write_output(allele_list, total_read_count, pdf)
+            Write the csv, html and pdf output files from calculated metrics
 
         roi_reads(self):
-            Open bam file and fetch reads from input bam (using pysam) intersecting the poly repeat
+            Open bam file and fetch reads from input bam (using pysam) that may span the roi
             :return roi_reads (obj):    Object containing reads
 
+        fetch(start, end)
+            Fetch reads intersecting a region of the chromosome of interest
+            :return reads (obj):        Object containing reads
+
         calculate_metrics()
             Calculate metrics per allele.
             :return allele_list (list):         List of dictionaries, one per allele,
                                                 containing calculated metrics
             :return total_read_count (int):     Total read count across all alleles
 
+        calculate_sampled_metrics()
+            Calculate metrics per allele from a sample of the reads, stopping early once the
+            metrics are clear of the thresholds if early_stop is set
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+            :return total_read_count (int):     Total read count across all alleles
+
+        sample_settled(allele_metrics)
+            Check whether the confidence intervals of the metrics are clear of the thresholds
+            :return settled (bool):             True if no further reads are needed
+
+        load_cached()
+            Load the metrics for this locus from the result cache
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+            :return total_read_count (int):     Total read count across all alleles
+
+        result_cache_key()
+            Create the key of this locus in the result cache
+            :return cache_key (str):            Hex digest identifying the metrics
+
+        analysis_params()
+            Parameters affecting the metrics, other than the locus
+            :return params (dict):              Parameter values by name
+
+        store_results(allele_list, total_read_count)
+            Append the metrics for this locus to the results store, if one was supplied
+
+        create_allele_metrics()
+            Create the object holding running statistics by first base allele for this locus
+            :return allele_metrics (obj):       Accumulator for the configured metrics engine
+
+        accumulate(read, allele_metrics)
+            Add a read to the running statistics if it passes the read filters, spans the poly
+            and is anchored, counting the outcome for each read
+
+        process_read(read, allele_metrics)
+            Add a read that has passed the read filters to the running statistics if it is
+            anchored and the poly can be extracted
+            :return outcome (str):  "counted", "not_anchored", "mate_overlap" or "no_poly"
+
+        add_poly(read, query_sequence, query_qualities, seq_start, seq_end, allele_metrics)
+            Extract the poly from an anchored read and add it to the running statistics
+            :return outcome (str):  "counted", "mate_overlap" if the read's mate has already been
+                                    counted, or "no_poly" if there is no poly between the anchors
+
+        filter_read(read)
+            Check a read against the read filters using fields that do not require decoding
+            :return reason (str):   Reason the read was rejected, or None if it passed
+
+        summarise(allele_metrics)
+            Calculate statistics from the running statistics
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+            :return total_read_count (int):     Total read count across all alleles
+
         create_csvfile()
             Write metrics to csv. Copy template csv to output dest, write data to end of file
             :param allele_list (list):  List of dictionaries, one per allele,
@@ -42,6 +120,12 @@ class PolyEdge:
             :return total_read_count (int):     Total read count across all alleles
             :return table_html (str):           String containing the table html
 
+        construct_row_cells(allele_dict)
+            Construct the html table cells for an allele, with formatting dependent on whether
+            metrics meet defined thresholds
+            :param allele_dict (dict):  Calculated metrics for the allele
+            :return cells (list):       Html of each cell, in the order of config.TABLE_HEADERS
+
         construct_readcount_html(self, allele_list)
             Construct html for total read count header with colour dependent upon whether it passes
             the config defined threshold
@@ -49,6 +133,19 @@ class PolyEdge:
                                             containing calculated metrics
             :return total_rc_html (str):    String containing the total read count html
 
+        construct_read_filter_html()
+            Construct html for the table of read filtering outcomes
+            :return read_filter_html (str): String containing the read filtering table html
+
+        sampling_rows()
+            Rows of the table of confidence intervals for a sampled locus, one per allele
+            :return rows (list):            List of rows, in the order of config.SAMPLING_HEADERS
+
+        construct_sampling_html()
+            Construct html for the numbers of reads sampled and available, and the confidence
+            intervals, if the reads were sampled
+            :return sampling_html (str):    String containing the sampling table html
+
         create_htmlfile()
             Write metrics to html
             :param table_html (str):    String containing the table html
@@ -57,7 +154,12 @@ class PolyEdge:
             Write metrics to pdf
     """
 
-    def __init__(self, bamfile, bam_index, gene, chrom, poly, anchor_length):
+    def __init__(self, bamfile, bam_index, gene, chrom, poly, anchor_length, reader=None,
+                 engine=config.DEFAULT_ENGINE, read_filters=config.DEFAULT_READ_FILTERS,
+                 min_mapq=config.DEFAULT_MIN_MAPQ, threads=config.DEFAULT_THREADS, reference=None,
+                 ref_cache=None, output_dir=None, pdf_renderer=None, result_cache=None,
+                 early_stop=False, max_reads=None, timings=None, evidence=False,
+                 results_store=None, output_pipeline=None, dedup_mates=False):
         """
         Constructor for PolyEdge class
 
@@ -66,28 +168,83 @@ class PolyEdge:
             :param chrom (str):         Chromosome of interest
             :param poly (tuple):        Contains start and end position of poly stretch
             :param anchor_length (int): Length of anchor sequence
+            :param reader (obj):        Optional open pysam AlignmentFile to fetch reads from, so
+                                        that the bam file is only opened once across loci
+            :param engine (str):        Metrics engine used to accumulate reads (python or numpy)
+            :param read_filters (list): Names of the flags (config.READ_FILTER_FLAGS) for which
+                                        reads are rejected
+            :param min_mapq (int):      Minimum mapping quality of reads
+            :param threads (int):       Number of htslib decompression threads, used if reader is
+                                        not supplied
+            :param reference (str):     Reference fasta for cram input, used if reader is not
+                                        supplied
+            :param ref_cache (str):     Local reference cache directory for cram input, used if
+                                        reader is not supplied
+            :param output_dir (str):    Directory to write output files to (default: current
+                                        working directory)
+            :param pdf_renderer (obj):  PdfRenderer used to write the pdf (default: written
+                                        immediately)
+            :param result_cache (obj):  Optional ResultCache to load and store the metrics in
+            :param early_stop (bool):   Process reads in a random order, stopping once the
+                                        metrics are clear of the thresholds
+            :param max_reads (int):     Maximum number of reads to process, sampled at random
+                                        from the reads passing the read filters
+            :param timings (obj):       StageTimings to record the time spent in each stage in
+            :param evidence (bool):     Export the features of each counted read to a .npy file
+            :param results_store (obj): Optional ResultsStore to append the metrics to
+            :param output_pipeline (obj):   Optional OutputPipeline to write the output files
+                                            with (default: written immediately)
+            :param dedup_mates (bool):  Count only the first read of a pair whose mates both
+                                        span the poly
             :return data (list):        List of tuples per allele, with each tuple containing the
                                         output stats as defined in the readme
         """
         self.bamfile = bamfile
+        self.bam_index = bam_index
+        self.reader = reader
+        self.threads = threads
+        self.reference = reference
+        self.ref_cache = ref_cache
+        self.pdf_renderer = pdf_renderer or PdfRenderer()
+        self.result_cache = result_cache
+        self.results_store = results_store
+        self.output_pipeline = output_pipeline
+        self.early_stop = early_stop
+        self.max_reads = max_reads
+        self.sampled = bool(early_stop or max_reads)
+        self.dedup_mates = dedup_mates
+        self.sampling = None  # Reads sampled and available, and intervals, if sampled
+        self.timings = timings or StageTimings()
+        self.evidence = evidence
+        self.evidence_recorder = None  # Created for each calculation if evidence is exported
+        self.cache_key = None  # Key of the metrics in the result cache, created on first use
+        self.contig = None  # Contig name of chrom in the bam header, resolved on first fetch
+        self.engine = engine
+        self.read_filters = list(read_filters)
+        self.min_mapq = min_mapq
+        # Reads with any of these flags are rejected before their sequence is decoded
+        self.exclude_flags = 0
+        for read_filter in self.read_filters:
+            self.exclude_flags |= config.READ_FILTER_FLAGS[read_filter]
+        self.read_filter_counts = {}
         self.gene = gene
         self.chrom = chrom
-        self.chrchrom = f"chr{self.chrom}"
         self.anchor_length = anchor_length
         self.poly = poly
         self.variant_pos = poly[0] + 1
         # Define start and end of segment to be matched
         self.roi_start = self.poly[0] - self.anchor_length
         self.roi_end = self.poly[1] + self.anchor_length
+        # Only reads overlapping the end of the roi can span it, so fetch reads overlapping
+        # roi_end rather than the whole poly
+        self.fetch_window = (self.roi_end, self.roi_end + 1)
         # Variables required for creating output files
         self.bamfile_prefix = os.path.splitext(bamfile)[0].split("/")[-1]
         self.baifile_prefix = os.path.splitext(bam_index)[0].split("/")[-1]
         self.sample_name = self.bamfile_prefix.split(".")[0]
-        self.output_string = f"{self.bamfile_prefix}.{self.gene}_polyedge"
         self.timestamp = datetime.datetime.now().strftime("%d-%B-%Y %H:%M")
-        self.csv_path = os.path.join(os.getcwd(), f"{self.output_string}.csv")
-        self.html_path = os.path.join(os.getcwd(), f"{self.output_string}.html")
-        self.pdf_path = os.path.join(os.getcwd(), f"{self.output_string}.pdf")
+        self.output_dir = output_dir or os.getcwd()
+        self.set_output_string(f"{self.bamfile_prefix}.{self.gene}_polyedge")
         self.footer_html = config.HTML_LIST.format(
             config.PARAMS["bam"],
             self.bamfile_prefix,
@@ -103,19 +260,57 @@ class PolyEdge:
             self.poly[1],
             config.PARAMS["anchor_length"],
             self.anchor_length,
+            config.PARAMS["read_filters"],
+            " ".join(self.read_filters),
+            config.PARAMS["min_mapq"],
+            self.min_mapq,
         )
 
+    def set_output_string(self, output_string):
+        """
+        Set the prefix used for the output files, and the output file paths derived from it
+
+            :param output_string (str): Output file prefix
+        """
+        self.output_string = output_string
+        self.csv_path = os.path.join(self.output_dir, f"{self.output_string}.csv")
+        self.html_path = os.path.join(self.output_dir, f"{self.output_string}.html")
+        self.pdf_path = os.path.join(self.output_dir, f"{self.output_string}.pdf")
+        self.timing_path = os.path.join(self.output_dir, f"{self.output_string}.timing.json")
+        self.profile_path = os.path.join(self.output_dir, f"{self.output_string}.pstats")
+        self.evidence_path = os.path.join(self.output_dir, f"{self.output_string}.evidence.npy")
+
     def generate_output(self):
         """
         Call methods required to generate all output files for the sample provided
+
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+            :return total_read_count (int):     Total read count across all alleles
         """
         allele_list, total_read_count = self.calculate_metrics()
+        self.store_results(allele_list, total_read_count)
+        submit_output(self.output_pipeline, self.output_string, self.write_output, allele_list,
+                      total_read_count)
+        return allele_list, total_read_count
+
+    def write_output(self, allele_list, total_read_count, pdf=True):
+        """
+        Write the csv, html and pdf output files from calculated metrics
+
+            :param allele_list (list):          List of dictionaries, one per allele,
+                                                containing calculated metrics
+            :param total_read_count (int):      Total read count across all alleles
+            :param pdf (bool):                  Write the pdf as well as the csv and html
+        """
         self.create_csvfile(allele_list, total_read_count)
         table_html = self.construct_table_html(allele_list)
         total_rc_html = self.construct_readcount_html(total_read_count)
-        self.create_htmlfile(table_html, total_rc_html)
-        self.create_pdffile()
+        self.create_htmlfile(table_html, total_rc_html, self.construct_read_filter_html())
+        if pdf:
+            self.create_pdffile()
 
+    @timed_stage("calculate_metrics")
     def calculate_metrics(self):
         """
         Calculate metrics per allele: first base of poly repeat allele, read count, mean quality
@@ -126,98 +321,353 @@ class PolyEdge:
                                                 containing calculated metrics
             :return total_read_count (int):     Total read count across all alleles
         """
-        # Poly length counts by first base allele
-        counts = defaultdict(
-            list
-        )  # Store lengths of repeat for given allele (one per read)
-        quals = defaultdict(list)  # Store quality of first base
-        purity = defaultdict(
-            list
-        )  # Store most common base count in poly w/o first base
+        cached = self.load_cached()
+        if cached:
+            return cached
+        if self.sampled:
+            return self.calculate_sampled_metrics()
+        allele_metrics = self.create_allele_metrics()
+        for read in self.roi_reads():
+            self.accumulate(read, allele_metrics)
+        return self.summarise(allele_metrics)
+
+    def calculate_sampled_metrics(self):
+        """
+        Calculate metrics per allele from a sample of the reads. The read filters are applied to
+        every read fetched, keeping a reservoir sample of at most max_reads of the reads passing
+        them. With early stopping, the sample is processed in a random order and processing stops
+        once the confidence interval of every allele's read fraction, and of the purity of every
+        allele above the read fraction threshold, is clear of the thresholds. The random seed is
+        fixed, so that the sample is the same on every run
 
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+            :return total_read_count (int):     Total read count across all alleles
+        """
+        allele_metrics = self.create_allele_metrics()
+        rng = random.Random(config.SAMPLING_SEED)
+        reservoir = []
+        available = 0
         for read in self.roi_reads():
-            # Select reads that span poly with defined ANCHOR sequence length
+            outcome = self.filter_read(read)
+            if outcome:
+                allele_metrics.read_filter_counts[outcome] += 1
+                continue
+            available += 1
+            if not self.max_reads or len(reservoir) < self.max_reads:
+                reservoir.append(read)
+            else:
+                index = rng.randrange(available)
+                if index < self.max_reads:
+                    reservoir[index] = read
+        if self.early_stop:
+            rng.shuffle(reservoir)
+        sampled = 0
+        for read in reservoir:
+            allele_metrics.read_filter_counts[self.process_read(read, allele_metrics)] += 1
+            sampled += 1
             if (
-                read.reference_start < self.roi_start
-                and self.roi_end < read.reference_end
+                self.early_stop
+                and sampled >= config.EARLY_STOP_MIN_READS
+                and sampled % config.EARLY_STOP_INTERVAL == 0
+                and self.sample_settled(allele_metrics)
             ):
-                # Find sequence segment with poly and anchor sequence
-                # -> first matching position in the query->reference mapping
-                seq_start = next(
-                    x for x in read.get_aligned_pairs() if x[1] == self.roi_start
-                )
-                seq_end = next(
-                    x for x in read.get_aligned_pairs() if x[1] == self.roi_end
-                )
-                if seq_start[0] and seq_end[0]:  # If anchored
-                    seq_segment = read.query_sequence[seq_start[0]: seq_end[0]]
-                    first_base_pos = seq_start[0] + self.anchor_length
-                    first_base_qual = read.query_qualities[first_base_pos]
-                    # Extract poly sequence (excluding anchor bases)
-                    # Assuming no indel in anchor sequence
-                    regex = (
-                        r".{"
-                        + re.escape(str(self.anchor_length))
-                        + r"}(.+).{"
-                        + re.escape(str(self.anchor_length))
-                        + r"}"
-                    )
-                    seq_match = re.match(regex, seq_segment)
-                    if seq_match:
-                        # Partition poly by first base allele
-                        allele = seq_match.group(1)[0]
-                        counts[allele].append(len(seq_match.group(1)))
-                        # Count polyN purity
-                        remainder_poly = Counter(seq_match.group(1)[1:])
-                        poly_most_abundant = remainder_poly.most_common()[0][1]
-                        purity[allele].append(poly_most_abundant)
-                        # Quality of first base of ROI (allele in question)
-                        quals[allele].append(first_base_qual)
-        # Calculate statistics
-        total_count = reduce(lambda a, c: a + len(c), counts.values(), 0)
-        allele_list = []
-        for allele in sorted(counts.keys()):
-            data = {
+                break
+        allele_metrics.read_filter_counts["not_sampled"] = available - sampled
+        self.sampling = {
+            "reads_sampled": sampled,
+            "reads_available": available,
+            "intervals": {
+                allele: [
+                    [round(bound, 3) for bound in interval] if interval else None
+                    for interval in intervals
+                ]
+                for allele, intervals in allele_metrics.allele_intervals(
+                    config.CONFIDENCE_Z
+                ).items()
+            } if allele_metrics.total_read_count() else {},
+        }
+        return self.summarise(allele_metrics)
+
+    def sample_settled(self, allele_metrics):
+        """
+        Check whether the confidence interval of every allele's read fraction, and of the purity
+        of every allele above the read fraction threshold, is clear of the thresholds
+
+            :param allele_metrics (obj):    Running statistics by first base allele
+            :return settled (bool):         True if no further reads are needed
+        """
+        for fraction, purity in allele_metrics.allele_intervals(config.CONFIDENCE_Z).values():
+            if fraction[0] <= config.THRESHOLDS["read_fraction"] <= fraction[1]:
+                return False
+            if fraction[0] > config.THRESHOLDS["read_fraction"] and (
+                purity is None or purity[0] <= config.THRESHOLDS["poly_purity"] <= purity[1]
+            ):
+                return False
+        return True
+
+    def load_cached(self):
+        """
+        Load the metrics for this locus from the result cache, if a cache was supplied and the
+        locus has been analysed with the same bam file, parameters and version before. The cache
+        is not read if the per-read evidence is to be exported, as that requires the reads, or if
+        the version of the code cannot be determined
+
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+            :return total_read_count (int):     Total read count across all alleles
+            :return (None):                     If the metrics are not cached
+        """
+        if not self.result_cache or self.evidence or not code_version():
+            return None
+        cached = self.result_cache.get(self.result_cache_key())
+        if not cached:
+            return None
+        self.read_filter_counts = cached["read_filter_counts"]
+        self.sampling = cached["sampling"]
+        return cached["allele_list"], cached["total_read_count"]
+
+    def result_cache_key(self):
+        """
+        Create the key of this locus in the result cache, from the identity of the bam file, the
+        analysis parameters and the version of the code. The engine is not included, as the
+        engines give identical metrics
+
+            :return cache_key (str):    Hex digest identifying the metrics
+        """
+        if self.cache_key is None:
+            self.cache_key = self.result_cache.key(
+                self.bamfile,
+                self.bam_index,
+                {
+                    "version": code_version(),
+                    "gene": self.gene,
+                    "chrom": self.chrom,
+                    "poly": list(self.poly),
+                    **self.analysis_params(),
+                },
+            )
+        return self.cache_key
+
+    def analysis_params(self):
+        """
+        Parameters affecting the metrics, other than the locus
+
+            :return params (dict):      Parameter values by name
+        """
+        return {
+            "anchor_length": self.anchor_length,
+            "read_filters": sorted(self.read_filters),
+            "min_mapq": self.min_mapq,
+            "early_stop": self.early_stop,
+            "max_reads": self.max_reads,
+            "dedup_mates": self.dedup_mates,
+        }
+
+    def store_results(self, allele_list, total_read_count):
+        """
+        Append the metrics for this locus to the results store, if one was supplied
+
+            :param allele_list (list):          List of dictionaries, one per allele,
+                                                containing calculated metrics
+            :param total_read_count (int):      Total read count across all alleles
+        """
+        if not self.results_store:
+            return
+        self.results_store.add(
+            {
+                "sample": self.sample_name,
+                "bam": os.path.abspath(self.bamfile),
+                "version": version_string(),
                 "gene": self.gene,
                 "chrom": self.chrom,
                 "pos": self.variant_pos,
-                "first_base": allele,
-                "read_count": len(counts[allele]),
-                "mean_quality": int(statistics.mean(quals[allele])),
-                "read_fraction": round(len(counts[allele]) / total_count, 2),
-                "mean_polylen": round(statistics.mean(counts[allele]), 2),
-                "stdev_polylen": round(statistics.stdev(counts[allele]), 2)
-                if len(counts[allele]) > 1
-                else 0,
-                "mode_polylen": statistics.mode(counts[allele]),
-                "poly_purity": round(
-                    sum(purity[allele]) / (sum(counts[allele]) - len(counts[allele])), 2),
-            }
-            allele_list.append(data)
-
-        total_read_count = int()
-        for allele in allele_list:
-            total_read_count += allele["read_count"]
+                "anchor_length": self.anchor_length,
+                "read_filter_counts": self.read_filter_counts,
+                "params": self.analysis_params(),
+            },
+            allele_list,
+            total_read_count,
+        )
+
+    def create_allele_metrics(self):
+        """
+        Create the object holding running statistics by first base allele for this locus, and
+        the recorder of the per-read evidence if it is exported
+
+            :return allele_metrics (obj):   Accumulator for the configured metrics engine
+        """
+        if self.evidence:
+            self.evidence_recorder = EvidenceRecorder()
+        return metrics.ENGINES[self.engine]()
+
+    def accumulate(self, read, allele_metrics):
+        """
+        Add a read to the running statistics if it passes the read filters, spans the poly with
+        the defined anchor sequence length and the poly can be extracted. Reads are filtered on
+        cheap fields (flag, mapping quality, alignment start and end) before the sequence is
+        decoded, and the outcome for each read is counted
+
+            :param read (obj):              pysam AlignedSegment overlapping the fetch window
+            :param allele_metrics (obj):    Running statistics by first base allele
+        """
+        outcome = self.filter_read(read) or self.process_read(read, allele_metrics)
+        allele_metrics.read_filter_counts[outcome] += 1
+
+    def process_read(self, read, allele_metrics):
+        """
+        Add a read that has passed the read filters to the running statistics if it is anchored
+        and the poly can be extracted
+
+            :param read (obj):              pysam AlignedSegment spanning the roi
+            :param allele_metrics (obj):    Running statistics by first base allele
+            :return outcome (str):          "counted", "not_anchored", "mate_overlap" or "no_poly"
+        """
+        # Find sequence segment with poly and anchor sequence
+        # -> query positions aligned to the start and end of the roi
+        seq_start, seq_end = metrics.resolve_query_positions(
+            read.cigartuples, read.reference_start, (self.roi_start, self.roi_end)
+        )
+        if seq_start and seq_end:  # If anchored
+            return self.add_poly(read, read.query_sequence, read.query_qualities, seq_start,
+                                 seq_end, allele_metrics)
+        return "not_anchored"
+
+    def add_poly(self, read, query_sequence, query_qualities, seq_start, seq_end,
+                 allele_metrics):
+        """
+        Extract the poly from an anchored read and add it to the running statistics, with its
+        strand and the distance of the first base of the poly from the nearest end of the read,
+        and to the per-read evidence if it is exported. If overlapping mates are deduplicated, a
+        read whose mate has already been counted is not counted again
+
+            :param read (obj):              pysam AlignedSegment
+            :param query_sequence (str):    Read sequence
+            :param query_qualities (array): Read base qualities
+            :param seq_start (int):         Query position aligned to the start of the roi
+            :param seq_end (int):           Query position aligned to the end of the roi
+            :param allele_metrics (obj):    Running statistics by first base allele
+            :return outcome (str):          "counted", "mate_overlap" if the read's mate has
+                                            already been counted, or "no_poly" if there is no
+                                            poly between the anchors
+        """
+        paired = self.dedup_mates and read.is_paired
+        if paired and read.query_name in allele_metrics.mate_names:
+            return "mate_overlap"
+        # Extract poly sequence (excluding anchor bases)
+        poly = metrics.extract_poly(query_sequence, seq_start, seq_end, self.anchor_length)
+        if not poly:
+            return "no_poly"
+        # Partition poly by first base allele, with quality of first base of ROI
+        # (allele in question)
+        allele, polylen, purity = poly
+        allele_pos = seq_start + self.anchor_length
+        first_base_qual = query_qualities[allele_pos]
+        read_pos = min(allele_pos, len(query_sequence) - 1 - allele_pos)
+        allele_metrics.add(allele, polylen, first_base_qual, purity, read.is_reverse, read_pos)
+        if paired:
+            allele_metrics.mate_names.add(read.query_name)
+        if self.evidence_recorder:
+            self.evidence_recorder.add(read, allele, polylen, first_base_qual, purity, read_pos)
+        return "counted"
+
+    def filter_read(self, read):
+        """
+        Check a read against the read filters using only fields that do not require the sequence
+        to be decoded
 
+            :param read (obj):      pysam AlignedSegment
+            :return reason (str):   Reason the read was rejected (a key of
+                                    config.READ_FILTER_REASONS), or None if it passed
+        """
+        if read.flag & self.exclude_flags:
+            for read_filter in self.read_filters:
+                if read.flag & config.READ_FILTER_FLAGS[read_filter]:
+                    return read_filter
+        if read.mapping_quality < self.min_mapq:
+            return "low_mapq"
+        # Select reads that span poly with defined ANCHOR sequence length
+        if not (
+            read.reference_start < self.roi_start
+            and read.reference_end is not None
+            and self.roi_end < read.reference_end
+        ):
+            return "not_spanning"
+        return None
+
+    def summarise(self, allele_metrics):
+        """
+        Calculate statistics from the running statistics, storing them in the result cache if one
+        was supplied, and write the per-read evidence if it is exported
+
+            :param allele_metrics (obj):        Running statistics by first base allele
+            :return allele_list (list):         List of dictionaries, one per allele,
+                                                containing calculated metrics
+            :return total_read_count (int):     Total read count across all alleles
+        """
+        allele_list = allele_metrics.allele_list(self.gene, self.chrom, self.variant_pos)
+        total_read_count = allele_metrics.total_read_count()
+        self.read_filter_counts = {
+            reason: allele_metrics.read_filter_counts[reason]
+            for reason in config.READ_FILTER_REASONS
+        }
+        self.timings.count_reads(self.read_filter_counts)
+        if self.evidence_recorder:
+            self.evidence_recorder.write(self.evidence_path, {
+                "gene": self.gene,
+                "chrom": self.chrom,
+                "pos": self.variant_pos,
+                "poly": list(self.poly),
+                "anchor_length": self.anchor_length,
+                "bam": os.path.abspath(self.bamfile),
+                "version": git_tag(),
+                "read_filters": self.read_filters,
+                "min_mapq": self.min_mapq,
+                "read_filter_counts": self.read_filter_counts,
+                "sampling": self.sampling,
+            })
+            self.evidence_recorder = None
+        if self.result_cache and code_version():
+            self.result_cache.put(
+                self.result_cache_key(),
+                {
+                    "allele_list": allele_list,
+                    "total_read_count": total_read_count,
+                    "read_filter_counts": self.read_filter_counts,
+                    "sampling": self.sampling,
+                },
+            )
         return allele_list, total_read_count
 
     def roi_reads(self):
         """
-        Open bam file and fetch reads from input bam (using pysam) intersecting the poly repeat
+        Open bam file and fetch reads from input bam (using pysam) that may span the roi (those
+        overlapping the end of the roi)
 
             :return roi_reads (obj):    Object containing reads
         """
-        reader = pysam.Samfile(self.bamfile, "rb")  # Open BAM file
-        try:
-            roi_reads = reader.fetch(str(self.chrom), *self.poly)
-        except ValueError as exception:
-            print(
-                f"Using CHROM {str(self.chrchrom)} raised an exception ({exception}). "
-                f"Trying: CHROM '{self.chrchrom}'"
+        return self.fetch(*self.fetch_window)
+
+    def fetch(self, start, end):
+        """
+        Fetch reads intersecting a region of the chromosome of interest, opening the bam file if
+        an open reader was not supplied. The contig name of the chromosome ('2' or 'chr2') is
+        resolved from the bam header on the first fetch
+
+            :param start (int):         0-based start of region
+            :param end (int):           0-based end of region
+            :return reads (obj):        Object containing reads
+        """
+        if not self.reader:
+            self.reader = open_alignment(
+                self.bamfile, self.bam_index, self.threads, self.reference, self.ref_cache
             )
-            roi_reads = reader.fetch(self.chrchrom, *self.poly)
-        return roi_reads
+        if not self.contig:
+            self.contig = resolve_contig(self.reader.references, self.chrom)
+        # Time spent reading and decompressing reads is recorded separately from processing them
+        return self.timings.timed("roi_reads", self.reader.fetch(self.contig, start, end))
 
+    @timed_stage("create_csvfile")
     def create_csvfile(self, allele_list, total_read_count):
         """
         Write metrics to csv file
@@ -242,7 +692,25 @@ class PolyEdge:
             writer.writerow([config.PARAMS["poly_start"], self.poly[0]])
             writer.writerow([config.PARAMS["poly_end"], self.poly[1]])
             writer.writerow([config.PARAMS["anchor_length"], self.anchor_length])
+            writer.writerow([config.PARAMS["read_filters"], " ".join(self.read_filters)])
+            writer.writerow([config.PARAMS["min_mapq"], self.min_mapq])
+            writer.writerow([config.PARAMS["early_stop"], self.early_stop])
+            writer.writerow([config.PARAMS["max_reads"], self.max_reads])
+            writer.writerow([config.PARAMS["dedup_mates"], self.dedup_mates])
+            writer.writerow([])
+            writer.writerow([config.READ_FILTER_STR])
+            for reason, label in config.READ_FILTER_REASONS.items():
+                writer.writerow([label, self.read_filter_counts.get(reason, 0)])
             writer.writerow([])
+            if self.sampling:
+                writer.writerow([config.SAMPLING_STR])
+                writer.writerow([config.SAMPLING_COUNT_HEADERS[0], self.sampling["reads_sampled"]])
+                writer.writerow(
+                    [config.SAMPLING_COUNT_HEADERS[1], self.sampling["reads_available"]]
+                )
+                writer.writerow(config.SAMPLING_HEADERS)
+                writer.writerows(self.sampling_rows())
+                writer.writerow([])
             writer.writerow(config.GENERAL_HEADERS + config.TABLE_HEADERS)
 
             for row in allele_list:
@@ -261,49 +729,73 @@ class PolyEdge:
         table_body = str()
         # Generate the table body, with a row per allele
         for allele_dict in allele_list:
-            if allele_dict["mean_quality"] >= config.THRESHOLDS["mean_quality"]:
-                mean_quality = config.HTML_TBL_CELL_PASS.format(
-                    allele_dict["mean_quality"]
-                )
-            else:
-                mean_quality = config.HTML_TBL_CELL_FAIL.format(
-                    allele_dict["mean_quality"]
-                )
-
-            if allele_dict["read_fraction"] >= config.THRESHOLDS["read_fraction"]:
-                read_fraction = config.HTML_TBL_CELL_PASS.format(
-                    allele_dict["read_fraction"]
-                )
-            else:
-                read_fraction = config.HTML_TBL_CELL_FAIL.format(
-                    allele_dict["read_fraction"]
-                )
-
-            if allele_dict["poly_purity"] >= config.THRESHOLDS["poly_purity"]:
-                poly_purity = config.HTML_TBL_CELL_PASS.format(
-                    allele_dict["poly_purity"]
-                )
-            else:
-                poly_purity = config.HTML_TBL_CELL_FAIL.format(
-                    allele_dict["poly_purity"]
-                )
-
-            table_body += config.HTML_TBL_ROW.format(
-                config.HTML_TBL_CELL.format(allele_dict["first_base"]),
-                config.HTML_TBL_CELL.format(allele_dict["read_count"]),
-                mean_quality,
-                read_fraction,
-                config.HTML_TBL_CELL.format(allele_dict["mean_polylen"]),
-                config.HTML_TBL_CELL.format(allele_dict["stdev_polylen"]),
-                config.HTML_TBL_CELL.format(allele_dict["mode_polylen"]),
-                poly_purity,
-            )
+            table_body += config.HTML_TBL_ROW.format(*self.construct_row_cells(allele_dict))
         table_header = config.HTML_TBL_HEADER.format(
             *config.TABLE_HEADERS
         )  # Generate table headers
         table_html = f"{table_header}{table_body}"
         return table_html
 
+    def construct_row_cells(self, allele_dict):
+        """
+        Construct the html table cells for an allele, with formatting dependent on whether
+        metrics meet defined thresholds
+
+            :param allele_dict (dict):  Calculated metrics for the allele
+            :return cells (list):       Html of each cell, in the order of config.TABLE_HEADERS
+        """
+        if allele_dict["mean_quality"] >= config.THRESHOLDS["mean_quality"]:
+            mean_quality = config.HTML_TBL_CELL_PASS.format(
+                allele_dict["mean_quality"]
+            )
+        else:
+            mean_quality = config.HTML_TBL_CELL_FAIL.format(
+                allele_dict["mean_quality"]
+            )
+
+        if allele_dict["read_fraction"] >= config.THRESHOLDS["read_fraction"]:
+            read_fraction = config.HTML_TBL_CELL_PASS.format(
+                allele_dict["read_fraction"]
+            )
+        else:
+            read_fraction = config.HTML_TBL_CELL_FAIL.format(
+                allele_dict["read_fraction"]
+            )
+
+        if allele_dict["poly_purity"] >= config.THRESHOLDS["poly_purity"]:
+            poly_purity = config.HTML_TBL_CELL_PASS.format(
+                allele_dict["poly_purity"]
+            )
+        else:
+            poly_purity = config.HTML_TBL_CELL_FAIL.format(
+                allele_dict["poly_purity"]
+            )
+
+        if allele_dict["strand_bias_p"] >= config.THRESHOLDS["strand_bias_p"]:
+            strand_bias_p = config.HTML_TBL_CELL_PASS.format(
+                allele_dict["strand_bias_p"]
+            )
+        else:
+            strand_bias_p = config.HTML_TBL_CELL_FAIL.format(
+                allele_dict["strand_bias_p"]
+            )
+
+        return [
+            config.HTML_TBL_CELL.format(allele_dict["first_base"]),
+            config.HTML_TBL_CELL.format(allele_dict["read_count"]),
+            mean_quality,
+            read_fraction,
+            config.HTML_TBL_CELL.format(allele_dict["mean_polylen"]),
+            config.HTML_TBL_CELL.format(allele_dict["stdev_polylen"]),
+            config.HTML_TBL_CELL.format(allele_dict["mode_polylen"]),
+            poly_purity,
+            config.HTML_TBL_CELL.format(allele_dict["forward_count"]),
+            config.HTML_TBL_CELL.format(allele_dict["reverse_count"]),
+            strand_bias_p,
+            config.HTML_TBL_CELL.format(allele_dict["median_read_pos"]),
+            config.HTML_TBL_CELL.format(allele_dict["read_end_fraction"]),
+        ]
+
     def construct_readcount_html(self, total_read_count):
         """
         Construct html for total read count header with colour dependent upon whether it passes
@@ -319,146 +811,1601 @@ class PolyEdge:
 
         return total_rc_html
 
-    def create_htmlfile(self, table_html, total_rc_html):
+    def construct_read_filter_html(self):
+        """
+        Construct html for the table of read filtering outcomes
+
+            :return read_filter_html (str): String containing the read filtering table html
+        """
+        return "".join(
+            config.HTML_FILTER_ROW.format(label, self.read_filter_counts.get(reason, 0))
+            for reason, label in config.READ_FILTER_REASONS.items()
+        )
+
+    def sampling_rows(self):
+        """
+        Rows of the table of confidence intervals for a sampled locus, one per allele
+
+            :return rows (list):    List of rows, in the order of config.SAMPLING_HEADERS
+        """
+        return [
+            [allele] + fraction + (purity or ["", ""])
+            for allele, (fraction, purity) in self.sampling["intervals"].items()
+        ]
+
+    def construct_sampling_html(self):
+        """
+        Construct html for the numbers of reads sampled and available, and the table of
+        confidence intervals, if the reads were sampled
+
+            :return sampling_html (str):    String containing the sampling table html, empty if
+                                            the reads were not sampled
+        """
+        if not self.sampling:
+            return ""
+        sampling_html = "".join(
+            config.HTML_FILTER_ROW.format(header, self.sampling[key])
+            for header, key in zip(config.SAMPLING_COUNT_HEADERS,
+                                   ["reads_sampled", "reads_available"])
+        )
+        sampling_html += config.HTML_ROW.format(
+            "".join(config.HTML_HEADER_CELL.format(header) for header in config.SAMPLING_HEADERS)
+        )
+        for row in self.sampling_rows():
+            sampling_html += config.HTML_ROW.format(
+                "".join(config.HTML_TBL_CELL.format(value) for value in row)
+            )
+        return sampling_html
+
+    @timed_stage("create_htmlfile")
+    def create_htmlfile(self, table_html, total_rc_html, read_filter_html):
         """
         Write metrics to html. Load template using jinja2, then write to new file, filling the
         place holders in the template with the specified placeholder values
 
             :param table_html (str): String containing the table html
             :return total_rc_html (str):    String containing the total read count html
+            :param read_filter_html (str):  String containing the read filtering table html
         """
-        template = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(config.TEMPLATE_DIR), autoescape=True
-        ).get_template("template_report.html")
-
-        logo_string = open(config.LOGOPATH, 'r', encoding="utf-8").read()
-
         html_placeholders = {
             "timestamp": self.timestamp,
-            "app_version": git_tag(),
             "sample_name": self.sample_name,
             "total_read_count_html": total_rc_html,
             "gene": self.gene,
             "chromosome": self.chrom,
             "position": self.variant_pos,
             "results_table_html": table_html,
-            "logo_string": logo_string,
-            "parameters_str": config.PARAMS_STR,
+            "read_filter_str": config.READ_FILTER_STR,
+            "read_filter_html": read_filter_html,
+            "sampling_str": config.SAMPLING_STR,
+            "sampling_html": self.construct_sampling_html(),
             "footer_html": self.footer_html,
-        } | config.INTERP_THRESHS
-
-        with open(self.html_path, "w", encoding="utf-8") as html_file:
-            html_file.write(template.render(html_placeholders))
-        html_file.close()
+        }
+        write_html(config.REPORT_TEMPLATE, html_placeholders, self.html_path)
 
+    @timed_stage("create_pdffile")
     def create_pdffile(self):
         """
         Write metrics to pdf, specifying pdfkit options to turn off standard out and to allow
         pdfkit access to logo image
         """
-        pdfkit.from_file(
-            self.html_path,
-            self.pdf_path,
-            options={
-                "enable-local-file-access": None,
-                "quiet": "",
-                "encoding": "UTF-8",
-            },
-        )
+        self.pdf_renderer.submit([self.html_path], self.pdf_path)
 
 
-def arg_parse():
+class PolyEdgePanel:
     """
-    Parse arguments supplied by the command line. Create argument parser, define command line
-    arguments, then parse supplied command line arguments using the created argument parser
+    Class for processing multiple poly stretches (loci) from a single bam file. The bam file is
+    opened once and the loci are processed in coordinate order, producing either one set of output
+    files per locus or one combined set of output files for the whole panel
 
-        :return (Namespace object): parsed command line attributes
-    """
-    parser = argparse.ArgumentParser(
-        description="Determine whether a known variant is present at "
-        "the base preceding a poly stretch in a BAM file"
-    )
-    parser.add_argument(
-        "-A",
-        config.PARAMS["anchor_length"],
-        type=int,
-        nargs="?",
-        default=2,
-        const=2,
-        help="Length of anchor sequence",
-        required=False,
-    )  # Optional arg
-    requirednamed = parser.add_argument_group("Required named arguments")
-    requirednamed.add_argument(
-        "-B",
-        config.PARAMS["bam"],
-        type=validate_path,
-        help="Bam file to analyse",
-        required=True,
-    )
-    requirednamed.add_argument(
-        "-I",
-        config.PARAMS["bai"],
-        type=validate_path,
-        help="Bam index file",
-        required=True,
-    )
-    requirednamed.add_argument(
-        "-G", config.PARAMS["gene"], type=str, help="Gene of interest", required=True
-    )
-    requirednamed.add_argument(
-        "-S",
-        config.PARAMS["poly_start"],
-        type=int,
-        help="Start position of poly stretch",
-        required=True,
-    )
-    requirednamed.add_argument(
-        "-E",
-        config.PARAMS["poly_end"],
-        type=int,
-        help="End position of poly stretch",
-        required=True,
-    )
-    requirednamed.add_argument(
-        "-C",
-        config.PARAMS["chrom"],
-        type=int,
-        help="Chromosome of interest",
-        required=True,
-    )
-    return vars(parser.parse_args())
+        generate_output()
+            Call methods required to generate all output files for the sample provided
+            :return results (list):     List of (PolyEdge, allele_list, total_read_count) tuples,
+                                        one per locus
 
+        calculate_metrics()
+            Calculate metrics per allele for every locus
+            :return results (list):     List of (PolyEdge, allele_list, total_read_count) tuples,
+                                        one per locus
 
-def validate_path(path):
-    """
-    Check path exists
+        iter_metrics()
+            Calculate metrics per allele for every locus, fetching reads once per cluster of
+            nearby loci, and yielding each locus as soon as its metrics are calculated
+            :return results (generator):    (PolyEdge, allele_list, total_read_count) tuples,
+                                            one per locus
 
-        :param path (str):  Input path to validate
-    """
-    if os.path.exists(path):
-        return path
-    else:
-        raise argparse.ArgumentTypeError(f"{path} is not a valid path")
+        write_output(results)
+            Write the combined csv, html and pdf output files from calculated metrics
+            :param results (list):      List of (PolyEdge, allele_list, total_read_count) tuples
 
+        clusters(polyedges)
+            Group the loci into clusters of nearby loci on the same chromosome
+            :return clusters (list):    List of lists of PolyEdge objects
 
-def git_tag():
-    """Obtain git tag from current commit
+        create_csvfile(results)
+            Write metrics for all loci to a single csv
+            :param results (list):      List of (PolyEdge, allele_list, total_read_count) tuples
 
-    :return stdout (str):  String containing stdout, with newline characters removed
+        create_htmlfile(results)
+            Write metrics for all loci to a single html
+            :param results (list):      List of (PolyEdge, allele_list, total_read_count) tuples
+
+        create_pdffile()
+            Write combined metrics to pdf
+
+        create_combined_pdffile()
+            Write the per-locus html reports to a single pdf, with one page per locus
     """
-    filepath = os.path.dirname(os.path.realpath(__file__))
-    cmd = f"git -C {filepath} describe --tags"
 
-    proc = subprocess.Popen(
-        [cmd], stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True
-    )
-    out, _ = proc.communicate()
-    return out.rstrip().decode("utf-8")
+    def __init__(self, bamfile, bam_index, loci, anchor_length, combined=False, reader=None,
+                 combined_pdf=False, **options):
+        """
+        Constructor for PolyEdgePanel class
+
+            :param bamfile (str):       Bam file to analyse
+            :param bam_index (str):     Bam index file
+            :param loci (list):         List of (gene, chrom, poly) tuples, one per locus
+            :param anchor_length (int): Length of anchor sequence
+            :param combined (bool):     Write one combined set of output files rather than one
+                                        set per locus
+            :param reader (obj):        Optional open pysam AlignmentFile to fetch reads from,
+                                        which is left open after generating output
+            :param combined_pdf (bool): Write the per-locus html reports to a single pdf rather
+                                        than one pdf per locus
+            :param options (dict):      Keyword arguments passed to PolyEdge for every locus
+                                        (engine, read_filters, min_mapq, output_dir,
+                                        pdf_renderer, output_pipeline), and used
+                                        to open the bam file (threads, reference, ref_cache)
+        """
+        self.bamfile = bamfile
+        self.loci_count = len(loci)
+        self.anchor_length = anchor_length
+        self.combined = combined
+        self.combined_pdf = combined_pdf
+        # Share one renderer across loci, so that a deferred renderer collects every report
+        options["pdf_renderer"] = options.get("pdf_renderer") or PdfRenderer()
+        self.pdf_renderer = options["pdf_renderer"]
+        self.output_pipeline = options.get("output_pipeline")
+        options["timings"] = options.get("timings") or StageTimings()
+        self.timings = options["timings"]
+        self.read_filters = list(options.get("read_filters", config.DEFAULT_READ_FILTERS))
+        self.min_mapq = options.get("min_mapq", config.DEFAULT_MIN_MAPQ)
+        # Open bam file once for all loci
+        self.owns_reader = reader is None
+        self.reader = reader or open_alignment(
+            bamfile,
+            bam_index,
+            options.get("threads", config.DEFAULT_THREADS),
+            options.get("reference"),
+            options.get("ref_cache"),
+        )
+        self.polyedges = []
+        for gene, chrom, poly in sort_loci(loci, self.reader.references):
+            polyedge = PolyEdge(
+                bamfile, bam_index, gene, chrom, poly, anchor_length, reader=self.reader,
+                **options,
+            )
+            # Include the position so that loci within the same gene do not overwrite each other
+            polyedge.set_output_string(
+                f"{polyedge.bamfile_prefix}.{gene}_{polyedge.variant_pos}_polyedge"
+            )
+            self.polyedges.append(polyedge)
+        self.bamfile_prefix = os.path.splitext(bamfile)[0].split("/")[-1]
+        self.baifile_prefix = os.path.splitext(bam_index)[0].split("/")[-1]
+        self.sample_name = self.bamfile_prefix.split(".")[0]
+        self.output_string = f"{self.bamfile_prefix}.panel_polyedge"
+        self.timestamp = datetime.datetime.now().strftime("%d-%B-%Y %H:%M")
+        self.output_dir = options.get("output_dir") or os.getcwd()
+        self.csv_path = os.path.join(self.output_dir, f"{self.output_string}.csv")
+        self.html_path = os.path.join(self.output_dir, f"{self.output_string}.html")
+        self.pdf_path = os.path.join(self.output_dir, f"{self.output_string}.pdf")
+        self.timing_path = os.path.join(self.output_dir, f"{self.output_string}.timing.json")
+        self.profile_path = os.path.join(self.output_dir, f"{self.output_string}.pstats")
+        self.footer_html = config.PANEL_HTML_LIST.format(
+            config.PARAMS["bam"],
+            self.bamfile_prefix,
+            config.PARAMS["bai"],
+            self.baifile_prefix,
+            config.PARAMS["loci"],
+            self.loci_count,
+            config.PARAMS["anchor_length"],
+            self.anchor_length,
+            config.PARAMS["read_filters"],
+            " ".join(self.read_filters),
+            config.PARAMS["min_mapq"],
+            self.min_mapq,
+        )
+
+    def generate_output(self):
+        """
+        Call methods required to generate all output files for the sample provided. Unless the
+        output is combined, the output files for each locus are written (by the output pipeline
+        if one was supplied) as soon as its metrics are calculated
+
+            :return results (list):     List of (PolyEdge, allele_list, total_read_count) tuples,
+                                        one per locus
+        """
+        if self.combined:
+            results = self.calculate_metrics()
+            for polyedge, allele_list, total_read_count in results:
+                polyedge.store_results(allele_list, total_read_count)
+            submit_output(self.output_pipeline, self.output_string, self.write_output, results)
+        else:
+            finished = {}
+            for polyedge, allele_list, total_read_count in self.timings.timed(
+                "calculate_metrics", self.iter_metrics()
+            ):
+                finished[polyedge] = (allele_list, total_read_count)
+                polyedge.store_results(allele_list, total_read_count)
+                submit_output(self.output_pipeline, polyedge.output_string, polyedge.write_output,
+                              allele_list, total_read_count, not self.combined_pdf)
+            results = [(polyedge, *finished[polyedge]) for polyedge in self.polyedges]
+            if self.combined_pdf:
+                # The combined pdf is rendered from the html reports of every locus
+                if self.output_pipeline:
+                    self.output_pipeline.drain()
+                submit_output(self.output_pipeline, self.output_string,
+                              self.create_combined_pdffile)
+        if self.owns_reader:
+            self.reader.close()
+        return results
+
+    def write_output(self, results):
+        """
+        Write the combined csv, html and pdf output files from calculated metrics
+
+            :param results (list):      List of (PolyEdge, allele_list, total_read_count) tuples
+        """
+        self.create_csvfile(results)
+        self.create_htmlfile(results)
+        self.create_pdffile()
+
+    @timed_stage("calculate_metrics")
+    def calculate_metrics(self):
+        """
+        Calculate metrics per allele for every locus
+
+            :return results (list):     List of (PolyEdge, allele_list, total_read_count) tuples,
+                                        one per locus, in coordinate order
+        """
+        finished = {
+            polyedge: (allele_list, total_read_count)
+            for polyedge, allele_list, total_read_count in self.iter_metrics()
+        }
+        return [(polyedge, *finished[polyedge]) for polyedge in self.polyedges]
+
+    def iter_metrics(self):
+        """
+        Calculate metrics per allele for every locus, yielding each locus as soon as its metrics
+        are calculated: loci found in the result cache first, then the remaining loci in
+        coordinate order. Loci within config.CLUSTER_DISTANCE of each other are clustered, and
+        reads are fetched once per cluster. Each read is passed to every locus in the cluster
+        whose fetch window it overlaps, using an active set of loci swept along the chromosome,
+        so that each read is decoded once
+
+            :return results (generator):    (PolyEdge, allele_list, total_read_count) tuples,
+                                            one per locus
+        """
+        # Loci found in the result cache are not fetched
+        uncached = []
+        for polyedge in self.polyedges:
+            cached = polyedge.load_cached()
+            if cached is None:
+                uncached.append(polyedge)
+            else:
+                yield (polyedge, *cached)
+        if self.polyedges and self.polyedges[0].sampled:
+            # Each locus is sampled from its own reads, so is fetched separately
+            for polyedge in uncached:
+                yield (polyedge, *polyedge.calculate_sampled_metrics())
+            uncached = []
+        for cluster in self.clusters(uncached):
+            allele_metrics = [polyedge.create_allele_metrics() for polyedge in cluster]
+            # Loci not yet reached by the sweep, in order of fetch window start
+            pending = sorted(range(len(cluster)), key=lambda index: cluster[index].fetch_window)
+            active = []
+            reads = cluster[0].fetch(
+                cluster[pending[0]].fetch_window[0],
+                max(polyedge.fetch_window[1] for polyedge in cluster),
+            )
+            for read in reads:
+                read_start = read.reference_start
+                # Unmapped reads with a position are fetched as overlapping that position only
+                read_end = read.reference_end or read_start + 1
+                while pending and cluster[pending[0]].fetch_window[0] < read_end:
+                    active.append(pending.pop(0))
+                # Reads are sorted by start, so loci ending before this read are finished with
+                active = [
+                    index for index in active if cluster[index].fetch_window[1] > read_start
+                ]
+                for index in active:
+                    if cluster[index].fetch_window[0] < read_end:
+                        cluster[index].accumulate(read, allele_metrics[index])
+            for polyedge, locus_metrics in zip(cluster, allele_metrics):
+                yield (polyedge, *polyedge.summarise(locus_metrics))
+
+    def clusters(self, polyedges):
+        """
+        Group (coordinate sorted) loci into clusters of loci on the same contig within
+        config.CLUSTER_DISTANCE of each other
+
+            :param polyedges (list):    List of PolyEdge objects, in coordinate order
+            :return clusters (list):    List of lists of PolyEdge objects, each in order of poly
+                                        start
+        """
+        clusters = []
+        for polyedge in polyedges:
+            if (
+                clusters
+                and locus_contig(self.reader.references, clusters[-1][-1].chrom)
+                == locus_contig(self.reader.references, polyedge.chrom)
+                and polyedge.fetch_window[0]
+                - max(locus.fetch_window[1] for locus in clusters[-1])
+                <= config.CLUSTER_DISTANCE
+            ):
+                clusters[-1].append(polyedge)
+            else:
+                clusters.append([polyedge])
+        return clusters
+
+    @timed_stage("create_csvfile")
+    def create_csvfile(self, results):
+        """
+        Write metrics for all loci to a single csv file, with the total read count of each locus
+        given alongside the allele rows
+
+            :param results (list):      List of (PolyEdge, allele_list, total_read_count) tuples
+        """
+        with open(self.csv_path, "wt", encoding="utf-8") as file:
+            writer = csv.writer(file, delimiter=",")
+            writer.writerow(["Created by", f"{config.APP_NAME}"])
+            writer.writerow(["Version", git_tag()])
+            writer.writerow(["Date", self.timestamp])
+            writer.writerow(["Sample", self.sample_name])
+            writer.writerow(["Loci", self.loci_count])
+            writer.writerow([])
+            writer.writerow([config.PARAMS_STR])
+            writer.writerow([config.PARAMS["bam"], self.bamfile_prefix])
+            writer.writerow([config.PARAMS["bai"], self.baifile_prefix])
+            writer.writerow([config.PARAMS["anchor_length"], self.anchor_length])
+            writer.writerow([config.PARAMS["read_filters"], " ".join(self.read_filters)])
+            writer.writerow([config.PARAMS["min_mapq"], self.min_mapq])
+            writer.writerow([config.PARAMS["early_stop"], self.polyedges[0].early_stop])
+            writer.writerow([config.PARAMS["max_reads"], self.polyedges[0].max_reads])
+            writer.writerow([config.PARAMS["dedup_mates"], self.polyedges[0].dedup_mates])
+            writer.writerow([])
+            writer.writerow(
+                config.GENERAL_HEADERS + config.PANEL_HEADERS + config.TABLE_HEADERS
+            )
+
+            for _, allele_list, total_read_count in results:
+                for row in allele_list:
+                    values = list(row.values())
+                    writer.writerow(
+                        values[:len(config.GENERAL_HEADERS)]
+                        + [total_read_count]
+                        + values[len(config.GENERAL_HEADERS):]
+                    )
+            writer.writerow([])
+            writer.writerow([config.READ_FILTER_STR])
+            writer.writerow(config.GENERAL_HEADERS + list(config.READ_FILTER_REASONS.values()))
+            for polyedge, _, _ in results:
+                writer.writerow(
+                    [polyedge.gene, polyedge.chrom, polyedge.variant_pos]
+                    + [polyedge.read_filter_counts.get(reason, 0)
+                       for reason in config.READ_FILTER_REASONS]
+                )
+            if any(polyedge.sampling for polyedge in self.polyedges):
+                writer.writerow([])
+                writer.writerow([config.SAMPLING_STR])
+                writer.writerow(
+                    config.GENERAL_HEADERS + config.SAMPLING_COUNT_HEADERS
+                    + config.SAMPLING_HEADERS
+                )
+                for polyedge in self.polyedges:
+                    for row in polyedge.sampling_rows():
+                        writer.writerow(
+                            [polyedge.gene, polyedge.chrom, polyedge.variant_pos,
+                             polyedge.sampling["reads_sampled"],
+                             polyedge.sampling["reads_available"]] + row
+                        )
+        file.close()
+
+    @timed_stage("create_htmlfile")
+    def create_htmlfile(self, results):
+        """
+        Write metrics for all loci to a single html, with one section per locus
+
+            :param results (list):      List of (PolyEdge, allele_list, total_read_count) tuples
+        """
+        loci = []
+        for polyedge, allele_list, total_read_count in results:
+            loci.append(
+                {
+                    "gene": polyedge.gene,
+                    "chromosome": polyedge.chrom,
+                    "position": polyedge.variant_pos,
+                    "total_read_count_html": polyedge.construct_readcount_html(
+                        total_read_count
+                    ),
+                    "results_table_html": polyedge.construct_table_html(allele_list),
+                    "read_filter_html": polyedge.construct_read_filter_html(),
+                    "sampling_html": polyedge.construct_sampling_html(),
+                }
+            )
+        html_placeholders = {
+            "timestamp": self.timestamp,
+            "sample_name": self.sample_name,
+            "loci": loci,
+            "read_filter_str": config.READ_FILTER_STR,
+            "sampling_str": config.SAMPLING_STR,
+            "footer_html": self.footer_html,
+        }
+        write_html(config.PANEL_TEMPLATE, html_placeholders, self.html_path)
+
+    @timed_stage("create_pdffile")
+    def create_pdffile(self):
+        """
+        Write combined metrics to pdf
+        """
+        self.pdf_renderer.submit([self.html_path], self.pdf_path)
+
+    @timed_stage("create_pdffile")
+    def create_combined_pdffile(self):
+        """
+        Write the per-locus html reports to a single pdf, with one page per locus
+        """
+        self.pdf_renderer.submit(
+            [polyedge.html_path for polyedge in self.polyedges], self.pdf_path
+        )
+
+
+class PolyEdgeSweep:
+    """
+    Class for comparing the metrics for a single locus across a range of anchor lengths. Reads
+    are fetched once for all anchor lengths, and the query positions of the roi for every anchor
+    length are resolved with a single walk of each read's CIGAR, with separate running statistics
+    kept for each anchor length. Writes one csv, html and pdf comparing the anchor lengths
+
+        generate_output()
+            Call methods required to generate all output files for the sample provided
+            :return results (list):     List of (PolyEdge, allele_list, total_read_count) tuples,
+                                        one per anchor length
+
+        write_output(results)
+            Write the csv, html and pdf comparing the anchor lengths from calculated metrics
+            :param results (list):      List of (PolyEdge, allele_list, total_read_count) tuples
+
+        calculate_metrics()
+            Calculate metrics per allele for every anchor length from a single pass of the reads
+            :return results (list):     List of (PolyEdge, allele_list, total_read_count) tuples,
+                                        one per anchor length
+
+        accumulate(read, polyedges, allele_metrics)
+            Add a read to the running statistics of each anchor length whose fetch window it
+            overlaps, decoding the read at most once
+
+        create_csvfile(results)
+            Write the metrics for all anchor lengths to a single csv table
+
+        construct_table_html(results)
+            Construct the html table comparing the metrics for all anchor lengths
+            :return table_html (str):   String containing the table html
+
+        construct_read_filter_html()
+            Construct html for the table of read filtering outcomes for all anchor lengths
+            :return read_filter_html (str): String containing the read filtering table html
+
+        create_htmlfile(results)
+            Write the metrics for all anchor lengths to a single html
+
+        create_pdffile()
+            Write the comparison to pdf
+    """
+
+    def __init__(self, bamfile, bam_index, gene, chrom, poly, anchor_lengths, **options):
+        """
+        Constructor for PolyEdgeSweep class
+
+            :param bamfile (str):           Bam file to analyse
+            :param bam_index (str):         Bam index file
+            :param gene (str) :             Gene of interest
+            :param chrom (str):             Chromosome of interest
+            :param poly (tuple):            Contains start and end position of poly stretch
+            :param anchor_lengths (list):   Anchor lengths to compare
+            :param options (dict):          Keyword arguments passed to PolyEdge for every anchor
+                                            length
+        """
+        options["pdf_renderer"] = options.get("pdf_renderer") or PdfRenderer()
+        self.pdf_renderer = options["pdf_renderer"]
+        self.output_pipeline = options.get("output_pipeline")
+        options["timings"] = options.get("timings") or StageTimings()
+        self.timings = options["timings"]
+        self.anchor_lengths = sorted(set(anchor_lengths))
+        self.polyedges = [
+            PolyEdge(bamfile, bam_index, gene, chrom, poly, anchor_length, **options)
+            for anchor_length in self.anchor_lengths
+        ]
+        first = self.polyedges[0]
+        self.gene = gene
+        self.chrom = chrom
+        self.poly = poly
+        self.read_filters = first.read_filters
+        self.min_mapq = first.min_mapq
+        self.bamfile_prefix = first.bamfile_prefix
+        self.baifile_prefix = first.baifile_prefix
+        self.sample_name = first.sample_name
+        self.timestamp = first.timestamp
+        self.output_string = f"{self.bamfile_prefix}.{gene}_anchor_sweep_polyedge"
+        for polyedge in self.polyedges:
+            # Only the per-read evidence is written per anchor length
+            polyedge.set_output_string(
+                f"{self.bamfile_prefix}.{gene}_anchor_{polyedge.anchor_length}_polyedge"
+            )
+        self.csv_path = os.path.join(first.output_dir, f"{self.output_string}.csv")
+        self.html_path = os.path.join(first.output_dir, f"{self.output_string}.html")
+        self.pdf_path = os.path.join(first.output_dir, f"{self.output_string}.pdf")
+        self.timing_path = os.path.join(first.output_dir, f"{self.output_string}.timing.json")
+        self.profile_path = os.path.join(first.output_dir, f"{self.output_string}.pstats")
+        self.footer_html = config.HTML_LIST.format(
+            config.PARAMS["bam"],
+            self.bamfile_prefix,
+            config.PARAMS["bai"],
+            self.baifile_prefix,
+            config.PARAMS["gene"],
+            self.gene,
+            config.PARAMS["chrom"],
+            self.chrom,
+            config.PARAMS["poly_start"],
+            self.poly[0],
+            config.PARAMS["poly_end"],
+            self.poly[1],
+            config.PARAMS["anchor_sweep"],
+            " ".join(str(anchor_length) for anchor_length in self.anchor_lengths),
+            config.PARAMS["read_filters"],
+            " ".join(self.read_filters),
+            config.PARAMS["min_mapq"],
+            self.min_mapq,
+        )
+
+    def generate_output(self):
+        """
+        Call methods required to generate all output files for the sample provided
+
+            :return results (list):     List of (PolyEdge, allele_list, total_read_count) tuples,
+                                        one per anchor length
+        """
+        results = self.calculate_metrics()
+        for polyedge, allele_list, total_read_count in results:
+            polyedge.store_results(allele_list, total_read_count)
+        submit_output(self.output_pipeline, self.output_string, self.write_output, results)
+        return results
+
+    def write_output(self, results):
+        """
+        Write the csv, html and pdf comparing the anchor lengths from calculated metrics
+
+            :param results (list):      List of (PolyEdge, allele_list, total_read_count) tuples
+        """
+        self.create_csvfile(results)
+        self.create_htmlfile(results)
+        self.create_pdffile()
+
+    @timed_stage("calculate_metrics")
+    def calculate_metrics(self):
+        """
+        Calculate metrics per allele for every anchor length from a single pass of the reads.
+        Reads are fetched across the fetch windows of all anchor lengths not found in the result
+        cache
+
+            :return results (list):     List of (PolyEdge, allele_list, total_read_count) tuples,
+                                        one per anchor length
+        """
+        results = {polyedge: polyedge.load_cached() for polyedge in self.polyedges}
+        polyedges = [polyedge for polyedge in self.polyedges if results[polyedge] is None]
+        if polyedges:
+            # The roi of every anchor length, in ascending order as required by the resolver
+            self.ref_positions = sorted(
+                {position for polyedge in polyedges
+                 for position in (polyedge.roi_start, polyedge.roi_end)}
+            )
+            allele_metrics = [polyedge.create_allele_metrics() for polyedge in polyedges]
+            # Reads are always fetched through the first PolyEdge, so the bam is opened once
+            reads = self.polyedges[0].fetch(
+                min(polyedge.fetch_window[0] for polyedge in polyedges),
+                max(polyedge.fetch_window[1] for polyedge in polyedges),
+            )
+            for read in reads:
+                self.accumulate(read, polyedges, allele_metrics)
+            for polyedge, locus_metrics in zip(polyedges, allele_metrics):
+                results[polyedge] = polyedge.summarise(locus_metrics)
+        return [(polyedge, *results[polyedge]) for polyedge in self.polyedges]
+
+    def accumulate(self, read, polyedges, allele_metrics):
+        """
+        Add a read to the running statistics of each anchor length whose fetch window it
+        overlaps (i.e. each anchor length that would have fetched it on its own). The CIGAR is
+        walked, and the sequence and qualities decoded, at most once
+
+            :param read (obj):              pysam AlignedSegment
+            :param polyedges (list):        PolyEdge object for each anchor length
+            :param allele_metrics (list):   Running statistics for each anchor length
+        """
+        read_start = read.reference_start
+        # Unmapped reads with a position are fetched as overlapping that position only
+        read_end = read.reference_end or read_start + 1
+        query_positions = None
+        query_sequence = query_qualities = None
+        for polyedge, locus_metrics in zip(polyedges, allele_metrics):
+            if not (polyedge.fetch_window[0] < read_end and read_start < polyedge.fetch_window[1]):
+                continue
+            outcome = polyedge.filter_read(read)
+            if not outcome:
+                if query_positions is None:
+                    query_positions = dict(zip(
+                        self.ref_positions,
+                        metrics.resolve_query_positions(
+                            read.cigartuples, read_start, self.ref_positions
+                        ),
+                    ))
+                seq_start = query_positions[polyedge.roi_start]
+                seq_end = query_positions[polyedge.roi_end]
+                if seq_start and seq_end:  # If anchored
+                    if query_sequence is None:
+                        query_sequence = read.query_sequence
+                        query_qualities = read.query_qualities
+                    outcome = polyedge.add_poly(read, query_sequence, query_qualities,
+                                                seq_start, seq_end, locus_metrics)
+                else:
+                    outcome = "not_anchored"
+            locus_metrics.read_filter_counts[outcome] += 1
+
+    @timed_stage("create_csvfile")
+    def create_csvfile(self, results):
+        """
+        Write the metrics for all anchor lengths to a single csv table, with the anchor length and
+        total read count given alongside the allele rows
+
+            :param results (list):      List of (PolyEdge, allele_list, total_read_count) tuples
+        """
+        with open(self.csv_path, "wt", encoding="utf-8") as file:
+            writer = csv.writer(file, delimiter=",")
+            writer.writerow(["Created by", f"{config.APP_NAME}"])
+            writer.writerow(["Version", git_tag()])
+            writer.writerow(["Date", self.timestamp])
+            writer.writerow(["Sample", self.sample_name])
+            writer.writerow([])
+            writer.writerow([config.PARAMS_STR])
+            writer.writerow([config.PARAMS["bam"], self.bamfile_prefix])
+            writer.writerow([config.PARAMS["bai"], self.baifile_prefix])
+            writer.writerow([config.PARAMS["gene"], self.gene])
+            writer.writerow([config.PARAMS["chrom"], self.chrom])
+            writer.writerow([config.PARAMS["poly_start"], self.poly[0]])
+            writer.writerow([config.PARAMS["poly_end"], self.poly[1]])
+            writer.writerow([config.PARAMS["anchor_sweep"], *self.anchor_lengths])
+            writer.writerow([config.PARAMS["read_filters"], " ".join(self.read_filters)])
+            writer.writerow([config.PARAMS["min_mapq"], self.min_mapq])
+            writer.writerow([config.PARAMS["dedup_mates"], self.polyedges[0].dedup_mates])
+            writer.writerow([])
+            writer.writerow(
+                config.SWEEP_HEADERS + config.GENERAL_HEADERS + config.PANEL_HEADERS
+                + config.TABLE_HEADERS
+            )
+            for polyedge, allele_list, total_read_count in results:
+                for row in allele_list:
+                    values = list(row.values())
+                    writer.writerow(
+                        [polyedge.anchor_length]
+                        + values[:len(config.GENERAL_HEADERS)]
+                        + [total_read_count]
+                        + values[len(config.GENERAL_HEADERS):]
+                    )
+            writer.writerow([])
+            writer.writerow([config.READ_FILTER_STR])
+            writer.writerow(config.SWEEP_HEADERS + list(config.READ_FILTER_REASONS.values()))
+            for polyedge in self.polyedges:
+                writer.writerow(
+                    [polyedge.anchor_length]
+                    + [polyedge.read_filter_counts.get(reason, 0)
+                       for reason in config.READ_FILTER_REASONS]
+                )
+        file.close()
+
+    def construct_table_html(self, results):
+        """
+        Construct the html table comparing the metrics for all anchor lengths, with one row per
+        allele per anchor length
+
+            :param results (list):      List of (PolyEdge, allele_list, total_read_count) tuples
+            :return table_html (str):   String containing the table html
+        """
+        table_html = config.HTML_ROW.format("".join(
+            config.HTML_HEADER_CELL.format(header)
+            for header in config.SWEEP_HEADERS + config.PANEL_HEADERS + config.TABLE_HEADERS
+        ))
+        for polyedge, allele_list, total_read_count in results:
+            for allele_dict in allele_list:
+                table_html += config.HTML_ROW.format("".join(
+                    [config.HTML_TBL_CELL.format(polyedge.anchor_length),
+                     polyedge.construct_readcount_html(total_read_count)]
+                    + polyedge.construct_row_cells(allele_dict)
+                ))
+        return table_html
+
+    def construct_read_filter_html(self):
+        """
+        Construct html for the table of read filtering outcomes, with one column per anchor length
+
+            :return read_filter_html (str): String containing the read filtering table html
+        """
+        read_filter_html = config.HTML_ROW.format("".join(
+            config.HTML_HEADER_CELL.format(header)
+            for header in config.SWEEP_HEADERS + self.anchor_lengths
+        ))
+        for reason, label in config.READ_FILTER_REASONS.items():
+            read_filter_html += config.HTML_ROW.format("".join(
+                [config.HTML_HEADER_CELL.format(label)]
+                + [config.HTML_TBL_CELL.format(polyedge.read_filter_counts.get(reason, 0))
+                   for polyedge in self.polyedges]
+            ))
+        return read_filter_html
+
+    @timed_stage("create_htmlfile")
+    def create_htmlfile(self, results):
+        """
+        Write the metrics for all anchor lengths to a single html
+
+            :param results (list):      List of (PolyEdge, allele_list, total_read_count) tuples
+        """
+        html_placeholders = {
+            "timestamp": self.timestamp,
+            "sample_name": self.sample_name,
+            "gene": self.gene,
+            "chromosome": self.chrom,
+            "position": self.polyedges[0].variant_pos,
+            "results_table_html": self.construct_table_html(results),
+            "read_filter_str": config.READ_FILTER_STR,
+            "read_filter_html": self.construct_read_filter_html(),
+            "footer_html": self.footer_html,
+        }
+        write_html(config.SWEEP_TEMPLATE, html_placeholders, self.html_path)
+
+    @timed_stage("create_pdffile")
+    def create_pdffile(self):
+        """
+        Write the comparison to pdf
+        """
+        self.pdf_renderer.submit([self.html_path], self.pdf_path)
+
+
+class PdfRenderer:
+    """
+    Class for rendering html reports to pdf with wkhtmltopdf. Reports are either rendered as they
+    are submitted, or queued (jobs) to be rendered elsewhere, e.g. by the main process when
+    samples are analysed in worker processes in batch mode
+
+        submit(html_paths, pdf_path)
+            Render html reports to a pdf, or queue them to be rendered if deferred
+            :param html_paths (list):   Paths of html files to render, in page order
+            :param pdf_path (str):      Path of pdf file to write
+    """
+
+    def __init__(self, deferred=False, enabled=True):
+        """
+        Constructor for PdfRenderer class
+
+            :param deferred (bool):     Queue reports as (html_paths, pdf_path) jobs rather than
+                                        rendering them
+            :param enabled (bool):      Write pdf files. If False, submitted reports are ignored
+        """
+        self.deferred = deferred
+        self.enabled = enabled
+        self.jobs = []
+
+    def submit(self, html_paths, pdf_path):
+        """
+        Render html reports to a pdf, or queue them to be rendered if deferred
+
+            :param html_paths (list):   Paths of html files to render, in page order
+            :param pdf_path (str):      Path of pdf file to write
+        """
+        if not self.enabled:
+            return
+        if self.deferred:
+            self.jobs.append((html_paths, pdf_path))
+        else:
+            write_pdf(html_paths, pdf_path)
+
+
+def write_html(template_name, html_placeholders, html_path):
+    """
+    Load template using jinja2, then write to new file, filling the place holders in the template
+    with the specified placeholder values and those common to all reports
+
+        :param template_name (str):         Name of template within the template directory
+        :param html_placeholders (dict):    Report-specific placeholder values
+        :param html_path (str):             Path of html file to write
+    """
+    template = load_template(template_name)
+
+    html_placeholders = {
+        "app_version": git_tag(),
+        "logo_string": load_logo(),
+        "parameters_str": config.PARAMS_STR,
+    } | html_placeholders | config.INTERP_THRESHS
+
+    with open(html_path, "w", encoding="utf-8") as html_file:
+        html_file.write(template.render(html_placeholders))
+    html_file.close()
+
+
+@functools.lru_cache(maxsize=None)
+def load_template(template_name):
+    """
+    Load and compile a template using jinja2. Cached, so each template is only compiled once
+    per process
+
+        :param template_name (str):     Name of template within the template directory
+        :return template (obj):         Compiled jinja2 template
+    """
+    return template_environment().get_template(template_name)
+
+
+@functools.lru_cache(maxsize=None)
+def template_environment():
+    """
+    Create the jinja2 environment shared by the report templates, so that the base template they
+    extend is only compiled once per process
+
+        :return environment (obj):      jinja2 Environment loading from the template directory
+    """
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(config.TEMPLATE_DIR), autoescape=True
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def load_logo():
+    """
+    Read the base64 encoded logo. Cached, so the file is only read once per process
+
+        :return logo_string (str):  Base64 encoded logo
+    """
+    with open(config.LOGOPATH, "r", encoding="utf-8") as logo_file:
+        return logo_file.read()
+
+
+def write_pdf(html_paths, pdf_path):
+    """
+    Write html to pdf, specifying pdfkit options to turn off standard out and to allow pdfkit
+    access to logo image. Multiple html files are written to a single pdf in one wkhtmltopdf
+    process
+
+        :param html_paths (list):   Paths of html files to convert
+        :param pdf_path (str):      Path of pdf file to write
+    """
+    pdfkit.from_file(
+        html_paths,
+        pdf_path,
+        options={
+            "enable-local-file-access": None,
+            "quiet": "",
+            "encoding": "UTF-8",
+        },
+    )
+
+
+def load_loci(loci_file):
+    """
+    Read loci from a tab-separated BED-style file with columns chrom, poly_start, poly_end and
+    gene. Blank lines and lines starting with '#' (e.g. a header line) are skipped
+
+        :param loci_file (str): Path to loci file
+        :return loci (list):    List of (gene, chrom, poly) tuples, one per locus
+    """
+    loci = []
+    with open(loci_file, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 4:
+                raise ValueError(
+                    f"{loci_file} line {line_number}: expected columns chrom, poly_start, "
+                    f"poly_end and gene, got {len(fields)} column(s)"
+                )
+            chrom, poly_start, poly_end, gene = fields[:4]
+            loci.append((gene, chrom, (int(poly_start), int(poly_end))))
+    return loci
+
+
+def sort_loci(loci, references):
+    """
+    Sort loci into coordinate order, using the contig order of the bam header so that reads are
+    fetched in file order. Contigs may be named with or without a 'chr' prefix
+
+        :param loci (list):         List of (gene, chrom, poly) tuples
+        :param references (tuple):  Contig names from the bam header
+        :return loci (list):        Sorted list of (gene, chrom, poly) tuples
+    """
+    contig_order = {contig: index for index, contig in enumerate(references)}
+
+    def locus_key(locus):
+        _, chrom, poly = locus
+        contig = locus_contig(references, chrom)
+        return contig_order.get(contig, len(contig_order)), contig, poly
+
+    return sorted(loci, key=locus_key)
+
+
+def locus_contig(references, chrom):
+    """
+    Contig name of a locus in the bam header, so that loci named with and without a 'chr'
+    prefix are ordered and clustered together
+
+        :param references (tuple):  Contig names from the bam header
+        :param chrom (str):         Chromosome of interest
+        :return contig (str):       Contig name in the bam header, or chrom if it is not in the
+                                    header (reported when the locus is fetched)
+    """
+    try:
+        return resolve_contig(references, chrom)
+    except ValueError:
+        return str(chrom)
+
+
+def open_alignment(bamfile, bam_index, threads=config.DEFAULT_THREADS, reference=None,
+                   ref_cache=None):
+    """
+    Open a bam or cram file (format detected from the file contents) with htslib decompression
+    threads. For cram input, reference sequences are looked up in a local reference cache rather
+    than downloaded, populating the cache from the reference fasta if one is supplied
+
+        :param bamfile (str):       Bam or cram file
+        :param bam_index (str):     Bam or cram index file
+        :param threads (int):       Number of htslib decompression threads
+        :param reference (str):     Reference fasta (with fai index) for cram input
+        :param ref_cache (str):     Local reference cache directory. Defaults to
+                                    config.REF_CACHE_DIR unless $REF_PATH is already set
+        :return reader (obj):       Open pysam AlignmentFile
+    """
+    if ref_cache or "REF_PATH" not in os.environ:
+        ref_cache = ref_cache or config.REF_CACHE_DIR
+        # htslib only looks up reference md5s in REF_PATH, so this disables the download of
+        # reference sequences from the ENA server
+        cache_path = os.path.join(ref_cache, "%2s", "%2s", "%s")
+        os.environ["REF_PATH"] = cache_path
+        os.environ["REF_CACHE"] = cache_path
+    reader = pysam.AlignmentFile(
+        bamfile, "r", index_filename=bam_index, threads=threads, reference_filename=reference
+    )
+    if reader.is_cram and reference and ref_cache:
+        populate_ref_cache(reader.header, reference, ref_cache)
+    return reader
+
+
+def populate_ref_cache(header, reference, ref_cache):
+    """
+    Write the reference sequences listed in a cram header (SQ lines with an M5 tag) that are
+    missing from the local reference cache, taking them from the reference fasta. The cache uses
+    the htslib REF_CACHE layout ($REF_CACHE/md5[:2]/md5[2:4]/md5[4:])
+
+        :param header (obj):        pysam AlignmentHeader
+        :param reference (str):     Reference fasta (with fai index)
+        :param ref_cache (str):     Local reference cache directory
+    """
+    fasta = None
+    for sequence in header.to_dict().get("SQ", []):
+        md5 = sequence.get("M5")
+        if not md5:
+            continue
+        cache_file = os.path.join(ref_cache, md5[:2], md5[2:4], md5[4:])
+        if os.path.exists(cache_file):
+            continue
+        fasta = fasta or pysam.FastaFile(reference)
+        try:
+            seq = fasta.fetch(resolve_contig(fasta.references, sequence["SN"])).upper()
+        except ValueError:
+            continue  # Not in the reference, so left for htslib to report if needed
+        if hashlib.md5(seq.encode("ascii")).hexdigest() != md5:
+            continue
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # Written to a unique temporary file and renamed, so that concurrent runs populating the
+        # same sequence never leave a partially written file
+        file_handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix=".tmp")
+        with os.fdopen(file_handle, "w", encoding="ascii") as file:
+            file.write(seq)
+        os.replace(tmp_path, cache_file)
+    if fasta:
+        fasta.close()
+
+
+def resolve_contig(references, chrom, source="the bam header"):
+    """
+    Find the contig name used for a chromosome in a bam header (or site index), which may name
+    contigs with or without a 'chr' prefix (e.g. '2' or 'chr2')
+
+        :param references (tuple):  Contig names from the bam header
+        :param chrom (str):         Chromosome of interest
+        :param source (str):        Where the contig names are from, for the error message
+        :return contig (str):       Contig name in the bam header
+    """
+    chrom = str(chrom)
+    bare = chrom[3:] if chrom.lower().startswith("chr") else chrom
+    for contig in [chrom, bare, f"chr{bare}"]:
+        if contig in references:
+            return contig
+    raise ValueError(f"Chromosome {chrom} is not in {source}")
+
+
+def arg_parse():
+    """
+    Parse arguments supplied by the command line. Create argument parser, define command line
+    arguments, then parse supplied command line arguments using the created argument parser
+
+        :return (Namespace object): parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(
+        description="Determine whether a known variant is present at "
+        "the base preceding a poly stretch in a BAM file"
+    )
+    requirednamed = parser.add_argument_group(
+        "Required named arguments", "gene, chrom, poly_start and poly_end are not required if "
+        "--loci or --site_index is supplied"
+    )
+    requirednamed.add_argument(
+        "-B",
+        config.PARAMS["bam"],
+        type=validate_path,
+        help="Bam file to analyse",
+        required=True,
+    )
+    requirednamed.add_argument(
+        "-I",
+        config.PARAMS["bai"],
+        type=validate_path,
+        help="Bam index file",
+        required=True,
+    )
+    add_analysis_arguments(parser, requirednamed)
+    args = vars(parser.parse_args())
+    check_locus_arguments(parser, args)
+    return args
+
+
+def add_analysis_arguments(parser, requirednamed):
+    """
+    Add the arguments defining the analysis to be run on each bam file (anchor length and loci)
+    to an argument parser. Shared by the single sample and batch command line interfaces
+
+        :param parser (ArgumentParser):         Parser to add optional arguments to
+        :param requirednamed (ArgumentGroup):   Group to add the locus arguments to
+    """
+    parser.add_argument(
+        "-A",
+        config.PARAMS["anchor_length"],
+        type=int,
+        nargs="?",
+        default=2,
+        const=2,
+        help="Length of anchor sequence",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "-L",
+        config.PARAMS["loci"],
+        type=validate_path,
+        help="Tab-separated file of loci (chrom, poly_start, poly_end, gene) to analyse in a "
+        "single pass of the bam file. Replaces the gene, chrom, poly_start and poly_end arguments",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["site_index"],
+        type=validate_path,
+        help="Homopolymer site index (built with site_index.py) to take the loci from, selected "
+        "by --region or by --gene. Replaces the chrom, poly_start and poly_end arguments",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["region"],
+        type=str,
+        help="Region (chrom, chrom:start or chrom:start-end, 1-based inclusive) from which to "
+        "analyse every site in the site index. Sites are named by --gene if supplied",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["anchor_sweep"],
+        type=int,
+        nargs="+",
+        help="Compare the metrics for the single locus across these anchor lengths, from a "
+        "single pass of the bam file. Replaces the anchor_length argument",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["combined"],
+        action="store_true",
+        help="Write one combined csv, html and pdf for all loci supplied with --loci",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["engine"],
+        type=str,
+        choices=list(metrics.ENGINES),
+        default=config.DEFAULT_ENGINE,
+        help="Engine used to calculate the metrics. The numpy engine requires numpy and is faster "
+        f"for high depth loci (default: {config.DEFAULT_ENGINE})",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["read_filters"],
+        type=str,
+        nargs="*",
+        choices=list(config.READ_FILTER_FLAGS),
+        default=config.DEFAULT_READ_FILTERS,
+        help="Reject reads with these flags before decoding them "
+        f"(default: {' '.join(config.DEFAULT_READ_FILTERS)})",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["min_mapq"],
+        type=int,
+        default=config.DEFAULT_MIN_MAPQ,
+        help=f"Minimum mapping quality of reads (default: {config.DEFAULT_MIN_MAPQ})",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["dedup_mates"],
+        action="store_true",
+        help="Count each read pair once at loci where both mates span the poly, rather than "
+        "counting overlapping mates as independent reads",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["early_stop"],
+        action="store_true",
+        help="Process reads in a random order, stopping once the 95%% confidence intervals of "
+        "the read fractions and purities are clear of the thresholds",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["max_reads"],
+        type=int,
+        help="Maximum number of reads to process per locus, sampled at random from the reads "
+        "passing the read filters",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "-T",
+        config.PARAMS["threads"],
+        type=int,
+        default=config.DEFAULT_THREADS,
+        help="Number of htslib decompression threads used to read each bam/cram file "
+        f"(default: {config.DEFAULT_THREADS})",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "-R",
+        config.PARAMS["reference"],
+        type=validate_path,
+        help="Reference fasta (with fai index) used to decode cram input",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["ref_cache"],
+        type=str,
+        help="Local reference cache directory used to decode cram input, populated from "
+        f"--reference (default: {config.REF_CACHE_DIR}, unless $REF_PATH is set)",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["combined_pdf"],
+        action="store_true",
+        help="Write one pdf containing every locus supplied with --loci, alongside the per-locus "
+        "csv and html files",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["no_pdf"],
+        action="store_true",
+        help="Do not write pdf files",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["pdf_workers"],
+        type=int,
+        default=config.DEFAULT_PDF_WORKERS,
+        help="Number of threads writing the csv, html and pdf files (and so wkhtmltopdf "
+        "processes run at once) while the metrics for later loci or samples are calculated "
+        f"(default: {config.DEFAULT_PDF_WORKERS})",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["output_queue"],
+        type=int,
+        default=config.DEFAULT_OUTPUT_QUEUE,
+        help="Number of loci or samples whose output files may be queued or being written before "
+        "the calculation of metrics waits for them. If 0, output files are written as soon as "
+        f"the metrics for each locus are calculated (default: {config.DEFAULT_OUTPUT_QUEUE})",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["no_cache"],
+        action="store_true",
+        help="Do not load or store results in the result cache",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["cache_dir"],
+        type=str,
+        default=config.RESULT_CACHE_DIR,
+        help=f"Result cache directory (default: {config.RESULT_CACHE_DIR})",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["cache_size"],
+        type=int,
+        default=config.DEFAULT_CACHE_SIZE,
+        help="Maximum size of the result cache in MB, beyond which the least recently used "
+        f"results are removed (default: {config.DEFAULT_CACHE_SIZE})",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["cache_hash"],
+        action="store_true",
+        help="Identify bam files in the result cache by a hash of their contents, rather than "
+        "their path, size, modification time and index checksum",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["evidence"],
+        action="store_true",
+        help="Write the features of each counted read (read name hash, allele, poly length, first "
+        "base quality, purity, strand and mapping quality) to a .npy file per locus, which can be "
+        "re-aggregated with evidence.py",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["results_store"],
+        type=str,
+        help="SQLite results store to append the metrics for each locus to, created if it does "
+        "not exist. Query it with results_store.py",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["timing"],
+        action="store_true",
+        help="Write the time spent in each stage, read counts, reads per second and peak memory "
+        "of the process to a json file alongside the outputs",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["profile"],
+        action="store_true",
+        help="Write a cProfile stats file for the per-read loop alongside the outputs",
+        required=False,
+    )  # Optional arg
+    requirednamed.add_argument(
+        "-G", config.PARAMS["gene"], type=str, help="Gene of interest", required=False
+    )
+    requirednamed.add_argument(
+        "-S",
+        config.PARAMS["poly_start"],
+        type=int,
+        help="Start position of poly stretch",
+        required=False,
+    )
+    requirednamed.add_argument(
+        "-E",
+        config.PARAMS["poly_end"],
+        type=int,
+        help="End position of poly stretch",
+        required=False,
+    )
+    requirednamed.add_argument(
+        "-C",
+        config.PARAMS["chrom"],
+        type=str,
+        help="Chromosome of interest, with or without a 'chr' prefix",
+        required=False,
+    )
+
+
+def check_locus_arguments(parser, args):
+    """
+    Check that either a loci file or all of the single locus arguments have been supplied, exiting
+    with a usage error if not
+
+        :param parser (ArgumentParser): Parser used to parse the arguments
+        :param args (dict):             Parsed command line arguments
+    """
+    if args["region"] and not args["site_index"]:
+        parser.error(
+            f"argument {config.PARAMS['region']}: requires {config.PARAMS['site_index']}"
+        )
+    if args["site_index"] and args["loci"]:
+        parser.error(
+            f"argument {config.PARAMS['site_index']}: not allowed with {config.PARAMS['loci']}"
+        )
+    if args["site_index"] and not (args["region"] or args["gene"]):
+        parser.error(
+            f"argument {config.PARAMS['site_index']}: requires {config.PARAMS['region']} or "
+            f"{config.PARAMS['gene']}"
+        )
+    if args["loci"] and args["anchor_sweep"]:
+        parser.error(
+            f"argument {config.PARAMS['anchor_sweep']}: not allowed with {config.PARAMS['loci']}"
+        )
+    if args["anchor_sweep"] and (args["early_stop"] or args["max_reads"]):
+        parser.error(
+            f"argument {config.PARAMS['anchor_sweep']}: not allowed with "
+            f"{config.PARAMS['early_stop']} or {config.PARAMS['max_reads']}"
+        )
+    if not (args["loci"] or args["site_index"]):
+        missing = [
+            config.PARAMS[arg] for arg in ["gene", "poly_start", "poly_end", "chrom"]
+            if args[arg] is None
+        ]
+        if missing:
+            parser.error(
+                f"the following arguments are required without {config.PARAMS['loci']} or "
+                f"{config.PARAMS['site_index']}: {', '.join(missing)}"
+            )
+
+
+def build_polyedge(bamfile, bam_index, args, pdf_renderer=None, result_cache=None,
+                   timings=None, results_store=None, output_pipeline=None):
+    """
+    Create the object used to analyse a bam file from the parsed analysis arguments: a
+    PolyEdgeSweep if anchor lengths to sweep were supplied, a PolyEdgePanel if a loci file was
+    supplied (even one with a single locus) or several sites were found in the site index,
+    otherwise a PolyEdge for the single locus
+
+        :param bamfile (str):       Bam file to analyse
+        :param bam_index (str):     Bam index file
+        :param args (dict):         Parsed command line arguments
+        :param pdf_renderer (obj):  PdfRenderer used to write the pdfs (default: written
+                                    immediately)
+        :param result_cache (obj):  Optional ResultCache to load and store the metrics in
+        :param timings (obj):       StageTimings to record the time spent in each stage in
+        :param results_store (obj): Optional ResultsStore to append the metrics to
+        :param output_pipeline (obj):   Optional OutputPipeline to write the output files with
+        :return polyedge (obj):     PolyEdge, PolyEdgePanel or PolyEdgeSweep object
+    """
+    options = analysis_options(args)
+    options["pdf_renderer"] = pdf_renderer
+    options["result_cache"] = result_cache
+    options["timings"] = timings
+    options["results_store"] = results_store
+    options["output_pipeline"] = output_pipeline
+    loci = None
+    if args["loci"]:
+        loci = load_loci(args["loci"])
+    elif args["site_index"]:
+        loci = site_loci(args)
+    # A loci file is always analysed as a panel, so that its output files do not depend on the
+    # number of loci it contains
+    if args["loci"] or loci and len(loci) > 1:
+        if args["anchor_sweep"]:
+            raise ValueError(f"{config.PARAMS['anchor_sweep']} requires a single locus, "
+                             f"{len(loci)} sites were found in the site index")
+        return PolyEdgePanel(bamfile, bam_index, loci, args["anchor_length"],
+                             combined=args["combined"], combined_pdf=args["combined_pdf"],
+                             **options)
+    gene, chrom, poly = loci[0] if loci else (
+        args["gene"], args["chrom"], (args["poly_start"], args["poly_end"])
+    )
+    if args["anchor_sweep"]:
+        return PolyEdgeSweep(bamfile, bam_index, gene, chrom, poly, args["anchor_sweep"],
+                             **options)
+    return PolyEdge(bamfile, bam_index, gene, chrom, poly, args["anchor_length"], **options)
+
+
+def site_loci(args):
+    """
+    Find the loci to analyse in a homopolymer site index: the sites in --region, named by --gene
+    if supplied, or otherwise the sites in the target region named --gene. Region chromosomes may
+    be given with or without a 'chr' prefix
+
+        :param args (dict):         Parsed command line arguments
+        :return loci (list):        List of (gene, chrom, poly) tuples, one per site
+    """
+    index = site_index.SiteIndex(args["site_index"])
+    try:
+        if args["region"]:
+            chrom, start, end = site_index.parse_region(args["region"])
+            contig = resolve_contig(index.contigs, chrom, f"the site index {args['site_index']}")
+            sites = index.sites(contig, start, end)
+        else:
+            sites = index.named(args["gene"])
+    finally:
+        index.close()
+    if not sites:
+        raise ValueError(f"No sites found in the site index for {args['region'] or args['gene']}")
+    return [
+        (args["gene"] or site.name or f"{site.base}{site.end - site.start}", site.contig,
+         (site.start, site.end))
+        for site in sites
+    ]
+
+
+def create_pdf_renderer(args, deferred=False):
+    """
+    Create the renderer used to write pdfs from the parsed command line arguments
+
+        :param args (dict):         Parsed command line arguments
+        :param deferred (bool):     Queue the pdfs to be rendered later (e.g. by the main process
+                                    in batch mode), rather than rendering them as they are
+                                    submitted
+        :return pdf_renderer (obj): PdfRenderer object
+    """
+    return PdfRenderer(deferred=deferred, enabled=not args["no_pdf"])
+
+
+def create_output_pipeline(args):
+    """
+    Create the pipeline used to write the output files from the parsed command line arguments
+
+        :param args (dict):             Parsed command line arguments
+        :return output_pipeline (obj):  OutputPipeline object
+    """
+    return OutputPipeline(args["pdf_workers"], args["output_queue"])
+
+
+def submit_output(output_pipeline, label, function, *args):
+    """
+    Write output files with the output pipeline, or immediately if there is no pipeline, in which
+    case any error is raised to the caller
+
+        :param output_pipeline (obj):   OutputPipeline, or None
+        :param label (str):             Name of the outputs written, used in log messages
+        :param function (func):         Function writing the outputs
+        :param args (list):             Arguments of function
+    """
+    if output_pipeline is None:
+        function(*args)
+    else:
+        output_pipeline.submit(label, function, *args)
+
+
+def write_timings(analysis, args):
+    """
+    Write the stage timings and read counters of an analysis to a json sidecar file if --timing
+    was supplied, and the profile of the per-read loop to a pstats file if --profile was supplied
+
+        :param analysis (obj):      PolyEdge, PolyEdgePanel or PolyEdgeSweep object
+        :param args (dict):         Parsed command line arguments
+    """
+    if args["timing"]:
+        analysis.timings.write(
+            analysis.timing_path, {"sample": analysis.sample_name, "version": git_tag()}
+        )
+    if args["profile"]:
+        analysis.timings.write_profile(analysis.profile_path)
+
+
+def create_result_cache(args):
+    """
+    Create the result cache from the parsed command line arguments
+
+        :param args (dict):         Parsed command line arguments
+        :return result_cache (obj): ResultCache object, or None if --no_cache was supplied
+    """
+    if args["no_cache"]:
+        return None
+    return ResultCache(args["cache_dir"], args["cache_size"], args["cache_hash"])
+
+
+def create_results_store(args, run_date=None):
+    """
+    Open the results store from the parsed command line arguments
+
+        :param args (dict):             Parsed command line arguments
+        :param run_date (str):          Date and time recorded for the loci added, in ISO format,
+                                        shared by every process of a run (default: now)
+        :return results_store (obj):    ResultsStore object, or None if --results_store was not
+                                        supplied
+    """
+    if not args["results_store"]:
+        return None
+    return ResultsStore(args["results_store"], run_date)
+
+
+def analysis_options(args):
+    """
+    Select the keyword arguments for PolyEdge and PolyEdgePanel from the parsed arguments
+
+        :param args (dict):         Parsed command line arguments
+        :return options (dict):     Keyword arguments
+    """
+    return {
+        "engine": args["engine"],
+        "read_filters": args["read_filters"],
+        "min_mapq": args["min_mapq"],
+        "early_stop": args["early_stop"],
+        "max_reads": args["max_reads"],
+        "dedup_mates": args["dedup_mates"],
+        "evidence": args["evidence"],
+        "threads": args["threads"],
+        "reference": args["reference"],
+        "ref_cache": args["ref_cache"],
+    }
+
+
+def validate_path(path):
+    """
+    Check path exists
+
+        :param path (str):  Input path to validate
+    """
+    if os.path.exists(path):
+        return path
+    else:
+        raise argparse.ArgumentTypeError(f"{path} is not a valid path")
+
+
+@functools.lru_cache(maxsize=None)
+def git_tag():
+    """Obtain git tag from current commit. Cached, so git is only run once per process
+
+    :return stdout (str):  String containing stdout, with newline characters removed
+    """
+    filepath = os.path.dirname(os.path.realpath(__file__))
+    cmd = f"git -C {filepath} describe --tags"
+
+    proc = subprocess.Popen(
+        [cmd], stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True
+    )
+    out, _ = proc.communicate()
+    return out.rstrip().decode("utf-8")
+
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    """Hash the source files that calculate the metrics, identifying the code version in result
+    cache keys whether or not it is a tagged git checkout. Cached, so the files are only hashed
+    once per process
+
+    :return digest (str):  Hex digest, or an empty string if a source file cannot be read
+    """
+    digest = hashlib.sha256()
+    filepath = os.path.dirname(os.path.realpath(__file__))
+    try:
+        for source_file in config.CACHE_SOURCE_FILES:
+            with open(os.path.join(filepath, source_file), "rb") as file:
+                digest.update(file.read())
+    except OSError:
+        return ""
+    return digest.hexdigest()
+
+
+def version_string():
+    """Identify the version of the code in stored results, as the git tag and the start of the
+    hash of the source files that calculate the metrics (e.g. v1.2.0+3f2a9c1e4b5d), so that it is
+    not empty in an untagged checkout
+
+    :return version (str):  Version string
+    """
+    return "+".join(part for part in [git_tag(), code_version()[:12]] if part)
 
 
 if __name__ == "__main__":
     args = arg_parse()
-    polyedge = PolyEdge(args["bam"], args["bai"], args["gene"], args["chrom"],
-                        (args["poly_start"], args["poly_end"]), args["anchor_length"])
-    polyedge.generate_output()
+    pdf_renderer = create_pdf_renderer(args)
+    result_cache = create_result_cache(args)
+    timings = StageTimings(profile=args["profile"])
+    results_store = create_results_store(args)
+    output_pipeline = create_output_pipeline(args)
+    polyedge = build_polyedge(args["bam"], args["bai"], args, pdf_renderer, result_cache, timings,
+                              results_store, output_pipeline)
+    try:
+        polyedge.generate_output()
+    finally:
+        # Finish writing the outputs of the loci already calculated, even if a later one failed
+        output_failures = output_pipeline.close()
+    if results_store:
+        results_store.close()
+    if result_cache:
+        result_cache.evict()
+    write_timings(polyedge, args)
+    if output_failures:
+        sys.exit(1)
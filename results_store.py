@@ -0,0 +1,330 @@
+""" Append-only SQLite store of polyedge results across runs, indexed for cross-sample queries such
+as the background fraction of an allele at a locus
+"""
+import os
+import argparse
+import csv
+import datetime
+import json
+import sqlite3
+import statistics
+import sys
+import config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS loci (
+    id INTEGER PRIMARY KEY,
+    sample TEXT NOT NULL,
+    bam TEXT NOT NULL,
+    run_date TEXT NOT NULL,
+    version TEXT NOT NULL,
+    gene TEXT NOT NULL,
+    chrom TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    anchor_length INTEGER NOT NULL,
+    total_read_count INTEGER NOT NULL,
+    read_filter_counts TEXT NOT NULL,
+    params TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS alleles (
+    locus_id INTEGER NOT NULL REFERENCES loci (id),
+    first_base TEXT NOT NULL,
+    read_count INTEGER NOT NULL,
+    mean_quality INTEGER NOT NULL,
+    read_fraction REAL NOT NULL,
+    mean_polylen REAL NOT NULL,
+    stdev_polylen REAL NOT NULL,
+    mode_polylen INTEGER NOT NULL,
+    poly_purity REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS loci_site ON loci (gene, chrom, pos);
+CREATE INDEX IF NOT EXISTS loci_position ON loci (chrom, pos);
+CREATE INDEX IF NOT EXISTS loci_sample ON loci (sample);
+CREATE INDEX IF NOT EXISTS loci_run_date ON loci (run_date);
+CREATE INDEX IF NOT EXISTS alleles_locus ON alleles (locus_id);
+"""
+
+ALLELE_COLUMNS = ["first_base", "read_count", "mean_quality", "read_fraction", "mean_polylen",
+                  "stdev_polylen", "mode_polylen", "poly_purity"]
+LOCUS_COLUMNS = ["sample", "run_date", "version", "gene", "chrom", "pos", "anchor_length",
+                 "total_read_count"]
+
+
+class ResultsStore:
+    """
+    Append-only store of the metrics for each locus analysed, with one row per locus per run in
+    the loci table and one row per allele in the alleles table. Concurrent runs (e.g. batch
+    workers) may write to the same store; each locus is written in its own transaction
+
+        add(locus, allele_list, total_read_count)
+            Append the metrics for a locus
+
+        find_loci(gene, chrom, pos, sample, since, until, limit)
+            Find the loci matching the filters, most recent first
+            :return loci (list):        List of sqlite3.Row objects
+
+        alleles(loci)
+            Load the alleles of loci
+            :return alleles (dict):     Locus id: list of sqlite3.Row objects
+
+        query(**filters)
+            Find the loci matching the filters, most recent first
+            :return rows (list):        List of dictionaries, one per allele per locus
+
+        background(allele, **filters)
+            Summarise the read fraction of each allele across the matching loci
+            :return summary (list):     List of dictionaries, one per allele
+
+        close()
+            Close the database connection
+    """
+
+    def __init__(self, path, run_date=None):
+        """
+        Constructor for ResultsStore class
+
+            :param path (str):          Path of SQLite database, created if it does not exist
+            :param run_date (str):      Date and time recorded for the loci added, in ISO format
+                                        (default: now)
+        """
+        self.path = path
+        self.run_date = run_date or current_run_date()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=config.RESULTS_STORE_TIMEOUT)
+        self.connection.row_factory = sqlite3.Row
+        # Write-ahead logging lets queries run while results are being appended
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def add(self, locus, allele_list, total_read_count):
+        """
+        Append the metrics for a locus
+
+            :param locus (dict):        sample, bam, version, gene, chrom, pos (1-based),
+                                        anchor_length, read_filter_counts and params of the locus
+            :param allele_list (list):  List of dictionaries, one per allele, containing
+                                        calculated metrics
+            :param total_read_count (int):  Total read count across all alleles
+        """
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO loci (sample, bam, run_date, version, gene, chrom, pos, "
+                "anchor_length, total_read_count, read_filter_counts, params) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    locus["sample"], locus["bam"], self.run_date, locus["version"],
+                    locus["gene"], str(locus["chrom"]), locus["pos"], locus["anchor_length"],
+                    total_read_count, json.dumps(locus["read_filter_counts"]),
+                    json.dumps(locus["params"], sort_keys=True),
+                ),
+            )
+            self.connection.executemany(
+                f"INSERT INTO alleles (locus_id, {', '.join(ALLELE_COLUMNS)}) "
+                f"VALUES (?, {', '.join('?' for _ in ALLELE_COLUMNS)})",
+                [
+                    (cursor.lastrowid, *[allele[column] for column in ALLELE_COLUMNS])
+                    for allele in allele_list
+                ],
+            )
+
+    def find_loci(self, gene=None, chrom=None, pos=None, sample=None, since=None, until=None,
+                  limit=None):
+        """
+        Find the loci matching the filters, most recent first. Chromosomes match with or without
+        a 'chr' prefix
+
+            :param gene (str):          Gene
+            :param chrom (str):         Chromosome
+            :param pos (int):           1-based position of the variant
+            :param sample (str):        Sample name
+            :param since (str):         Earliest run date (ISO format)
+            :param until (str):         Latest run date (ISO format)
+            :param limit (int):         Maximum number of loci, most recent first
+            :return loci (list):        List of sqlite3.Row objects
+        """
+        conditions = []
+        values = []
+        if gene:
+            conditions.append("gene = ?")
+            values.append(gene)
+        if chrom:
+            bare = chrom[3:] if chrom.lower().startswith("chr") else chrom
+            conditions.append("chrom IN (?, ?)")
+            values.extend([bare, f"chr{bare}"])
+        if pos:
+            conditions.append("pos = ?")
+            values.append(pos)
+        if sample:
+            conditions.append("sample = ?")
+            values.append(sample)
+        if since:
+            conditions.append("run_date >= ?")
+            values.append(since)
+        if until:
+            conditions.append("run_date <= ?")
+            # A date alone includes the whole of that day
+            values.append(f"{until}T23:59:59" if len(until) == 10 else until)
+        sql = "SELECT * FROM loci"
+        if conditions:
+            sql += f" WHERE {' AND '.join(conditions)}"
+        sql += " ORDER BY run_date DESC, id DESC"
+        if limit:
+            sql += " LIMIT ?"
+            values.append(limit)
+        return self.connection.execute(sql, values).fetchall()
+
+    def alleles(self, loci):
+        """
+        Load the alleles of loci
+
+            :param loci (list):         List of sqlite3.Row objects from the loci table
+            :return alleles (dict):     Locus id: list of sqlite3.Row objects
+        """
+        alleles = {locus["id"]: [] for locus in loci}
+        ids = list(alleles)
+        for start in range(0, len(ids), 500):  # Within SQLite's limit on query parameters
+            batch = ids[start:start + 500]
+            for allele in self.connection.execute(
+                f"SELECT * FROM alleles WHERE locus_id IN ({', '.join('?' for _ in batch)}) "
+                "ORDER BY locus_id, first_base",
+                batch,
+            ):
+                alleles[allele["locus_id"]].append(allele)
+        return alleles
+
+    def query(self, **filters):
+        """
+        Find the loci matching the filters (as for find_loci), most recent first
+
+            :param filters (dict):      Keyword arguments of find_loci
+            :return rows (list):        List of dictionaries, one per allele per locus
+        """
+        loci = self.find_loci(**filters)
+        alleles = self.alleles(loci)
+        return [
+            {**{column: locus[column] for column in LOCUS_COLUMNS},
+             **{column: allele[column] for column in ALLELE_COLUMNS}}
+            for locus in loci
+            for allele in alleles[locus["id"]]
+        ]
+
+    def background(self, allele=None, **filters):
+        """
+        Summarise the read fraction of each allele across the loci matching the filters (as for
+        find_loci), e.g. to estimate the background noise at a locus. Fractions are calculated
+        from the read counts, and loci where an allele was not seen count as a fraction of 0
+
+            :param allele (str):        Only summarise this allele
+            :param filters (dict):      Keyword arguments of find_loci
+            :return summary (list):     List of dictionaries, one per allele
+        """
+        loci = [locus for locus in self.find_loci(**filters) if locus["total_read_count"]]
+        alleles = self.alleles(loci)
+        fractions = {}
+        for locus in loci:
+            for row in alleles[locus["id"]]:
+                fractions.setdefault(row["first_base"], {})[locus["id"]] = (
+                    row["read_count"] / locus["total_read_count"]
+                )
+        summary = []
+        for first_base in sorted(fractions):
+            if allele and first_base != allele:
+                continue
+            values = sorted(fractions[first_base].get(locus["id"], 0.0) for locus in loci)
+            summary.append({
+                "first_base": first_base,
+                "loci": len(values),
+                "samples": len({locus["sample"] for locus in loci}),
+                "mean_fraction": round(statistics.mean(values), 4),
+                "median_fraction": round(statistics.median(values), 4),
+                "stdev_fraction": round(statistics.stdev(values), 4) if len(values) > 1 else 0,
+                "p95_fraction": round(values[min(len(values) - 1, int(0.95 * len(values)))], 4),
+                "max_fraction": round(values[-1], 4),
+            })
+        return summary
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        self.connection.close()
+
+
+def current_run_date():
+    """
+    Date and time of a run as recorded in the results store
+
+        :return run_date (str):     Current date and time, in ISO format
+    """
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def arg_parse():
+    """
+    Parse arguments supplied by the command line. Create argument parser, define command line
+    arguments, then parse supplied command line arguments using the created argument parser
+
+        :return (Namespace object): parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(
+        description="Query the polyedge results store, writing csv to standard output"
+    )
+    parser.add_argument("store", type=str, help="Results store (SQLite database)")
+    parser.add_argument(
+        config.PARAMS["gene"], type=str, help="Gene", required=False
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["chrom"], type=str, help="Chromosome, with or without a 'chr' prefix",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["pos"], type=int,
+        help="1-based position of the variant, as in the output files (poly_start + 1)",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["sample"], type=str, help="Sample name", required=False
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["since"], type=str, help="Earliest run date (e.g. 2024-01-31)",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["until"], type=str, help="Latest run date (e.g. 2024-12-31T23:59:59)",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["limit"], type=int, help="Only use the most recent loci matching the filters",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["background"], action="store_true",
+        help="Summarise the read fraction of each allele across the matching loci, rather than "
+        "listing them",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["allele"], type=str, help="Only summarise this allele (with --background)",
+        required=False,
+    )  # Optional arg
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    if not os.path.exists(args["store"]):
+        sys.exit(f"Results store {args['store']} does not exist")
+    store = ResultsStore(args["store"])
+    filters = {key: args[key] for key in
+               ["gene", "chrom", "pos", "sample", "since", "until", "limit"]}
+    if args["background"]:
+        rows = store.background(args["allele"], **filters)
+    else:
+        rows = store.query(**filters)
+    store.close()
+    if rows:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,345 @@
+""" Runs polyedge as a long-lived local server accepting analysis jobs as JSON over HTTP. The report
+templates, logo, version string and recently used bam files are kept in memory between jobs, so
+each job only pays for the analysis itself
+"""
+import os
+import json
+import time
+import argparse
+import traceback
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import config
+import polyedge
+from timing import StageTimings
+
+
+class AlignmentCache:
+    """
+    Least recently used cache of open pysam AlignmentFile objects. A cached file is reopened if the
+    bam file has been modified since it was opened
+
+        get(bamfile, bam_index, threads, reference, ref_cache)
+            Return an open AlignmentFile, opening it and closing the least recently used file if
+            the cache is full
+            :return reader (obj):       pysam AlignmentFile object
+
+        close()
+            Close all cached files
+    """
+
+    def __init__(self, max_open_files=config.SERVER_MAX_OPEN_FILES):
+        """
+        Constructor for AlignmentCache class
+
+            :param max_open_files (int):    Maximum number of files kept open
+        """
+        self.max_open_files = max_open_files
+        self.readers = OrderedDict()
+
+    def get(self, bamfile, bam_index, threads=config.DEFAULT_THREADS, reference=None,
+            ref_cache=None):
+        """
+        Return an open AlignmentFile, opening it and closing the least recently used file if the
+        cache is full
+
+            :param bamfile (str):       Bam or cram file
+            :param bam_index (str):     Bam or cram index file
+            :param threads (int):       Number of htslib decompression threads
+            :param reference (str):     Reference fasta used to decode cram files
+            :param ref_cache (str):     Directory of cached cram reference sequences
+            :return reader (obj):       pysam AlignmentFile object
+        """
+        stat = os.stat(bamfile)
+        key = (bamfile, bam_index, threads, reference, ref_cache, stat.st_size, stat.st_mtime_ns)
+        if key in self.readers:
+            self.readers.move_to_end(key)
+            return self.readers[key]
+        for cached_key in [cached for cached in self.readers if cached[:5] == key[:5]]:
+            self.readers.pop(cached_key).close()  # Bam file has been replaced
+        self.readers[key] = polyedge.open_alignment(
+            bamfile, bam_index, threads, reference, ref_cache
+        )
+        while len(self.readers) > self.max_open_files:
+            _, reader = self.readers.popitem(last=False)
+            reader.close()
+        return self.readers[key]
+
+    def close(self):
+        """
+        Close all cached files
+        """
+        while self.readers:
+            _, reader = self.readers.popitem()
+            reader.close()
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """
+    Handle requests to the polyedge server
+
+        do_GET()
+            GET /health: return the server version and number of open bam files
+
+        do_POST()
+            POST /analyse: run the analysis job in the request body and return the metrics
+
+        send_json(status, body)
+            Send a JSON response
+            :param status (int):        HTTP status code
+            :param body (dict):         Response body
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        GET /health: return the server version and number of open bam files
+        """
+        if self.path != "/health":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        self.send_json(200, {
+            "status": "ok",
+            "version": polyedge.version_string(),
+            "open_files": len(self.server.alignments.readers),
+        })
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        POST /analyse: run the analysis job in the request body and return the metrics
+        """
+        if self.path != "/analyse":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length) or b"{}")
+            result = run_job(job, self.server.defaults, self.server.alignments)
+        except (ValueError, KeyError, TypeError, OSError) as exception:
+            self.send_json(400, {"error": format_error(exception)})
+            return
+        except Exception as exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+            self.send_json(500, {"error": format_error(exception)})
+            return
+        result["seconds"] = round(time.perf_counter() - start, 4)
+        self.send_json(200, result)
+
+    def send_json(self, status, body):
+        """
+        Send a JSON response
+
+            :param status (int):        HTTP status code
+            :param body (dict):         Response body
+        """
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def run_job(job, defaults, alignments):
+    """
+    Run an analysis job. The job takes the same arguments as the command line (bam, bai, gene,
+    chrom, poly_start, poly_end, loci, site_index, region, anchor_length etc.), where loci may be
+    a path to a loci file or a list of [chrom, poly_start, poly_end, gene] lists. Output files are
+    written to output_dir unless write_outputs is false
+
+        :param job (dict):          Analysis job
+        :param defaults (dict):     Default analysis arguments
+        :param alignments (obj):    AlignmentCache of open bam files
+        :return result (dict):      Metrics for each locus, the paths of any output files and the
+                                    stage timings of the job
+    """
+    unknown = set(job) - set(defaults) - {"bam", "bai", "output_dir", "write_outputs"}
+    if unknown:
+        raise ValueError(f"Unknown job arguments: {', '.join(sorted(unknown))}")
+    args = {**defaults, **job}
+    if args["read_filters"] and not set(args["read_filters"]) <= set(config.READ_FILTER_FLAGS):
+        raise ValueError(f"read_filters must be from {', '.join(config.READ_FILTER_FLAGS)}")
+    if args["site_index"]:
+        if args["loci"] or not (args["region"] or args["gene"]):
+            raise ValueError("site_index requires region or gene, and is not allowed with loci")
+        sites = polyedge.site_loci(args)
+        if len(sites) == 1:
+            args["gene"], args["chrom"], (args["poly_start"], args["poly_end"]) = sites[0]
+        else:
+            args["loci"] = [[chrom, start, end, gene] for gene, chrom, (start, end) in sites]
+    if args["anchor_sweep"] and (args["loci"] or args["early_stop"] or args["max_reads"]):
+        raise ValueError("anchor_sweep is not allowed with loci, early_stop or max_reads")
+    if not args["loci"]:
+        missing = [arg for arg in ["gene", "chrom", "poly_start", "poly_end"] if args[arg] is None]
+        if missing:
+            raise ValueError(f"Job requires loci or {', '.join(missing)}")
+    write_outputs = args.get("write_outputs", True)
+    pdf_renderer = polyedge.create_pdf_renderer(args)
+    options = polyedge.analysis_options(args)
+    options["output_dir"] = args.get("output_dir")
+    options["pdf_renderer"] = pdf_renderer
+    result_cache = polyedge.create_result_cache(args)
+    options["result_cache"] = result_cache
+    timings = StageTimings(profile=args["profile"])
+    options["timings"] = timings
+    # Results are only appended to the store when the output files are written
+    results_store = polyedge.create_results_store(args)
+    options["results_store"] = results_store
+    output_pipeline = polyedge.create_output_pipeline(args)
+    options["output_pipeline"] = output_pipeline
+    try:
+        reader = alignments.get(
+            args["bam"], args["bai"], args["threads"], args["reference"], args["ref_cache"]
+        )
+        if args["loci"]:
+            if isinstance(args["loci"], str):
+                loci = polyedge.load_loci(args["loci"])
+            else:
+                loci = [(gene, chrom, (int(start), int(end)))
+                        for chrom, start, end, gene in args["loci"]]
+            analysis = polyedge.PolyEdgePanel(
+                args["bam"], args["bai"], loci, args["anchor_length"], combined=args["combined"],
+                reader=reader, combined_pdf=args["combined_pdf"], **options,
+            )
+        elif args["anchor_sweep"]:
+            analysis = polyedge.PolyEdgeSweep(
+                args["bam"], args["bai"], args["gene"], str(args["chrom"]),
+                (int(args["poly_start"]), int(args["poly_end"])), args["anchor_sweep"],
+                reader=reader, **options,
+            )
+        else:
+            analysis = polyedge.PolyEdge(
+                args["bam"], args["bai"], args["gene"], str(args["chrom"]),
+                (int(args["poly_start"]), int(args["poly_end"])), args["anchor_length"],
+                reader=reader, **options,
+            )
+        results = analysis.generate_output() if write_outputs else analysis.calculate_metrics()
+        if not args["loci"] and not args["anchor_sweep"]:
+            results = [(analysis, *results)]
+    finally:
+        # Queued outputs are written and the store closed even if the analysis fails
+        output_failures = output_pipeline.close()
+        if result_cache:
+            result_cache.evict()
+        if results_store:
+            results_store.close()
+    if write_outputs:
+        polyedge.write_timings(analysis, args)
+    # Combined panel and anchor sweep jobs write one set of output files for the whole job
+    combined = bool(args["loci"] and args["combined"] or args["anchor_sweep"])
+    locus_pdf = not (args["no_pdf"] or args["loci"] and args["combined_pdf"])
+    loci = []
+    for locus, allele_list, total_read_count in results:
+        locus_result = {
+            "gene": locus.gene,
+            "chrom": locus.chrom,
+            "pos": locus.variant_pos,
+            "anchor_length": locus.anchor_length,
+            "total_read_count": total_read_count,
+            "alleles": allele_list,
+            "read_filter_counts": locus.read_filter_counts,
+            "sampling": locus.sampling,
+        }
+        if args["evidence"]:
+            locus_result["evidence"] = locus.evidence_path
+        if write_outputs and not combined:
+            locus_result["outputs"] = [locus.csv_path, locus.html_path] + (
+                [locus.pdf_path] if locus_pdf else []
+            )
+        loci.append(locus_result)
+    result = {"loci": loci}
+    if write_outputs and combined:
+        result["outputs"] = [analysis.csv_path, analysis.html_path] + (
+            [] if args["no_pdf"] else [analysis.pdf_path]
+        )
+    elif write_outputs and args["loci"] and args["combined_pdf"] and not args["no_pdf"]:
+        result["outputs"] = [analysis.pdf_path]
+    result["timings"] = timings.report()
+    if output_failures:
+        result["output_errors"] = [f"{label}: {error}" for label, error in output_failures]
+    return result
+
+
+def format_error(exception):
+    """
+    Format an exception as a single line error message
+
+        :param exception (obj):     Exception raised by a job
+        :return error (str):        Error message
+    """
+    return "".join(traceback.format_exception_only(type(exception), exception)).strip()
+
+
+def analysis_defaults():
+    """
+    Default analysis arguments, as used by the command line interface
+
+        :return defaults (dict):    Default analysis arguments
+    """
+    parser = argparse.ArgumentParser()
+    polyedge.add_analysis_arguments(parser, parser.add_argument_group())
+    return vars(parser.parse_args([]))
+
+
+def warm_caches():
+    """
+    Load the report templates, logo and version string so that the first job does not pay for them
+    """
+    polyedge.git_tag()
+    polyedge.code_version()
+    polyedge.load_logo()
+    for template_name in [config.BASE_TEMPLATE, config.REPORT_TEMPLATE, config.PANEL_TEMPLATE,
+                          config.SWEEP_TEMPLATE]:
+        polyedge.load_template(template_name)
+
+
+def arg_parse():
+    """
+    Parse arguments supplied by the command line. Create argument parser, define command line
+    arguments, then parse supplied command line arguments using the created argument parser
+
+        :return (Namespace object): parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(
+        description="Run polyedge as a local server accepting analysis jobs as JSON"
+    )
+    parser.add_argument(
+        config.PARAMS["host"],
+        type=str,
+        default=config.SERVER_HOST,
+        help=f"Address to listen on (default: {config.SERVER_HOST})",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["port"],
+        type=int,
+        default=config.SERVER_PORT,
+        help=f"Port to listen on (default: {config.SERVER_PORT})",
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        config.PARAMS["max_open_files"],
+        type=int,
+        default=config.SERVER_MAX_OPEN_FILES,
+        help="Number of bam/cram files kept open between jobs "
+        f"(default: {config.SERVER_MAX_OPEN_FILES})",
+        required=False,
+    )  # Optional arg
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    warm_caches()
+    # Jobs are handled one at a time, as pysam file handles are not thread safe
+    server = HTTPServer((args["host"], args["port"]), JobHandler)
+    server.defaults = analysis_defaults()
+    server.alignments = AlignmentCache(args["max_open_files"])
+    print(f"Listening on http://{args['host']}:{args['port']}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.alignments.close()
+        server.server_close()
@@ -0,0 +1,466 @@
+""" Builds and queries an index of the homopolymer runs in a reference fasta, so that loci can be
+selected by gene or region rather than by typing their coordinates
+"""
+import os
+import argparse
+import json
+import mmap
+import struct
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import pysam
+import config
+
+# contig_id, start, end, name_id (-1 if unnamed), base
+RECORD = struct.Struct("<IIIi1s")
+HEADER = struct.Struct("<8sQ")  # magic, length of json metadata
+
+Site = namedtuple("Site", ["contig", "start", "end", "base", "name"])
+
+
+class SiteIndex:
+    """
+    Memory-mapped index of homopolymer runs. Runs are stored as fixed-size records sorted by
+    contig and start position (0-based, end exclusive), so that the runs overlapping a region are
+    found by binary search without reading the rest of the file
+
+        sites(contig, start, end)
+            Find the runs overlapping a region
+            :return sites (list):       List of Site tuples, in position order
+
+        named(name)
+            Find the runs in the target regions with a name
+            :return sites (list):       List of Site tuples, in position order
+
+        close()
+            Close the index file
+    """
+
+    def __init__(self, path):
+        """
+        Constructor for SiteIndex class
+
+            :param path (str):          Path of index file
+        """
+        self.path = path
+        with open(path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, metadata_length = HEADER.unpack_from(self.data, 0)
+        if magic != config.SITE_INDEX_MAGIC:
+            raise ValueError(f"{path} is not a polyedge site index")
+        self.metadata = json.loads(self.data[HEADER.size:HEADER.size + metadata_length])
+        self.records_offset = HEADER.size + metadata_length
+        self.contig_names = [contig for contig, _, _ in self.metadata["contigs"]]
+        # Contig name: (first record, number of records)
+        self.contigs = {
+            contig: (first, count) for contig, first, count in self.metadata["contigs"]
+        }
+        self.names = self.metadata["names"]
+
+    def record(self, index):
+        """
+        Read a record
+
+            :param index (int):         Index of record
+            :return site (obj):         Site tuple
+        """
+        contig_id, start, end, name_id, base = RECORD.unpack_from(
+            self.data, self.records_offset + index * RECORD.size
+        )
+        return Site(self.contig_names[contig_id], start, end, base.decode("ascii"),
+                    self.names[name_id] if name_id >= 0 else None)
+
+    def sites(self, contig, start=0, end=None):
+        """
+        Find the runs overlapping a region. Runs do not overlap each other, so their ends are in
+        the same order as their starts and the first run ending after the region start is found
+        by binary search
+
+            :param contig (str):        Contig name, as in the reference fasta
+            :param start (int):         0-based start of region
+            :param end (int):           0-based end of region (exclusive), or None for the end of
+                                        the contig
+            :return sites (list):       List of Site tuples, in position order
+        """
+        if contig not in self.contigs:
+            raise ValueError(f"Contig {contig} is not in the site index {self.path}")
+        first, count = self.contigs[contig]
+        low, high = first, first + count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle).end <= start:
+                low = middle + 1
+            else:
+                high = middle
+        sites = []
+        for index in range(low, first + count):
+            site = self.record(index)
+            if end is not None and site.start >= end:
+                break
+            sites.append(site)
+        return sites
+
+    def named(self, name):
+        """
+        Find the runs in the target regions with a name
+
+            :param name (str):          Name of target region (e.g. gene)
+            :return sites (list):       List of Site tuples, in position order
+        """
+        if name not in self.metadata["name_records"]:
+            raise ValueError(f"No sites named {name} in the site index {self.path}")
+        return [
+            self.record(index)
+            for first, count in self.metadata["name_records"][name]
+            for index in range(first, first + count)
+        ]
+
+    def close(self):
+        """
+        Close the index file
+        """
+        self.data.close()
+
+
+def find_runs(sequence, min_length):
+    """
+    Find the homopolymer runs in a sequence. Each base is searched for with str.find on a seed
+    of min_length copies of the base, which is much faster than a regex over every position, and
+    the run is then extended to its end
+
+        :param sequence (str):      Upper case sequence
+        :param min_length (int):    Shortest run to find
+        :return runs (list):        List of (start, end, base) tuples, in position order
+    """
+    runs = []
+    for base in "ACGT":
+        seed = base * min_length
+        start = sequence.find(seed)
+        while start != -1:
+            end = start + min_length
+            while end < len(sequence) and sequence[end] == base:
+                end += 1
+            runs.append((start, end, base))
+            start = sequence.find(seed, end)
+    runs.sort()
+    return runs
+
+
+def scan_sequence(fasta, contig, start, end, contig_length, min_length):
+    """
+    Find the homopolymer runs starting in a region, reading the sequence in chunks. A run
+    reaching the end of a chunk is found again in the next chunk so that it is not split, and
+    the sequence after the region is read only to find the end of a run crossing it
+
+        :param fasta (obj):         pysam FastaFile object
+        :param contig (str):        Contig name
+        :param start (int):         0-based start of region
+        :param end (int):           0-based end of region (exclusive)
+        :param contig_length (int): Length of contig
+        :param min_length (int):    Shortest run to find
+        :return runs (generator):   (start, end, base) tuples, in position order
+    """
+    position = start
+    chunk_size = config.SITE_INDEX_CHUNK
+    while position < end:
+        # A chunk which is all one run is doubled in size, past the region end if need be
+        chunk_end = min(position + chunk_size,
+                        end if chunk_size == config.SITE_INDEX_CHUNK else contig_length)
+        chunk = fasta.fetch(contig, position, chunk_end).upper()
+        limit = len(chunk)
+        if chunk_end < contig_length:
+            limit -= len(chunk) - len(chunk.rstrip(chunk[-1]))  # Trailing run may continue
+        for run_start, run_end, base in find_runs(chunk[:limit], min_length):
+            if position + run_start < end:
+                yield position + run_start, position + run_end, base
+        if limit == 0:
+            chunk_size *= 2
+        else:
+            chunk_size = config.SITE_INDEX_CHUNK
+            position += limit
+
+
+def find_run_start(fasta, contig, position):
+    """
+    Find the start of the homopolymer run containing a position, reading the sequence before it
+    in chunks until a different base is found
+
+        :param fasta (obj):         pysam FastaFile object
+        :param contig (str):        Contig name
+        :param position (int):      0-based position
+        :return start (int):        0-based start of the run
+    """
+    base = fasta.fetch(contig, position, position + 1).upper()
+    while position > 0:
+        chunk_start = max(0, position - config.SITE_INDEX_LOOKBACK)
+        remainder = fasta.fetch(contig, chunk_start, position).upper().rstrip(base)
+        position = chunk_start + len(remainder)
+        if remainder:
+            break
+    return position
+
+
+def scan_windows(reference, contig, contig_id, windows, min_length):
+    """
+    Find the homopolymer runs starting in each window of a contig. A run continuing from before
+    the start of a window belongs to the preceding window, unless the window is extended back to
+    the start of that run. Run in a worker process
+
+        :param reference (str):     Reference fasta (with fai index)
+        :param contig (str):        Contig name
+        :param contig_id (int):     Index of contig in the reference
+        :param windows (list):      List of (start, end, name_id, extend) tuples in position
+                                    order. Runs start in [start, end), or from the start of a run
+                                    crossing start if extend is True (e.g. for target regions)
+        :param min_length (int):    Shortest run to find
+        :return records (bytes):    Packed records, in position order
+    """
+    records = []
+    last_end = 0
+    with pysam.FastaFile(reference) as fasta:
+        contig_length = fasta.get_reference_length(contig)
+        for start, end, name_id, extend in windows:
+            if extend:
+                start = find_run_start(fasta, contig, start)
+            previous = fasta.fetch(contig, start - 1, start).upper() if start else ""
+            for run_start, run_end, base in scan_sequence(
+                fasta, contig, start, end, contig_length, min_length
+            ):
+                if run_start == start and previous == base:
+                    continue  # Run continues from the preceding window
+                if run_start >= last_end:
+                    records.append(
+                        RECORD.pack(contig_id, run_start, run_end, name_id, base.encode("ascii"))
+                    )
+                    last_end = run_end
+    return b"".join(records)
+
+
+def load_targets(targets_file):
+    """
+    Read target regions from a BED file with columns chrom, start, end and (optionally) name.
+    Overlapping regions are merged, keeping the name of the first
+
+        :param targets_file (str):  Path to BED file
+        :return targets (dict):     Contig name: list of (start, end, name) tuples in position
+                                    order
+    """
+    targets = {}
+    with open(targets_file, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            name = fields[3] if len(fields) > 3 and fields[3] else None
+            targets.setdefault(fields[0], []).append((int(fields[1]), int(fields[2]), name))
+    for contig, regions in targets.items():
+        merged = []
+        for start, end, name in sorted(regions, key=lambda region: region[:2]):
+            if merged and start < merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]), merged[-1][2])
+            else:
+                merged.append((start, end, name))
+        targets[contig] = merged
+    return targets
+
+
+def build_index(reference, output, min_length=config.SITE_INDEX_MIN_LENGTH, targets_file=None,
+                workers=None):
+    """
+    Scan a reference fasta for homopolymer runs and write them to an index file. The whole
+    genome is split into fixed-size segments, or each contig's target regions are scanned
+    together, and the jobs are spread over a pool of worker processes
+
+        :param reference (str):     Reference fasta (with fai index, created if missing)
+        :param output (str):        Path of index file to write
+        :param min_length (int):    Shortest run to index
+        :param targets_file (str):  Optional BED file of target regions to restrict the scan to
+        :param workers (int):       Number of worker processes (default: number of CPUs)
+        :return site_count (int):   Number of runs indexed
+    """
+    if not os.path.exists(f"{reference}.fai"):
+        pysam.faidx(reference)
+    with pysam.FastaFile(reference) as fasta:
+        contig_lengths = dict(zip(fasta.references, fasta.lengths))
+    targets = load_targets(targets_file) if targets_file else None
+    names = []
+    jobs = []
+    for contig_id, (contig, length) in enumerate(contig_lengths.items()):
+        if targets is None:
+            # One job per segment, so that large contigs are scanned in parallel
+            for start in range(0, length, config.SITE_INDEX_SEGMENT):
+                end = min(start + config.SITE_INDEX_SEGMENT, length)
+                jobs.append((contig_id, contig, [(start, end, -1, False)]))
+        elif contig in targets:
+            windows = []
+            for start, end, name in targets[contig]:
+                if name is not None and name not in names:
+                    names.append(name)
+                # A run starting before the target and continuing into it is included
+                windows.append((min(start, length), min(end, length),
+                                names.index(name) if name is not None else -1, True))
+            jobs.append((contig_id, contig, windows))
+    if targets is not None and not jobs:
+        raise ValueError(f"None of the contigs in {targets_file} are in {reference}")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(scan_windows, reference, contig, contig_id, windows, min_length)
+            for contig_id, contig, windows in jobs
+        ]
+        results = [future.result() for future in futures]
+    # Jobs are in contig and position order, so the records are already sorted
+    contigs = {contig: [contig, 0, 0] for contig in contig_lengths}
+    name_records = {}
+    site_count = 0
+    for (_, contig, _), records in zip(jobs, results):
+        if not contigs[contig][2]:
+            contigs[contig][1] = site_count
+        for _, _, _, name_id, _ in RECORD.iter_unpack(records):
+            if name_id >= 0:
+                ranges = name_records.setdefault(names[name_id], [])
+                if ranges and sum(ranges[-1]) == site_count:
+                    ranges[-1][1] += 1
+                else:
+                    ranges.append([site_count, 1])
+            site_count += 1
+            contigs[contig][2] += 1
+    metadata = json.dumps({
+        "reference": os.path.abspath(reference),
+        "targets": os.path.abspath(targets_file) if targets_file else None,
+        "min_length": min_length,
+        "contigs": list(contigs.values()),
+        "names": names,
+        "name_records": name_records,
+    }).encode("utf-8")
+    tmp_output = f"{output}.tmp"
+    with open(tmp_output, "wb") as file:
+        file.write(HEADER.pack(config.SITE_INDEX_MAGIC, len(metadata)))
+        file.write(metadata)
+        for records in results:
+            file.write(records)
+    os.replace(tmp_output, output)
+    return site_count
+
+
+def parse_region(region):
+    """
+    Parse a samtools-style region string: contig, contig:start or contig:start-end, with a
+    1-based inclusive start and end (commas are ignored)
+
+        :param region (str):        Region string
+        :return region (tuple):     (contig, start, end) with a 0-based start and exclusive end.
+                                    end is None if not supplied
+    """
+    contig, _, span = region.rpartition(":")
+    if not contig or not span.replace(",", "").replace("-", "").isdigit():
+        return region, 0, None
+    start, _, end = span.replace(",", "").partition("-")
+    return contig, int(start) - 1, int(end) if end else None
+
+
+def write_loci(sites, file):
+    """
+    Write sites in the loci file format read by polyedge --loci (chrom, poly_start, poly_end and
+    gene). Unnamed sites are named by their base and length (e.g. A27)
+
+        :param sites (list):        List of Site tuples
+        :param file (obj):          File to write to
+    """
+    file.write("#chrom\tpoly_start\tpoly_end\tgene\n")
+    for site in sites:
+        name = site.name or f"{site.base}{site.end - site.start}"
+        file.write(f"{site.contig}\t{site.start}\t{site.end}\t{name}\n")
+
+
+def arg_parse():
+    """
+    Parse arguments supplied by the command line. Create argument parser, define command line
+    arguments, then parse supplied command line arguments using the created argument parser
+
+        :return (Namespace object): parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(
+        description="Build or query an index of the homopolymer runs in a reference fasta"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Scan a reference fasta and write the index")
+    build.add_argument(
+        "-R",
+        config.PARAMS["reference"],
+        type=str,
+        required=True,
+        help="Reference fasta (a fai index is created if missing)",
+    )
+    build.add_argument(
+        "-o",
+        config.PARAMS["output"],
+        type=str,
+        required=True,
+        help="Path of index file to write",
+    )
+    build.add_argument(
+        config.PARAMS["targets"],
+        type=str,
+        default=None,
+        help="BED file of target regions to restrict the scan to. The name column, if present, "
+        "can be used to select sites by gene",
+        required=False,
+    )  # Optional arg
+    build.add_argument(
+        config.PARAMS["min_length"],
+        type=int,
+        default=config.SITE_INDEX_MIN_LENGTH,
+        help=f"Shortest homopolymer run to index (default: {config.SITE_INDEX_MIN_LENGTH})",
+        required=False,
+    )  # Optional arg
+    build.add_argument(
+        "-W",
+        config.PARAMS["workers"],
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes (default: number of CPUs)",
+        required=False,
+    )  # Optional arg
+    query = subparsers.add_parser(
+        "query", help="Write the sites in a region or target as a polyedge loci file"
+    )
+    query.add_argument("index", type=str, help="Site index file")
+    query_by = query.add_mutually_exclusive_group(required=True)
+    query_by.add_argument(
+        config.PARAMS["region"],
+        type=str,
+        help="Region (contig, contig:start or contig:start-end, 1-based inclusive)",
+    )
+    query_by.add_argument(
+        config.PARAMS["gene"],
+        type=str,
+        help="Name of target region (requires an index built with named --targets)",
+    )
+    query.add_argument(
+        config.PARAMS["min_length"],
+        type=int,
+        default=None,
+        help="Only write runs at least this long",
+        required=False,
+    )  # Optional arg
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    if args["command"] == "build":
+        count = build_index(args["reference"], args["output"], args["min_length"],
+                            args["targets"], args["workers"])
+        print(f"Indexed {count} homopolymer runs in {args['output']}")
+    else:
+        site_index = SiteIndex(args["index"])
+        if args["region"]:
+            found = site_index.sites(*parse_region(args["region"]))
+        else:
+            found = site_index.named(args["gene"])
+        site_index.close()
+        write_loci(
+            [site for site in found if site.end - site.start >= (args["min_length"] or 0)],
+            sys.stdout,
+        )
@@ -0,0 +1,215 @@
+""" Stage timings, read counters and optional profiling for polyedge runs, written to a json sidecar
+so that slow samples can be attributed to bam I/O, the per-read loop, templating or pdf rendering
+"""
+import time
+import json
+import cProfile
+import threading
+import functools
+import contextlib
+import config
+
+try:
+    import resource
+except ImportError:  # resource is only available on unix
+    resource = None
+
+
+class StageTimings:
+    """
+    Wall clock time spent in each stage of a run, and counts of the reads processed. Shared by
+    every locus in a run, including the output files written on other threads, so the times of
+    stages that overlap may add up to more than the run time
+
+        span(name)
+            Context manager adding the time spent inside it to a stage. The per-read loop
+            (calculate_metrics) is profiled if profiling is enabled
+
+        timed(name, iterable)
+            Iterate over an iterable, adding the time spent fetching each item to a stage. The
+            per-read loop (calculate_metrics) is profiled if profiling is enabled
+
+        count_reads(read_filter_counts)
+            Add the outcomes of the reads fetched for a locus to the read counters
+
+        report()
+            Summarise the timings and counters
+            :return report (dict):  Seconds and calls per stage, read counters, reads per second
+                                    and peak resident memory of the process
+
+        write(path, metadata)
+            Write the report to a json file
+
+        write_profile(path)
+            Write the profile of the per-read loop to a pstats file
+    """
+
+    def __init__(self, profile=False):
+        """
+        Constructor for StageTimings class
+
+            :param profile (bool):  Profile the per-read loop with cProfile
+        """
+        self.seconds = {}
+        self.calls = {}
+        self.read_counts = {reason: 0 for reason in config.READ_FILTER_REASONS}
+        self.profiler = cProfile.Profile() if profile else None
+        self.lock = threading.Lock()
+        # The peak is for the whole process, so may have been reached before this run started
+        self.start_peak_rss_mb = peak_rss_mb()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Context manager adding the time spent inside it to a stage. The per-read loop
+        (calculate_metrics) is profiled if profiling is enabled
+
+            :param name (str):      Name of stage
+        """
+        profiler = self.profiler if name == "calculate_metrics" else None
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, calls=1):
+        """
+        Add time to a stage
+
+            :param name (str):      Name of stage
+            :param seconds (float): Time spent in the stage
+            :param calls (int):     Number of times the stage was entered
+        """
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + calls
+
+    def timed(self, name, iterable):
+        """
+        Iterate over an iterable, adding the time spent fetching each item (e.g. reading and
+        decompressing each read from the bam file, or calculating the metrics for each locus) to a
+        stage. The per-read loop (calculate_metrics) is profiled if profiling is enabled
+
+            :param name (str):          Name of stage
+            :param iterable (obj):      Iterable to time
+            :return items (generator):  Items of the iterable
+        """
+        profiler = self.profiler if name == "calculate_metrics" else None
+        iterator = iter(iterable)
+        seconds = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                if profiler:
+                    profiler.enable()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    if profiler:
+                        profiler.disable()
+                    seconds += time.perf_counter() - start
+                yield item
+        finally:
+            self.add(name, seconds)
+
+    def count_reads(self, read_filter_counts):
+        """
+        Add the outcomes of the reads fetched for a locus to the read counters
+
+            :param read_filter_counts (dict):   Count of reads by outcome
+                                                (keys of config.READ_FILTER_REASONS)
+        """
+        with self.lock:
+            for reason, count in read_filter_counts.items():
+                self.read_counts[reason] = self.read_counts.get(reason, 0) + count
+
+    def report(self):
+        """
+        Summarise the timings and counters. Reads spanning the roi are those passing the read
+        filters, and reads anchored are those with both ends of the roi aligned
+
+            :return report (dict):  Seconds and calls per stage, read counters, reads per second
+                                    and peak resident memory of the process
+        """
+        counts = self.read_counts
+        reads_fetched = sum(counts.values())
+        reads_spanning = sum(
+            counts[reason]
+            for reason in ["not_sampled", "not_anchored", "mate_overlap", "no_poly", "counted"]
+        )
+        reads_processed = reads_spanning - counts["not_sampled"]
+        loop_seconds = self.seconds.get("calculate_metrics", 0.0)
+        return {
+            "stages": {
+                name: {"seconds": round(seconds, 6), "calls": self.calls[name]}
+                for name, seconds in self.seconds.items()
+            },
+            "reads": {
+                "fetched": reads_fetched,
+                "spanning": reads_spanning,
+                "processed": reads_processed,
+                "anchored": counts["mate_overlap"] + counts["no_poly"] + counts["counted"],
+                "counted": counts["counted"],
+            },
+            "reads_per_second": round(reads_fetched / loop_seconds) if loop_seconds else None,
+            "process_peak_rss_mb": peak_rss_mb(),
+            "process_peak_rss_mb_at_start": self.start_peak_rss_mb,
+        }
+
+    def write(self, path, metadata=None):
+        """
+        Write the report to a json file
+
+            :param path (str):      Path of json file to write
+            :param metadata (dict): Values identifying the run (e.g. sample and version), written
+                                    before the report
+        """
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({**(metadata or {}), **self.report()}, file, indent=2)
+        file.close()
+
+    def write_profile(self, path):
+        """
+        Write the profile of the per-read loop to a pstats file, which can be read with the
+        pstats module or a viewer such as snakeviz
+
+            :param path (str):      Path of pstats file to write
+        """
+        self.profiler.dump_stats(path)
+
+
+def timed_stage(name):
+    """
+    Decorator adding the time spent in a method to a stage of the object's StageTimings
+    (self.timings)
+
+        :param name (str):      Name of stage
+        :return decorator (func):   Method decorator
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.timings.span(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process since it started, including any earlier runs in the
+    same process (e.g. earlier samples analysed by a batch worker)
+
+        :return peak_rss (float):   Peak resident memory in MB, or None if not available
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)